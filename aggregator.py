@@ -0,0 +1,205 @@
+"""
+Downsampling of the sensor readings before they reach the Logger
+
+The sensors can be read as often as wanted: per sensor, only running statistics are kept
+over windows of windowS seconds (count, sums, min, max: O(1) memory, no sample stored).
+When a window is over, a single summary point is given to the Logger:
+- rawValue and calcValue: the means over the window ==> dashboards on these fields keep working
+- extra fields: calcMin, calcMax and count (the Logger needs nbExtra >= 3)
+  followed by the extra fields of the readings if any, e.g. the dispersion of the oversampling, merged
+  over the window: the minimum for the fields ending with Min, the maximum for the others
+  (the Logger needs nbExtra >= 3 + their number)
+The readings of a round given by addRow() are summarized together: when the window of the row is over,
+the summaries of all its sensors are given at once to Logger.addRow, e.g. one wide row.
+"""
+from micropython import const
+from time import time
+
+SUMMARY_FIELDS = const(("calcMin", "calcMax", "count"))
+# index of the running statistics of a sensor
+WINDOW = const(0)
+COUNT = const(1)
+SUM_RAW = const(2)
+SUM_CALC = const(3)
+MIN_CALC = const(4)
+MAX_CALC = const(5)
+LOG_TYPE = const(6)
+MESSAGE = const(7)
+EXTRA_FIELDS = const(8)
+EXTRA_VALUES = const(9)
+
+
+class Aggregator:
+    """
+    Drop-in in front of Logger.add and Logger.addRow: add() and addRow() have the same parameters
+    windowS: length of the windows in seconds, aligned on multiples of windowS since the epoch
+    clock: function returning the current time in seconds, injectable for testing
+    """
+    def __init__(self, logger, windowS=900, clock=time):
+        self.logger, self.windowS, self.clock = logger, windowS, clock
+        # sensorId --> [window, count, sumRaw, sumCalc, minCalc, maxCalc, logType, message, extraFields, extraValues]
+        self._stats = {}
+        self._rows = {}  # rowId --> [logType, message, sensorIds] of the rows in progress
+
+    def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None,
+            now=None):
+        """Account for one reading ; the summary of the previous window of this sensor is emitted if over"""
+        window = int(self.clock() if now is None else now) // self.windowS
+        stats = self._stats.get(sensorId)
+        if stats is not None and stats[WINDOW] != window:
+            self._emit(sensorId, stats)
+            stats = None
+        self._account(stats, window, logType, sensorId, message, rawValue, calcValue, extraFields, extraValues)
+
+    def addRow(self, logType, rowId, message, readings, now=None):
+        """
+        Account for the readings of a round, (sensorId, message, rawValue, calcValue[, extraFields, extraValues])
+        per sensor ;
+        the summaries of the previous window of the row are emitted together if over
+        """
+        window = int(self.clock() if now is None else now) // self.windowS
+        row = self._rows.get(rowId)
+        if row is not None and self._rowWindow(row) != window:
+            self._emitRow(rowId, row)
+        for r in readings:
+            self._account(self._stats.get(r[0]), window, logType, *r)
+        sensorIds = [r[0] for r in readings]
+        if rowId in self._rows:
+            sensorIds += [s for s in self._rows[rowId][2] if s not in sensorIds]
+        self._rows[rowId] = [logType, message, sensorIds]
+
+    def _account(self, stats, window, logType, sensorId, message, rawValue, calcValue, extraFields=None,
+                 extraValues=None):
+        calcValue = rawValue if calcValue is None else calcValue
+        if stats is None:
+            self._stats[sensorId] = [window, 1, rawValue, calcValue, calcValue, calcValue, logType, message,
+                                     extraFields, list(extraValues) if extraFields else None]
+        else:
+            if extraFields and len(stats) > EXTRA_FIELDS and stats[EXTRA_FIELDS]:
+                merged = stats[EXTRA_VALUES]
+                for i, name in enumerate(extraFields):
+                    value = extraValues[i]
+                    if (value < merged[i]) if name.endswith("Min") else (value > merged[i]):
+                        merged[i] = value
+            stats[COUNT] += 1
+            stats[SUM_RAW] += rawValue
+            stats[SUM_CALC] += calcValue
+            if calcValue < stats[MIN_CALC]:
+                stats[MIN_CALC] = calcValue
+            if calcValue > stats[MAX_CALC]:
+                stats[MAX_CALC] = calcValue
+
+    def flush(self, now=None, force=False):
+        """Emit the summaries of the windows over at time now, or of all the windows if force"""
+        window = int(self.clock() if now is None else now) // self.windowS
+        for rowId in list(self._rows):
+            row = self._rows[rowId]
+            if force or self._rowWindow(row) != window:
+                self._emitRow(rowId, row)
+        for sensorId in list(self._stats):
+            stats = self._stats[sensorId]
+            if force or stats[WINDOW] != window:
+                self._emit(sensorId, stats)
+
+    def _summary(self, stats):
+        """Extra fields and values of the summary of a window"""
+        fields, values = SUMMARY_FIELDS, (stats[MIN_CALC], stats[MAX_CALC], stats[COUNT])
+        if len(stats) > EXTRA_FIELDS and stats[EXTRA_FIELDS]:  # not in the snapshots saved before the extra fields
+            fields, values = fields + tuple(stats[EXTRA_FIELDS]), values + tuple(stats[EXTRA_VALUES])
+        return fields, values
+
+    def _emit(self, sensorId, stats):
+        count = stats[COUNT]
+        self.logger.add(stats[LOG_TYPE], sensorId, stats[MESSAGE], stats[SUM_RAW] / count, stats[SUM_CALC] / count,
+                        *self._summary(stats))
+        del self._stats[sensorId]
+
+    def _rowWindow(self, row):
+        """Window of the readings of a row, None if none is left"""
+        for sensorId in row[2]:
+            if sensorId in self._stats:
+                return self._stats[sensorId][WINDOW]
+        return None
+
+    def _emitRow(self, rowId, row):
+        summaries = []
+        for sensorId in row[2]:
+            stats = self._stats.pop(sensorId, None)
+            if stats is not None:
+                count = stats[COUNT]
+                summaries.append((sensorId, stats[MESSAGE], stats[SUM_RAW] / count, stats[SUM_CALC] / count)
+                                 + self._summary(stats))
+        if summaries:
+            self.logger.addRow(row[0], rowId, row[1], summaries)
+        del self._rows[rowId]
+
+    def dump(self):
+        """Running statistics and rows of the windows in progress, e.g. to be saved before a deep sleep"""
+        return [self._stats, self._rows]
+
+    def load(self, data):
+        if isinstance(data, dict):  # saved before the rows
+            data = [data, {}]
+        self._stats.update(data[0])
+        self._rows.update(data[1])
+
+
+if __name__ == "__main__":
+    # on CPython: compare the summaries with a brute force computation over the recorded samples
+    import random
+
+    class FakeLogger:
+        def __init__(self):
+            self.points, self.rows = [], []
+
+        def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
+            self.points.append((sensorId, rawValue, calcValue) + tuple(extraValues))
+
+        def addRow(self, logType, rowId, message, readings):
+            self.rows.append((rowId, message, readings))
+
+    log = FakeLogger()
+    agg = Aggregator(log, windowS=900)
+    samples = {}
+    for t in range(1_700_000_000, 1_700_000_000 + 4 * 3600, 7):
+        for sensorId in ("ACD0", "ACD1", "DHT11_T"):
+            raw = random.uniform(27000, 46000)
+            agg.add("DATA", sensorId, "moisture", raw, raw / 460, now=t)
+            samples.setdefault((sensorId, t // 900), []).append((raw, raw / 460))
+    agg.flush(force=True)
+    errors = 0
+    for sensorId in ("ACD0", "ACD1", "DHT11_T"):
+        emitted = [p[1:] for p in log.points if p[0] == sensorId]
+        windows = sorted(w for s, w in samples if s == sensorId)
+        for point, window in zip(emitted, windows):
+            values = samples[(sensorId, window)]
+            expected = (sum(v[0] for v in values) / len(values), sum(v[1] for v in values) / len(values),
+                        min(v[1] for v in values), max(v[1] for v in values), len(values))
+            errors += any(abs(a - b) > 1e-6 for a, b in zip(point, expected))
+        errors += len(emitted) != len(windows)
+    print(len(log.points), "summary points for", sum(len(v) for v in samples.values()), "readings,", errors, "errors")
+    assert errors == 0
+    # rows with the dispersion extra fields of the Oversampler: one summary per sensor, extras merged
+    extraFields = ("rawMin", "rawMax", "rawStddev")
+    rounds = {}
+    for t in range(1_700_000_000, 1_700_000_000 + 3600, 60):
+        readings = []
+        for sensorId in ("ACD0", "ACD1"):
+            raw = random.randint(27000, 46000)
+            extras = (raw - random.randint(0, 500), raw + random.randint(0, 500), random.uniform(0, 200))
+            readings.append((sensorId, "moisture", raw, raw / 460, extraFields, extras))
+            rounds.setdefault((sensorId, t // 900), []).append((raw, raw / 460) + extras)
+        agg.addRow("DATA", "moisture", "moisture", readings, now=t)
+    agg.flush(force=True)
+    windows = sorted({w for s, w in rounds})
+    assert len(log.rows) == len(windows)
+    for (rowId, message, summaries), window in zip(log.rows, windows):
+        assert (rowId, message) == ("moisture", "moisture") and len(summaries) == 2
+        for sensorId, sensorMessage, raw, calc, fields, values in summaries:
+            recorded = rounds[(sensorId, window)]
+            assert sensorMessage == "moisture" and fields == SUMMARY_FIELDS + extraFields
+            expected = (sum(v[0] for v in recorded) / len(recorded), sum(v[1] for v in recorded) / len(recorded),
+                        min(v[1] for v in recorded), max(v[1] for v in recorded), len(recorded),
+                        min(v[2] for v in recorded), max(v[3] for v in recorded), max(v[4] for v in recorded))
+            assert all(abs(a - b) < 1e-6 for a, b in zip((raw, calc) + values, expected)), (values, expected)
+    print(len(log.rows), "summary rows with", len(SUMMARY_FIELDS + extraFields), "extra fields each: ok")
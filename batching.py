@@ -0,0 +1,100 @@
+"""
+Adaptive sizing of the batches of points sent by Logger.push
+
+- the byte budget of a batch is derived from the free heap: the serialized payload never exceeds it
+- the number of points grows while InfluxDB answers 2xx quickly (additive increase)
+- it is halved after a timeout, a 413 (payload too large) or a 5xx (multiplicative decrease)
+  a 413 also halves the byte budget
+Fewer round trips on a large backlog, without risking an out of memory error on the Pico W.
+"""
+from micropython import const
+import gc
+
+MIN_BYTES = const(1024)
+MAX_BYTES = const(16384)
+
+
+def memFree():
+    """Free heap in bytes ; None on CPython where it is meaningless"""
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return None
+
+
+class BatchPolicy:
+    """
+    points: number of points to send in the next batch
+    maxBytes: maximum size of the serialized payload of a batch
+    """
+    def __init__(self, points=20, minPoints=1, maxPoints=250, step=10, fastMs=2000, memFraction=8):
+        self.minPoints, self.maxPoints, self.step = minPoints, maxPoints, step
+        self.fastMs = fastMs  # a response under fastMs milliseconds allows a larger batch
+        free = memFree()
+        self.maxBytes = max(MIN_BYTES, min(MAX_BYTES, free // memFraction)) if free else MAX_BYTES
+        self.points = max(minPoints, min(maxPoints, points))
+
+    def update(self, status_code, elapsedMs):
+        """Adapt the next batch to the outcome of the last write_api call"""
+        if 200 <= status_code < 300:
+            if elapsedMs < self.fastMs:
+                self.points = min(self.maxPoints, self.points + self.step)
+        elif status_code == 413 or status_code == 408 or status_code >= 500:
+            self.points = max(self.minPoints, self.points // 2)
+            if status_code == 413:
+                self.maxBytes = max(MIN_BYTES, self.maxBytes // 2)
+
+    def __str__(self):
+        return f"BatchPolicy({self.points} points, {self.maxBytes} bytes)"
+
+
+def bench_batching(nbPoints=500, latency=0.02, errorEvery=7, maxBody=6000):
+    """
+    Flush a backlog of nbPoints against the local stub server which answers with latency seconds,
+    a 503 every errorEvery requests and a 413 when the body is larger than maxBody bytes
+    Compares the former fixed slices of 20 points with the BatchPolicy
+    Returns a dictionary {policy name: (round trips, failed requests, wall time in ms)}
+    """
+    import time
+    from lineprotocol import LineWriter
+    from uhttp import HTTPConnection, stubServer
+
+    def status(index, length):
+        if length > maxBody:
+            return 413
+        return 503 if index % errorEvery == errorEvery - 1 else 204
+
+    results = {}
+    for name in ("fixed 20", "adaptive"):
+        server = stubServer(latency=latency, status=status)
+        http = HTTPConnection(server.url)
+        policy = BatchPolicy() if name == "adaptive" else None
+        writer = LineWriter(MAX_BYTES)
+        pending, trips, failed = nbPoints, 0, 0
+        start = time.perf_counter()
+        while pending:
+            writer.reset()
+            writer.limit = policy.maxBytes if policy else MAX_BYTES
+            batch = 0
+            while batch < min(pending, policy.points if policy else 20) and \
+                    writer.logPoint("28:cd:c1:07:e5:d5", (1679738601965652859 + batch, "DATA", "ACD0", "moisture", 40000.0, 29.0)):
+                batch += 1
+            sent = time.perf_counter()
+            status_code = http.request("POST", "/write?db=bench", writer.view())[0]
+            trips += 1
+            if policy:
+                policy.update(status_code, (time.perf_counter() - sent) * 1000)
+            if status_code < 300:
+                pending -= batch
+            else:
+                failed += 1
+        results[name] = (trips, failed, (time.perf_counter() - start) * 1000)
+        http.close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+if __name__ == "__main__":
+    for name, (trips, failed, ms) in bench_batching().items():
+        print(f"{name:>9}: {trips} round trips ({failed} failed), {ms:.0f} ms for 500 points")
@@ -0,0 +1,63 @@
+"""
+Helpers to measure the memory and time used by a piece of code
+Work on the Pico W (gc.mem_alloc) as well as on CPython (tracemalloc) to compare both
+"""
+import gc
+try:
+    from utime import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+    ticks_us = lambda: int(perf_counter() * 1_000_000)
+    ticks_diff = lambda a, b: a - b
+
+
+def memoryUsed(build):
+    """
+    Return (result of build(), bytes still allocated once built) i.e. the memory retained by the result
+    """
+    gc.collect()
+    try:
+        before = gc.mem_alloc()
+        result = build()
+        gc.collect()
+        return result, gc.mem_alloc() - before
+    except AttributeError:
+        import tracemalloc
+        tracemalloc.start()
+        result = build()
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, used
+
+
+def memoryAllocated(run):
+    """
+    Return (result of run(), bytes allocated while running)
+    MicroPython: total allocated with the garbage collector disabled
+    CPython: peak of the memory allocated at the same time, i.e. the copies alive together
+    """
+    gc.collect()
+    try:
+        gc.disable()
+        before = gc.mem_alloc()
+        result = run()
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        return result, allocated
+    except AttributeError:
+        gc.enable()
+        import tracemalloc
+        tracemalloc.start()
+        result = run()
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, allocated
+
+
+def timeUsed(run, repeat=1):
+    """Return (result of the last run(), average duration in microseconds)"""
+    start = ticks_us()
+    for i in range(repeat):
+        result = run()
+    return result, ticks_diff(ticks_us(), start) / repeat
@@ -0,0 +1,59 @@
+"""
+The 4 buttons around the screen, read through pin interrupts instead of polling
+- a rising edge records the button pressed and wakes the task waiting in next()
+- presses closer than debounceMs to the previous one on the same button are ignored (bounce effect)
+  even after a long idle time when ticks_ms() wrapped around
+The IRQ handler only stores integers and sets a flag: no allocation
+"""
+from micropython import const
+from machine import Pin
+from utime import ticks_ms, ticks_diff
+from events import ThreadSafeFlag, waitFor
+
+IDLE_MAX_MS = const(1 << 28)  # idleMs() stays there: ticks_diff is only valid within 2**29 ms on the rp2 port
+
+
+class Buttons:
+    def __init__(self, pins, debounceMs=150):
+        """pins: GPIO numbers of the buttons ; button i + 1 is on pins[i]"""
+        self.pins = [Pin(p, Pin.IN, Pin.PULL_DOWN) for p in pins]
+        self.debounceMs = debounceMs
+        self.pressed = 0   # last button pressed not yet consumed by next(), 0 if none
+        self._lastPress = [0] * len(self.pins)
+        self.lastPress = ticks_ms()  # last press on any button
+        self._idle = False  # latched once idleMs() reached IDLE_MAX_MS, cleared by a press
+        self._flag = ThreadSafeFlag()
+        for i, pin in enumerate(self.pins):
+            pin.irq(trigger=Pin.IRQ_RISING, handler=lambda p, i=i: self._irq(i))
+
+    def _irq(self, i):
+        now = ticks_ms()
+        # a negative difference or a latched idle: the ticks wrapped since the last press, not a bounce
+        if self._idle or not 0 <= ticks_diff(now, self._lastPress[i]) <= self.debounceMs:
+            self._lastPress[i] = self.lastPress = now
+            self._idle = False
+            self.pressed = i + 1
+            self._flag.set()
+
+    async def next(self, timeoutMs):
+        """Return the next button pressed (1 to 4) or 0 if none was pressed within timeoutMs"""
+        if not self.pressed:
+            await waitFor(self._flag.wait(), timeoutMs)
+        pressed, self.pressed = self.pressed, 0
+        return pressed
+
+    def idleMs(self):
+        """Milliseconds since the last press on any button, up to IDLE_MAX_MS"""
+        if not self._idle:
+            ms = ticks_diff(ticks_ms(), self.lastPress)
+            if 0 <= ms < IDLE_MAX_MS:
+                return ms
+            self._idle = True
+        return IDLE_MAX_MS
+
+    def setIdle(self):
+        """As if no button was pressed for long, e.g. after a restart without a press"""
+        self._idle = True
+
+    def anyPressed(self):
+        return any(pin.value() for pin in self.pins)
@@ -0,0 +1,94 @@
+"""
+Incremental gzip compression of the write_api payloads (Content-Encoding: gzip)
+- MicroPython: the deflate module (DeflateIO in GZIP format)
+- CPython: zlib with the same small window, to compare both
+The compressed bytes are written into a preallocated buffer as the lines are produced.
+"""
+from micropython import const
+try:
+    import deflate
+except ImportError:
+    deflate = None
+    import zlib
+
+WBITS = const(9)  # 512 bytes window: a few lines back, enough for the repeated measurement/tags/fields
+
+
+class BufferStream:
+    """Stream whose write() appends into a preallocated bytearray"""
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.size = 0
+
+    def write(self, data):
+        end = self.size + len(data)
+        if end > len(self.buffer):
+            raise ValueError("compressed payload larger than the buffer")
+        self.buffer[self.size:end] = data
+        self.size = end
+        return len(data)
+
+    def view(self):
+        return memoryview(self.buffer)[:self.size]
+
+
+class Compressor:
+    """gzip compressor writing into a stream: write() as many times as needed then close() once"""
+    def __init__(self, stream, wbits=WBITS):
+        self.stream = stream
+        if deflate:
+            self._deflate = deflate.DeflateIO(stream, deflate.GZIP, wbits)
+        else:
+            self._zlib = zlib.compressobj(6, zlib.DEFLATED, 16 + wbits)
+
+    def write(self, data):
+        if deflate:
+            self._deflate.write(data)
+        else:
+            self.stream.write(self._zlib.compress(data))
+
+    def close(self):
+        if deflate:
+            self._deflate.close()  # the underlying stream is left open
+        else:
+            self.stream.write(self._zlib.flush())
+
+
+def bench_compression(batches=(20, 100, 250), repeat=5):
+    """
+    Compression ratio and CPU time of gzip payloads against uncompressed ones
+    for realistic sensor batches: 3 soil moisture sensors + DHT temperature and humidity
+    Returns a dictionary {nbPoints: (plain bytes, gzip bytes, plain us, gzip us)}
+    """
+    from benchutils import timeUsed
+    from lineprotocol import LineWriter
+    sensors = (("ACD0", "moisture"), ("ACD1", "moisture"), ("ACD2", "moisture"),
+               ("DHT11_T", "temperature"), ("DHT11_H", "humidity"))
+    results = {}
+    for nbPoints in batches:
+        points = []
+        for i in range(nbPoints):
+            sensorId, message = sensors[i % 5]
+            raw = 27803.0 + (i * 7919) % 17872 if i % 5 < 3 else float(24 + i % 7)
+            points.append((1679738601965652859 + (i // 5) * 900_000_000_000 + i % 5 * 1234,
+                           "DATA", sensorId, message, raw, round(raw / 457.0, 2)))
+        sizes, times = [], []
+        for gzip in (False, True):
+            writer = LineWriter(nbPoints * 128, gzip=gzip)
+
+            def serialize():
+                writer.reset()
+                for point in points:
+                    writer.logPoint("28:cd:c1:07:e5:d5", point)
+                return len(writer.view())
+            size, us = timeUsed(serialize, repeat)
+            sizes.append(size)
+            times.append(us)
+        results[nbPoints] = (sizes[0], sizes[1], times[0], times[1])
+    return results
+
+
+if __name__ == "__main__":
+    for nbPoints, (plain, gz, plainUs, gzUs) in bench_compression().items():
+        print(f"{nbPoints:>4} points: {plain:>6} -> {gz:>5} bytes (ratio {plain / gz:.1f}), "
+              f"serialize {plainUs:.0f} us, with gzip {gzUs:.0f} us")
@@ -0,0 +1,132 @@
+"""
+Report-by-exception filter in front of Logger.add
+
+Soil moisture changes slowly: most readings repeat the last value sent.
+A DATA point is only queued when its calcValue moved out of the deadband around the last value queued
+for the same sensor, or when the sensor has been silent for heartbeatS seconds (gaps stay bounded).
+deadband = max(absolute, relative * |last value|)
+Other log types (INFO, WARNING, ERROR) always go through.
+addRow() filters each reading of a round the same way and passes on the ones kept as a smaller row.
+"""
+from time import time
+
+
+class Deadband:
+    """
+    target: Logger (or any object with the same add and addRow methods)
+    absolute, relative: default deadband ; thresholds: optional {sensorId: (absolute, relative)}
+    clock: function returning the current time in seconds, injectable for testing
+    """
+    def __init__(self, target, absolute=0.5, relative=0.0, heartbeatS=3600, thresholds=None, clock=time):
+        self.target = target
+        self.absolute, self.relative, self.heartbeatS = absolute, relative, heartbeatS
+        self.thresholds = thresholds or {}
+        self.clock = clock
+        self._last = {}  # sensorId --> [last value queued, time it was queued]
+        self.received = self.suppressed = 0
+
+    def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
+        """Same parameters as Logger.add ; return True if the point was passed on to the target"""
+        if not self._keep(logType, sensorId, rawValue if calcValue is None else calcValue, self.clock()):
+            return False
+        self.target.add(logType, sensorId, message, rawValue, calcValue, extraFields, extraValues)
+        return True
+
+    def addRow(self, logType, rowId, message, readings):
+        """Same parameters as Logger.addRow ; return the number of readings passed on to the target"""
+        now = self.clock()
+        kept = [r for r in readings if self._keep(logType, r[0], r[2] if r[3] is None else r[3], now)]
+        if kept:
+            self.target.addRow(logType, rowId, message, kept)
+        return len(kept)
+
+    def _keep(self, logType, sensorId, value, now):
+        """True if the value is out of the deadband of the sensor, then the new reference"""
+        self.received += 1
+        last = self._last.get(sensorId)
+        if logType == "DATA" and last is not None and now - last[1] < self.heartbeatS:
+            absolute, relative = self.thresholds.get(sensorId, (self.absolute, self.relative))
+            if abs(value - last[0]) <= max(absolute, relative * abs(last[0])):
+                self.suppressed += 1
+                return False
+        if last is None:
+            self._last[sensorId] = [value, now]
+        else:
+            last[0], last[1] = value, now
+        return True
+
+    def dump(self):
+        """Last values queued, e.g. to be saved before a deep sleep"""
+        return self._last
+
+    def load(self, data):
+        self._last.update(data)
+
+    @property
+    def ratio(self):
+        """Share of the points received which were suppressed"""
+        return self.suppressed / self.received if self.received else 0.0
+
+    def __str__(self):
+        return f"Deadband({self.suppressed}/{self.received} suppressed, {100 * self.ratio:.0f}%)"
+
+
+def syntheticTrace(days=7, periodS=300):
+    """
+    Soil moisture trace when no recorded one is given: 3 pots drying slowly, watered every 3 days,
+    read every periodS seconds with the ADC noise ; yields (time, sensorId, rawValue, calcValue)
+    """
+    import random
+    random.seed(1)
+    for t in range(0, days * 86400, periodS):
+        for pot in range(3):
+            dryness = ((t + pot * 40000) % (3 * 86400)) / (3 * 86400)  # 0 just watered --> 1 before watering
+            raw = 29000 + 15000 * dryness ** 0.7 + random.gauss(0, 60)
+            calc = round(min(100.0, max(0.0, (45675.9 - raw) * 100.0 / (45675.9 - 27803.7))), 1)
+            yield t, f"ACD{pot}", round(raw), calc
+
+
+def readTrace(path):
+    """Recorded trace as a CSV file: time in seconds, sensorId, rawValue, calcValue"""
+    with open(path) as f:
+        for line in f:
+            t, sensorId, raw, calc = line.strip().split(",")
+            yield int(t), sensorId, float(raw), float(calc)
+
+
+def bench_replay(path=None, absolute=0.5, heartbeatS=3600):
+    """
+    Replay a trace through the Deadband into a serializer counting the points queued and the bytes sent
+    Returns a dictionary {"unfiltered" / "deadband": (points queued, bytes sent)} and the Deadband
+    """
+    from lineprotocol import LineWriter
+
+    class Counter:
+        def __init__(self):
+            self.points = self.bytes = 0
+            self.writer = LineWriter(512)
+
+        def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
+            self.writer.reset()
+            self.writer.logPoint("28:cd:c1:07:e5:d5", (1679738601965652859, logType, sensorId, message,
+                                                      float(rawValue), float(calcValue)))
+            self.points += 1
+            self.bytes += len(self.writer.view()) + 1
+
+    now = [0]
+    unfiltered, filtered = Counter(), Counter()
+    deadband = Deadband(filtered, absolute=absolute, heartbeatS=heartbeatS, clock=lambda: now[0])
+    for t, sensorId, raw, calc in (readTrace(path) if path else syntheticTrace()):
+        now[0] = t
+        unfiltered.add("DATA", sensorId, "moisture", raw, calc)
+        deadband.add("DATA", sensorId, "moisture", raw, calc)
+    return {"unfiltered": (unfiltered.points, unfiltered.bytes),
+            "deadband": (filtered.points, filtered.bytes)}, deadband
+
+
+if __name__ == "__main__":
+    import sys
+    results, deadband = bench_replay(sys.argv[1] if len(sys.argv) > 1 else None)
+    for name, (points, nbBytes) in results.items():
+        print(f"{name:>10}: {points:>6} points queued, {nbBytes:>8} bytes sent")
+    print(deadband)
@@ -0,0 +1,61 @@
+"""
+Helpers for the delivery of the points by Logger.push
+- classification of the write_api status codes: success, retryable, malformed points, configuration error
+- exponential backoff with jitter between the failed attempts
+"""
+from micropython import const
+from random import getrandbits
+from utime import ticks_ms, ticks_add, ticks_diff
+
+SUCCESS = const(0)
+RETRYABLE = const(1)   # timeout, throttling, server error: the same points can be sent again later
+MALFORMED = const(2)   # the batch holds at least one point InfluxDB will never accept
+REJECTED = const(3)    # authentication, unknown bucket...: not the points' fault, stop and retry later
+
+
+def classify(status_code):
+    """Kind of outcome for a write_api status code ; write_api answers 500 when the socket fails"""
+    if status_code < 300:
+        return SUCCESS
+    if status_code in (400, 422):
+        return MALFORMED
+    if status_code in (408, 413, 429) or status_code >= 500:
+        return RETRYABLE
+    return REJECTED
+
+
+class Backoff:
+    """
+    Delay between 2 attempts after consecutive failures: min(cap, base * 2 ** failures)
+    "equal jitter": half of the delay is fixed, the other half random, so that retries do not synchronize
+    """
+    def __init__(self, baseMs=2000, capMs=600_000):
+        self.baseMs, self.capMs = baseMs, capMs
+        self.failures = 0
+        self.status = None   # status code of the last failure
+        self.nextAt = None   # ticks_ms of the next allowed attempt
+
+    def failed(self, status_code):
+        """Record a failure, return the delay in ms before the next attempt"""
+        delay = min(self.capMs, self.baseMs << min(self.failures, 20))
+        delay = delay // 2 + (delay // 2) * getrandbits(8) // 256
+        self.failures += 1
+        self.status = status_code
+        self.nextAt = ticks_add(ticks_ms(), delay)
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.status = self.nextAt = None
+
+    def waitMs(self):
+        """Milliseconds left before the next attempt is allowed, 0 if allowed now"""
+        if self.nextAt is None:
+            return 0
+        return max(0, ticks_diff(self.nextAt, ticks_ms()))
+
+    def ready(self):
+        return self.waitMs() == 0
+
+    def __str__(self):
+        return f"Backoff({self.failures} failures, wait {self.waitMs()} ms)"
@@ -4,50 +4,243 @@
   - screen: display a full screen with 4 buttons, title, footer and multi-lines text
   - test: display text for testing the display capacity
 
+Retained mode: the lines displayed are kept, multiLines() only redraws the characters which changed
+and sends the dirty part of the pages (8 pixels rows) with the SSD1306 page and column addressing,
+instead of the whole 1 KB framebuffer. bytesSent and frameBytes count the bytes written on the I2C bus.
+screen() takes the title and footer lines from a layout cache where they are prerendered,
+and slices the body lines one by one from mLines: see bench_screen()
+
+Power and refresh management by the run() task:
+- the display dims after dimS seconds without displayOn() (a button pressed), and is switched off after offS
+- requestScreen() and requestLines() only record the frame wanted: the task draws the last one requested
+  at most once per frameMs, so several requests in a row cost a single I2C flush and the callers never wait
+  While the display is off, nothing is drawn: the last frame requested is drawn when it is switched on
 """
 from micropython import const
-from utime import time
-from machine import Pin, I2C, Timer
+from array import array
+from utime import ticks_ms, ticks_diff
+from machine import Pin, I2C
 from ssd1306 import SSD1306_I2C
+import framebuf
+from events import asyncio, ThreadSafeFlag, waitFor
 
 WIDTH=const(128)
 HEIGHT=const(64)
 FONTSIZE=const((8, 10))  #  code to improve when we can change the font size (8px by 10px)
+LAYOUT_CACHE = const(8)  # title and footer layouts kept prerendered
+ON = const(0)
+DIM = const(1)
+OFF = const(2)
+FULL_CONTRAST = const(255)
+DIM_CONTRAST = const(1)
+SET_COL_ADDR = const(0x21)
+SET_PAGE_ADDR = const(0x22)
 
 class Display(SSD1306_I2C):
-    def __init__(self, port, scl, sda, width=WIDTH, height=HEIGHT, freq=400000):
-        i2c = I2C(port, scl=Pin(scl), sda=Pin(sda), freq=freq)
+    def __init__(self, port, scl, sda, width=WIDTH, height=HEIGHT, freq=400000, i2c=None,
+                 dimS=15, offS=60, frameMs=100):
+        """
+        i2c: bus to use instead of the one on port/scl/sda, e.g. a fake one for testing
+        dimS, offS: delays of inactivity before dimming and switching off the display
+        frameMs: minimum interval between 2 frames drawn by the run() task
+        """
+        if i2c is None:
+            i2c = I2C(port, scl=Pin(scl), sda=Pin(sda), freq=freq)
         self.fontSize = FONTSIZE  # default font size
-        super().__init__(width, height, i2c)
-        # self.displayoff_timer = Timer(mode=Timer.PERIODIC, period= 15 * 1000, callback=self.displayOff)
-        self.displayOn()
+        self.bytesSent = 0  # bytes written on the I2C bus since the start
+        self.frameBytes = 0  # bytes written for the last frame
+        self._rows, self._margins = None, None  # lines displayed and their margins
+        self._layouts = {}  # title, footer and buttons --> title and footer lines prerendered, see _chrome
+        # dirty columns of each page, none if from > to
+        self._dirtyFrom = array('h', [width] * (height // 8))
+        self._dirtyTo = array('h', [-1] * (height // 8))
+        self.dimMs, self.offMs, self.frameMs = dimS * 1000, offS * 1000, frameMs
+        self.power = ON  # ON, DIM or OFF
+        self._lastActivity = ticks_ms()
+        self._pending = None  # last frame requested: (method, args, kwargs)
+        self._flag = ThreadSafeFlag()
+        self._running = False  # True once the run() task is started
+        self.requests = self.frames = 0
+        super().__init__(width, height, i2c)  # switched on by the initialization
 
     def displayOn(self):
-        """Switch on the display and ensure 15 seconds ON"""
-        self.poweron()
-        self.offAt = time() + 15
+        """Switch on the display at full contrast and restart the idle timer ; return True if it was off"""
+        self._lastActivity = ticks_ms()
+        wasOff = self.power == OFF
+        if self.power != ON:
+            if wasOff:
+                self.poweron()
+            self.contrast(FULL_CONTRAST)
+            self.power = ON
+            if self._pending:
+                self._flag.set()  # the frame requested while off
+        return wasOff
+
+    def displayOff(self, timer=None):
+        self.poweroff()
+        self.power = OFF
+
+    def _idle(self):
+        """Dim then switch off after inactivity ; return the milliseconds before the next change, None if off"""
+        idle = ticks_diff(ticks_ms(), self._lastActivity)
+        if self.power == ON:
+            if idle < self.dimMs:
+                return self.dimMs - idle
+            self.contrast(DIM_CONTRAST)
+            self.power = DIM
+        if self.power == DIM:
+            if idle < self.offMs:
+                return self.offMs - idle
+            self.displayOff()
+        return None
+
+    def requestScreen(self, mLines, **kwargs):
+        """Same parameters as screen() ; drawn by the run() task, or at once if it is not running"""
+        self._request(self.screen, (mLines,), kwargs)
+
+    def requestLines(self, lines, topMargin=0, leftMargin=0):
+        """Same parameters as multiLines() ; drawn by the run() task, or at once if it is not running"""
+        self._request(self.multiLines, (lines, topMargin, leftMargin), None)
+
+    def _request(self, method, args, kwargs):
+        self.requests += 1
+        self._pending = (method, args, kwargs)
+        if self._running:
+            self._flag.set()
+        else:
+            self._flush()
+
+    def _flush(self):
+        if self._pending and self.power != OFF:
+            method, args, kwargs = self._pending
+            self._pending = None
+            method(*args, **kwargs) if kwargs else method(*args)
+            self.frames += 1
+
+    async def run(self):
+        """Task drawing the frames requested and dimming / switching off the display when idle"""
+        self._running = True
+        while True:
+            timeout = self._idle()
+            if timeout is None:
+                await self._flag.wait()
+            else:
+                await waitFor(self._flag.wait(), timeout)
+            if self._pending and self.power != OFF:
+                await asyncio.sleep(self.frameMs / 1000)  # the requests until then make a single frame
+                self._flush()
+
+    def write_cmd(self, cmd):
+        self.bytesSent += 2  # control byte + command
+        super().write_cmd(cmd)
+
+    def write_data(self, buf):
+        self.bytesSent += len(buf) + 1  # control byte + data
+        super().write_data(buf)
 
-    def displayOff(self, timer):
-        if self.offAt and time() > self.offAt:
-            self.poweroff()
-            self.offAt = None
+    def invalidate(self):
+        """To call after drawing directly in the framebuffer: the next screen() or multiLines() redraws everything"""
+        self._rows = None
+
+    def _markDirty(self, x0, x1, y0, y1):
+        x0, x1 = max(x0, 0), min(x1, self.width - 1)
+        for page in range(max(y0, 0) >> 3, (min(y1, self.height - 1) >> 3) + 1):
+            if x0 < self._dirtyFrom[page]:
+                self._dirtyFrom[page] = x0
+            if x1 > self._dirtyTo[page]:
+                self._dirtyTo[page] = x1
+
+    def _begin(self, topMargin, leftMargin):
+        """Start of a frame: everything is redrawn the first time, after invalidate() or a change of margins"""
+        if self._rows is None or self._margins != (topMargin, leftMargin):
+            self.fill(0)  # erase current screen to black
+            self._markDirty(0, self.width - 1, 0, self.height - 1)
+            self._rows, self._margins = [], (topMargin, leftMargin)
+        return self.bytesSent
+
+    def _end(self, start):
+        self.showDirty()
+        self.frameBytes = self.bytesSent - start
+
+    def _changed(self, i, new, x):
+        """
+        Replace the text of the row i by new ; return the columns (x0, x1) of the characters which changed,
+        x0 > x1 if none
+        """
+        rows = self._rows
+        while len(rows) <= i:
+            rows.append("")
+        old = rows[i]
+        if new == old:
+            return 1, 0
+        rows[i] = new
+        common = min(len(new), len(old))
+        first = 0
+        while first < common and new[first] == old[first]:
+            first += 1
+        last = max(len(new), len(old)) - 1
+        while first < last < common and new[last] == old[last]:
+            last -= 1
+        charWidth = self.fontSize[0]
+        return x + first * charWidth, min(x + (last + 1) * charWidth, self.width) - 1
+
+    def _drawRow(self, i, new, x, y):
+        """Draw the row i with the text new, erasing only the characters which changed"""
+        x0, x1 = self._changed(i, new, x)
+        if x0 <= x1:
+            # erase the characters changed, draw the line again over the unchanged pixels
+            rowHeight = self.fontSize[1]
+            self.fill_rect(x0, y, x1 - x0 + 1, rowHeight, 0)
+            self.text(new, x, y)
+            self._markDirty(x0, x1, y, y + rowHeight - 1)
+
+    def _blitRow(self, i, text, fb, x, y):
+        """Draw the row i from a prerendered framebuffer ; only the characters which changed are sent"""
+        x0, x1 = self._changed(i, text, x)
+        if x0 <= x1:
+            self.blit(fb, 0, y)
+            self._markDirty(x0, x1, y, y + self.fontSize[1] - 1)
 
     def multiLines(self, lines, topMargin=0, leftMargin=0):
         """
         Display all the lines separated by a \n from top to bottom
+        Only the characters which changed since the previous call are redrawn and sent
         :param lines: list of str separeted by \n
         :param topMargin: top margin in pixel
         :param leftMargin: left margin in pixel
         :return:
         """
-        self.displayOn()
-        self.fill(0)  # erase current screen to black
-        x, y = leftMargin, topMargin
-        for line in lines.split('\n'):
-            self.text(line, x, y)
+        start = self._begin(topMargin, leftMargin)
+        y = topMargin
+        lines = lines.split('\n')
+        for i in range(max(len(lines), len(self._rows))):
+            self._drawRow(i, lines[i] if i < len(lines) else "", leftMargin, y)
             y += self.fontSize[1]
-        self.show()
+        self._end(start)
 
+    def _chrome(self, title, footer, button1, button2, button3, button4, leftMargin):
+        """
+        Title and footer lines of a screen, rendered once per set of labels into framebuffers of one row
+        Returns [titleLine, footerLine, title framebuffer, footer framebuffer]
+        """
+        key = (title, footer, button1, button2, button3, button4, leftMargin)
+        layout = self._layouts.get(key)
+        if layout is None:
+            if len(self._layouts) >= LAYOUT_CACHE:
+                self._layouts.clear()
+            charByLine = self.width // self.fontSize[0]  #  font 10 -->  8px by 10px
+            t, b1, b2 = f"{title.strip():^{charByLine}}", button1.strip(), button2.strip()
+            titleLine = b1 + t[len(b1):charByLine-len(b2)] + b2
+            f, b3, b4 = f"{footer.strip():^{charByLine}}", button3.strip(), button4.strip()
+            footerLine = b3 + f[len(b3):charByLine-len(b4)] + b4
+            layout = [titleLine, footerLine]
+            for line in (titleLine, footerLine):
+                buffer = bytearray(self.width * ((self.fontSize[1] + 7) // 8))
+                fb = framebuf.FrameBuffer(buffer, self.width, self.fontSize[1], framebuf.MONO_VLSB)
+                fb.text(line, leftMargin, 0)
+                layout.append(fb)
+            self._layouts[key] = layout
+        return layout
 
     def screen(self, mLines, title="", footer="",
                button1="", button2="", button3="", button4="",
@@ -61,19 +254,64 @@ class Display(SSD1306_I2C):
             mLine 3.......
             mLine 4.......
             3    Footer  4
+
+            The title and footer lines come from the layout cache, the body lines are sliced
+            from mLines one by one and only their changes are redrawn
         """
-        charByLine = WIDTH // self.fontSize[0]  #  font 10 -->  8px by 10px
-        nbLines = HEIGHT // self.fontSize[1] - 2  # because 1st line is for Title and last line for Footer
-        t, b1, b2 = f"{title.strip():^{charByLine}}", button1.strip(), button2.strip()
-        titleLine = b1 + t[len(b1):charByLine-len(b2)] + b2
-        f, b3, b4 = f"{footer.strip():^{charByLine}}", button3.strip(), button4.strip()
-        footerLine = b3 + f[len(b3):charByLine-len(b4)] + b4
-        mLines += '\n' * nbLines
-        mLines = '\n'.join([ l[:charByLine] for l in (mLines.split('\n'))[:nbLines] ])
-        self.multiLines(f"""{titleLine}
-{mLines}
-{footerLine}""",
-                        leftMargin=leftMargin, topMargin=topMargin)
+        start = self._begin(topMargin, leftMargin)
+        layout = self._chrome(title, footer, button1, button2, button3, button4, leftMargin)
+        charByLine = self.width // self.fontSize[0]  #  font 10 -->  8px by 10px
+        rowHeight = self.fontSize[1]
+        nbLines = self.height // rowHeight - 2  # because 1st line is for Title and last line for Footer
+        self._blitRow(0, layout[0], layout[2], leftMargin, topMargin)
+        y, pos = topMargin + rowHeight, 0
+        for i in range(1, nbLines + 1):
+            end = mLines.find('\n', pos)
+            if end < 0:
+                end = len(mLines)
+            self._drawRow(i, mLines[pos:min(end, pos + charByLine)], leftMargin, y)
+            pos = min(end + 1, len(mLines))
+            y += rowHeight
+        self._blitRow(nbLines + 1, layout[1], layout[3], leftMargin, y)
+        for i in range(nbLines + 2, len(self._rows)):  # rows left by a longer multiLines
+            y += rowHeight
+            self._drawRow(i, "", leftMargin, y)
+        self._end(start)
+
+    def showDirty(self):
+        """
+        Send the dirty columns of the dirty pages only
+        Consecutive pages with the same dirty columns share one addressing window
+        """
+        width, pages = self.width, self.height // 8
+        offset = (128 - width) // 2  # narrower panels are centered in the 128 columns of the controller
+        buffer = memoryview(self.buffer)
+        page = 0
+        while page < pages:
+            x0, x1 = self._dirtyFrom[page], self._dirtyTo[page]
+            if x0 > x1:
+                page += 1
+                continue
+            last = page
+            while last + 1 < pages and self._dirtyFrom[last + 1] == x0 and self._dirtyTo[last + 1] == x1:
+                last += 1
+            for cmd in (SET_COL_ADDR, x0 + offset, x1 + offset, SET_PAGE_ADDR, page, last):
+                self.write_cmd(cmd)
+            if x0 == 0 and x1 == width - 1:  # full pages: contiguous in the framebuffer
+                self.write_data(buffer[page * width:(last + 1) * width])
+            else:  # the controller goes on with the next page of the window after x1
+                for p in range(page, last + 1):
+                    self.write_data(buffer[p * width + x0:p * width + x1 + 1])
+            for p in range(page, last + 1):
+                self._dirtyFrom[p], self._dirtyTo[p] = width, -1
+            page = last + 1
+
+    def show(self):
+        """Send the whole framebuffer"""
+        super().show()
+        for p in range(len(self._dirtyFrom)):
+            self._dirtyFrom[p], self._dirtyTo[p] = self.width, -1
+
 
     def test(self):
         """
@@ -85,15 +323,107 @@ class Display(SSD1306_I2C):
         t = "\n".join([l for i in range(7)])
         self.multiLines(t)
 
+def bench_screen(dis, repeat=50):
+    """
+    Bytes allocated and microseconds per HOME screen refresh, the clock changing every time:
+    former string building (padding, split, join and split again) against screen()
+    Returns a dictionary {name: (bytes allocated, microseconds)}
+    """
+    from benchutils import memoryAllocated, timeUsed
+    tick = [0]
+
+    def body():
+        tick[0] += 1
+        return f" 2024-03-25 MON\n 12:{tick[0] // 60 % 60:02}:{tick[0] % 60:02}\n Connected to\n MyWifi"
+
+    def former():
+        # the strings built by screen() before the layout cache
+        mLines, charByLine, nbLines = body(), dis.width // dis.fontSize[0], dis.height // dis.fontSize[1] - 2
+        t, b1, b2 = f"{'':^{charByLine}}", "Wifi", "ACD"
+        titleLine = b1 + t[len(b1):charByLine-len(b2)] + b2
+        f, b3, b4 = f"{'12 Send':^{charByLine}}", "Buzz", "DHT"
+        footerLine = b3 + f[len(b3):charByLine-len(b4)] + b4
+        mLines += '\n' * nbLines
+        mLines = '\n'.join([l[:charByLine] for l in (mLines.split('\n'))[:nbLines]])
+        dis.multiLines(f"""{titleLine}\n{mLines}\n{footerLine}""", leftMargin=1, topMargin=2)
+
+    def cached():
+        dis.screen(body(), footer="12 Send", button1="Wifi", button2="ACD", button3="Buzz", button4="DHT")
+
+    results = {}
+    for name, refresh in (("strings + multiLines", former), ("layout cache", cached)):
+        dis.invalidate()
+        refresh()  # first frame: full redraw, layout rendered
+        allocated = memoryAllocated(refresh)[1]
+        results[name] = (allocated, timeUsed(refresh, repeat)[1])
+    return results
+
+
 if __name__ == "__main__":
+    import sys
     from time import sleep, localtime
-    dis = Display(0, 17, 16)
+
+    class FakeBus:
+        """I2C bus with a SSD1306 at the end: keeps its display RAM up to date with the commands and data received"""
+        def __init__(self):
+            self.ram = bytearray(WIDTH * HEIGHT // 8)
+            self.bytes, self.cmd, self.col, self.page, self.window = 0, [], 0, 0, (0, WIDTH - 1, 0, HEIGHT // 8 - 1)
+
+        def writeto(self, addr, buf):
+            self.bytes += len(buf)
+            self.cmd.append(buf[1])
+            if len(self.cmd) == 3 and self.cmd[0] == SET_COL_ADDR:
+                self.window = (self.cmd[1], self.cmd[2]) + self.window[2:]
+                self.col, self.cmd = self.cmd[1], []
+            elif len(self.cmd) == 3 and self.cmd[0] == SET_PAGE_ADDR:
+                self.window = self.window[:2] + (self.cmd[1], self.cmd[2])
+                self.page, self.cmd = self.cmd[1], []
+            elif self.cmd[0] not in (SET_COL_ADDR, SET_PAGE_ADDR):
+                self.cmd = []
+
+        def writevto(self, addr, bufs):
+            for byte in bufs[1]:
+                self.ram[self.page * WIDTH + self.col] = byte
+                self.col += 1
+                if self.col > self.window[1]:
+                    self.col, self.page = self.window[0], self.page + 1 if self.page < self.window[3] else self.window[2]
+            self.bytes += 1 + len(bufs[1])
+
+    bus = FakeBus() if sys.implementation.name != "micropython" else None
+    dis = Display(0, 17, 16, i2c=bus)
     dis.screen("line 1 qui est tres longue\net ligne 2\nplus courte",
                title="Title", footer="Footer",
                button1="1", button2="2",button3="3", button4="4")
-    while True:
+    print("first frame:", dis.frameBytes, "bytes")
+    for i in range(5):
         now = localtime()
-        dis.multiLines(f"""{now[0]}-{now[1]:02}-{now[2]:02}
-{now[3]}:{now[4]:02}:{now[5]:02}""")
-    sleep(5)
-    dis.poweroff()
+        dis.screen(f"""{now[0]}-{now[1]:02}-{now[2]:02}\n{now[3]}:{now[4]:02}:{now[5] + i:02}""", title="HOME",
+                   footer=f"{i} points", button1="Wifi", button2="ACD", button3="Buzz", button4="DHT")
+        print("clock frame:", dis.frameBytes, "bytes", "- display RAM identical" if bus and bus.ram == dis.buffer else "")
+        sleep(1)
+    for name, (allocated, us) in bench_screen(dis).items():
+        print(f"{name:>20}: {allocated} bytes allocated, {us:.0f} us per refresh")
+
+    async def idleAndCoalescing():
+        dis.dimMs, dis.offMs = 300, 600
+        dis.displayOn()
+        asyncio.create_task(dis.run())
+        requests, frames = dis.requests, dis.frames
+        for i in range(10):  # 10 requests in 50 ms
+            dis.requestLines(f"request {i}")
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.2)
+        print(f"{dis.requests - requests} requests --> {dis.frames - frames} frame(s) drawn, power {dis.power}")
+        await asyncio.sleep(0.2)
+        print("dimmed:", dis.power == DIM)
+        await asyncio.sleep(0.3)
+        frames = dis.frames
+        dis.requestLines("while off")
+        await asyncio.sleep(0.2)
+        print("off:", dis.power == OFF, "- frames drawn while off:", dis.frames - frames)
+        dis.displayOn()  # a button pressed
+        await asyncio.sleep(0.2)
+        print("on:", dis.power == ON, "- frame requested while off drawn:", dis.frames - frames == 1)
+
+    asyncio.run(idleAndCoalescing())
+    dis.displayOff()
@@ -0,0 +1,42 @@
+"""
+Cooperative multitasking helpers shared by the application tasks
+- asyncio: uasyncio on the Pico W, asyncio on CPython
+- ThreadSafeFlag: flag set from an IRQ handler (or another thread) and awaited by a task
+  CPython has no ThreadSafeFlag: an asyncio.Event set through the event loop replaces it
+- waitFor: await with a timeout in milliseconds, returning False on timeout
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    ThreadSafeFlag = asyncio.ThreadSafeFlag
+except AttributeError:
+    class ThreadSafeFlag:
+        def __init__(self):
+            self._event = asyncio.Event()
+            self._loop = None
+
+        def set(self):
+            if self._loop:
+                self._loop.call_soon_threadsafe(self._event.set)
+            else:
+                self._event.set()
+
+        def clear(self):
+            self._event.clear()
+
+        async def wait(self):
+            self._loop = asyncio.get_running_loop()
+            await self._event.wait()
+            self._event.clear()
+
+
+async def waitFor(awaitable, timeoutMs):
+    """Return True if awaitable completed within timeoutMs milliseconds"""
+    try:
+        await asyncio.wait_for(awaitable, timeoutMs / 1000)
+        return True
+    except asyncio.TimeoutError:
+        return False
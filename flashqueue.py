@@ -0,0 +1,341 @@
+"""
+Persistent FIFO queue stored in a fixed-size ring file on the flash filesystem
+Used by the Logger to keep the pending points across a brownout or a watchdog reset
+
+File layout:
+- 2 header slots written alternately: magic, sequence number, geometry, head, count, number of the head record
+  and crc32 ; on opening, the valid header with the highest sequence number wins
+  ==> a power loss while writing one header falls back on the previous one
+- nbRecords record slots of recordSize bytes: payload length (2 bytes), record number (4 bytes), payload,
+  padding, crc32 (4 bytes) ; the records are numbered in sequence since the creation of the file
+
+The file is created once at its full size: writes never grow it and always cover a whole slot.
+append() only writes the record: one flash block write per point. The header is written when the head moves
+(popleft, drop: once per upload) and at least once per lap of the ring ; on opening, the records appended
+after the header are recovered by scanning the slots after its tail while they hold the next record numbers.
+A crash while writing a record only loses this point, never the queue.
+
+A file of the previous format (FQ01: no record numbers, a header written per append) is renamed *.fq01 on opening,
+its pending records are copied into a new file, then it is removed ; a crash in between resumes the copy.
+
+Operation Runtimes:
+- append: O(1) - one record write (+ one header write per lap of the ring)
+- popleft: O(1) - one record read + one header write
+- [i]: O(1) - one record read, None for a corrupted record
+- drop: O(1) - one header write whatever the number of records removed
+- len: O(1)
+"""
+from micropython import const
+import os
+import struct
+try:
+    from binascii import crc32
+except ImportError:
+    from ubinascii import crc32
+try:
+    import json
+except ImportError:
+    import ujson as json
+
+MAGIC = const(b"FQ02")
+HEADER_FMT = const("<4sIHHHHII")  # magic, seq, nbRecords, recordSize, head, count, first, crc32
+HEADER_SIZE = const(24)
+RECORD_OVERHEAD = const(10)  # 2 bytes for the payload length, 4 for the record number, 4 for the crc32
+
+V1_MAGIC = const(b"FQ01")
+V1_HEADER_FMT = const("<4sIHHHHI")  # magic, seq, nbRecords, recordSize, head, count, crc32
+V1_HEADER_SIZE = const(20)
+
+
+class FlashQueue:
+    """
+    deque-like queue (append, popleft, [i], drop, len, bool) persisted in a ring file
+    - maxlen: number of record slots ; when full, the oldest record is dropped like deque((), maxlen)
+    - recordSize: size in bytes of one slot ; the encoded item must fit in recordSize - 10 bytes
+    - encode/decode: convert an item to bytes and back ; json by default
+    """
+    def __init__(self, path, maxlen=500, recordSize=256, encode=None, decode=None):
+        self.path = path
+        self.maxlen, self.recordSize = maxlen, recordSize
+        self.encode = encode or (lambda item: json.dumps(item).encode())
+        self.decode = decode or (lambda data: json.loads(data))
+        self.seq, self.head, self.count = 0, 0, 0
+        self.first = 0  # number of the record at the head
+        self._pending = 0  # records appended since the last header write
+        self.dropped = 0   # number of records lost because the queue was full or a record was corrupted
+        self._record = bytearray(recordSize)  # reusable buffer for reading/writing one slot
+        try:
+            self._file = open(path, "r+b")
+        except OSError:
+            self._create()
+        if not self._load():
+            self._file.seek(0)
+            headers = self._file.read(2 * V1_HEADER_SIZE)
+            self._file.close()
+            if V1_MAGIC in (headers[:4], headers[V1_HEADER_SIZE:V1_HEADER_SIZE + 4]):
+                os.rename(path, path + ".fq01")
+            self._create()
+        self._upgrade(path + ".fq01")
+
+    def _create(self):
+        """Create the file at its full size, written slot by slot with zeros"""
+        with open(self.path, "wb") as f:
+            empty = bytes(HEADER_SIZE)
+            f.write(empty)
+            f.write(empty)
+            empty = bytes(self.recordSize)
+            for i in range(self.maxlen):
+                f.write(empty)
+        self._file = open(self.path, "r+b")
+        self.seq, self.head, self.count = 0, 0, 0
+        self._commit(0, 0, 0)
+
+    def _readHeader(self, slot):
+        """Return (seq, head, count, first) from a header slot or None if the slot is invalid"""
+        self._file.seek(slot * HEADER_SIZE)
+        data = self._file.read(HEADER_SIZE)
+        if len(data) < HEADER_SIZE:
+            return None
+        magic, seq, nbRecords, recordSize, head, count, first, crc = struct.unpack(HEADER_FMT, data)
+        if magic != MAGIC or crc != crc32(data[:HEADER_SIZE - 4]):
+            return None
+        if nbRecords != self.maxlen or recordSize != self.recordSize or head >= nbRecords or count > nbRecords:
+            return None
+        return seq, head, count, first
+
+    def _load(self):
+        """Restore the head/tail pointers from the most recent valid header and the records appended after it"""
+        best = None
+        for slot in (0, 1):
+            header = self._readHeader(slot)
+            if header and (best is None or header[0] > best[0]):
+                best = header
+        if best is None:
+            return False
+        self.seq, head, count, first = best
+        while self._read((head + count) % self.maxlen, first + count) is not None:
+            if count == self.maxlen:  # the oldest record was overwritten
+                head, first = (head + 1) % self.maxlen, first + 1
+            else:
+                count += 1
+        self.head, self.count, self.first = head, count, first
+        if (head, count, first) != best[1:]:
+            self._commit(head, count, first)  # the next scan starts from the records recovered
+        return True
+
+    def _upgrade(self, path):
+        """
+        Append the pending records of the FQ01 file path, if any, then remove it ;
+        the records already copied by an upgrade interrupted by a crash are skipped
+        """
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return
+        with f:
+            best = None
+            for slot in (0, 1):
+                data = f.read(V1_HEADER_SIZE)
+                if len(data) == V1_HEADER_SIZE:
+                    header = struct.unpack(V1_HEADER_FMT, data)
+                    if header[0] == V1_MAGIC and header[6] == crc32(data[:V1_HEADER_SIZE - 4]) and \
+                            (best is None or header[1] > best[1]):
+                        best = header
+            if best is not None:
+                magic, seq, nbRecords, recordSize, head, count, crc = best
+                record = bytearray(recordSize)
+                for i in range(self.first + self.count, count):
+                    f.seek(2 * V1_HEADER_SIZE + (head + i) % nbRecords * recordSize)
+                    f.readinto(record)
+                    size = struct.unpack_from("<H", record, 0)[0]
+                    if size <= recordSize - 6 and struct.unpack_from("<I", record, recordSize - 4)[0] == \
+                            crc32(memoryview(record)[:recordSize - 4]):
+                        self._write(record[2:2 + size])
+                    else:
+                        self._write(b"")  # corrupted: an empty payload keeps the count for the resume, read as None
+        self._commit(self.head, self.count, self.first)
+        os.remove(path)
+
+    def _commit(self, head, count, first):
+        """Write the new pointers in the header slot NOT holding the current header"""
+        seq = self.seq + 1
+        header = bytearray(struct.pack(HEADER_FMT, MAGIC, seq, self.maxlen, self.recordSize, head, count, first, 0))
+        struct.pack_into("<I", header, HEADER_SIZE - 4, crc32(header[:HEADER_SIZE - 4]))
+        self._file.seek((seq % 2) * HEADER_SIZE)
+        self._file.write(header)
+        self._file.flush()
+        self.seq, self.head, self.count, self.first = seq, head, count, first
+        self._pending = 0
+
+    def _offset(self, idx):
+        return 2 * HEADER_SIZE + idx * self.recordSize
+
+    def append(self, item):
+        """Write the item in the slot after the tail then move the tail, the header is written lazily"""
+        self._write(self.encode(item))
+
+    def _write(self, data):
+        size = len(data)
+        if size > self.recordSize - RECORD_OVERHEAD:
+            raise ValueError("record too large")
+        record = self._record
+        struct.pack_into("<HI", record, 0, size, self.first + self.count)
+        record[6:6 + size] = data
+        for i in range(6 + size, self.recordSize - 4):
+            record[i] = 0
+        struct.pack_into("<I", record, self.recordSize - 4, crc32(memoryview(record)[:self.recordSize - 4]))
+        self._file.seek(self._offset((self.head + self.count) % self.maxlen))
+        self._file.write(record)
+        self._file.flush()
+        if self.count == self.maxlen:  # full: the oldest record was overwritten
+            self.head, self.first = (self.head + 1) % self.maxlen, self.first + 1
+            self.dropped += 1
+        else:
+            self.count += 1
+        self._pending += 1
+        if self._pending == self.maxlen:  # the scan on opening does not go further than a lap of the ring
+            self._commit(self.head, self.count, self.first)
+
+    def _read(self, idx, number=None):
+        """
+        Return the payload of the record in slot idx or None if the record is corrupted
+        or, when number is given, if the slot does not hold this record number
+        An empty payload is a record found corrupted by the upgrade from FQ01
+        """
+        self._file.seek(self._offset(idx))
+        self._file.readinto(self._record)
+        record = self._record
+        size, found = struct.unpack_from("<HI", record, 0)
+        if size > self.recordSize - RECORD_OVERHEAD or (number is not None and found != number) or \
+                struct.unpack_from("<I", record, self.recordSize - 4)[0] != crc32(memoryview(record)[:self.recordSize - 4]):
+            return None
+        if not size:
+            return None if number is None else b""
+        return bytes(record[6:6 + size])
+
+    def popleft(self):
+        """Read the record at the head then move the head ; corrupted records are skipped"""
+        while self.count:
+            data = self._read(self.head)
+            self._commit((self.head + 1) % self.maxlen, self.count - 1, self.first + 1)
+            if data is not None:
+                return self.decode(data)
+            self.dropped += 1
+        raise IndexError("empty")
+
+    def __getitem__(self, i):
+        """Read the i-th record from the head without removing it ; None if the record is corrupted"""
+        if not 0 <= i < self.count:
+            raise IndexError("index out of range")
+        data = self._read((self.head + i) % self.maxlen)
+        return None if data is None else self.decode(data)
+
+    def drop(self, n):
+        """Remove the n oldest records with a single header write"""
+        n = min(n, self.count)
+        self._commit((self.head + n) % self.maxlen, self.count - n, self.first + n)
+
+    def clear(self):
+        self._commit((self.head + self.count) % self.maxlen, 0, self.first + self.count)
+
+    def close(self):
+        if self._pending:
+            self._commit(self.head, self.count, self.first)
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+
+if __name__ == "__main__":
+    # can be run on CPython against a plain file, including crashes injected between 2 writes
+    import os
+    PATH = "flashqueue_test.bin"
+    try:
+        os.remove(PATH)
+    except OSError:
+        pass
+
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    for i in range(3):
+        q.append({"sensorId": f"ACD{i}", "rawValue": 40000.0 + i})
+    q.close()
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    print("after reboot:", len(q), "records ; first:", q.popleft())
+
+    # power loss after appends without a header write: the records are recovered by the scan on opening
+    q.append({"sensorId": "ACD3", "rawValue": 40003.0})
+    q.append({"sensorId": "ACD4", "rawValue": 40004.0})
+    print("header written by the appends:", q._pending == 0)
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)  # without closing the previous one
+    print("after power loss:", len(q), "records")
+
+    # torn record write: the scan stops at the record, the queue is unchanged
+    q.append({"sensorId": "TORN", "rawValue": 0.0})
+    with open(PATH, "r+b") as f:
+        f.seek(q._offset((q.head + q.count - 1) % q.maxlen) + 8)
+        f.write(b"\xff" * 7)
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    print("after torn record:", len(q), "records")
+
+    # torn header write: the last header written is garbage, the previous header is used
+    q.append({"sensorId": "ACD3", "rawValue": 40003.0})
+    with open(PATH, "r+b") as f:
+        f.seek((q.seq % 2) * HEADER_SIZE)
+        f.write(b"\xff" * 7)
+    q.close()
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    print("after torn header:", len(q), "records")
+
+    # overflow drops the oldest records like deque((), maxlen)
+    for i in range(10):
+        q.append({"sensorId": "ACD0", "rawValue": float(i)})
+    print("full:", len(q), "dropped:", q.dropped, [q.popleft()["rawValue"] for i in range(len(q))])
+
+    # a corrupted record reads as None and is skipped by popleft
+    q.append({"sensorId": "ACD1", "rawValue": 1.0})
+    q.append({"sensorId": "ACD2", "rawValue": 2.0})
+    with open(PATH, "r+b") as f:
+        f.seek(q._offset(q.head) + 3)
+        f.write(b"\xff")
+    print("corrupted:", q[0], q[1], "popleft:", q.popleft(), "dropped:", q.dropped)
+    q.close()
+    os.remove(PATH)
+
+    # a FQ01 file, e.g. written before a firmware update: its pending records are moved into a new file
+    def writeV1(path, items, nbRecords=8, recordSize=64, head=6):
+        with open(path, "wb") as f:
+            header = bytearray(struct.pack(V1_HEADER_FMT, V1_MAGIC, 7, nbRecords, recordSize, head, len(items), 0))
+            struct.pack_into("<I", header, V1_HEADER_SIZE - 4, crc32(header[:V1_HEADER_SIZE - 4]))
+            f.write(bytes(V1_HEADER_SIZE) + header)  # the older header slot is empty
+            records = [bytearray(recordSize) for i in range(nbRecords)]
+            for i, item in enumerate(items):  # wrapping around the end of the ring
+                record, data = records[(head + i) % nbRecords], json.dumps(item).encode()
+                struct.pack_into("<H", record, 0, len(data))
+                record[2:2 + len(data)] = data
+                struct.pack_into("<I", record, recordSize - 4, crc32(record[:recordSize - 4]))
+            for record in records:
+                f.write(record)
+
+    items = [{"sensorId": f"ACD{i}", "rawValue": float(i)} for i in range(4)]
+    writeV1(PATH, items)
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    print("upgraded from FQ01:", len(q), "records", [q[i]["sensorId"] for i in range(len(q))], "left:",
+          [name for name in os.listdir(".") if name.startswith(PATH)])
+    assert [q[i] for i in range(len(q))] == items
+    q.close()
+    os.remove(PATH)
+
+    # crash during the upgrade, after copying 2 records: the copy resumes without duplicates
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    q.append(items[0])
+    q.append(items[1])
+    writeV1(PATH + ".fq01", items)
+    q = FlashQueue(PATH, maxlen=5, recordSize=64)
+    print("upgrade resumed:", len(q), "records")
+    assert [q[i] for i in range(len(q))] == items
+    q.close()
+    os.remove(PATH)
@@ -0,0 +1,131 @@
+"""
+Handoff of the points between the 2 cores of the RP2040
+
+Core 0 (sampling, UI) produces the points, core 1 (Wifi, InfluxDB) owns the Logger queue and delivers them.
+Handoff is a single producer / single consumer ring of fixed capacity, each put() and get() holding
+a _thread lock for a few instructions only: the producer never waits for a network operation.
+When the ring is full, put() refuses the point and counts it: the producer is never blocked.
+Counters: puts, gets, dropped, maxDepth and the latency between put() and get() (average, max).
+Producer gives a Logger-like add() and addRow() on core 0 putting the points in the ring.
+"""
+import _thread
+from array import array
+try:
+    from utime import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+    ticks_us = lambda: int(perf_counter() * 1_000_000) & 0x3FFFFFFF
+    ticks_diff = lambda a, b: ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+
+
+class Handoff:
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._putAt = array('I', [0] * capacity)  # ticks_us of the put of each slot
+        self._lock = _thread.allocate_lock()
+        self.puts = self.gets = 0  # the slot of the next put is puts % capacity, of the next get gets % capacity
+        self.dropped = 0  # points refused because the ring was full
+        self.maxDepth = 0
+        self.latencyUs = self.maxLatencyUs = 0  # total and max of the time spent in the ring
+        self.backlog = 0  # published by the consumer: points waiting in its own queue
+
+    def put(self, item):
+        """Producer side: return False if the ring is full"""
+        with self._lock:
+            depth = self.puts - self.gets
+            if depth == self.capacity:
+                self.dropped += 1
+                return False
+            i = self.puts % self.capacity
+            self._items[i] = item
+            self._putAt[i] = ticks_us()
+            self.puts += 1
+            if depth + 1 > self.maxDepth:
+                self.maxDepth = depth + 1
+        return True
+
+    def get(self):
+        """Consumer side: the oldest item, None if the ring is empty"""
+        with self._lock:
+            if self.gets == self.puts:
+                return None
+            i = self.gets % self.capacity
+            item, self._items[i] = self._items[i], None
+            latency = ticks_diff(ticks_us(), self._putAt[i])
+            self.gets += 1
+        self.latencyUs += latency
+        if latency > self.maxLatencyUs:
+            self.maxLatencyUs = latency
+        return item
+
+    def drainInto(self, queue):
+        """Consumer side: move all the items to queue (append) ; return how many"""
+        n = 0
+        item = self.get()
+        while item is not None:
+            queue.append(item)
+            n += 1
+            item = self.get()
+        return n
+
+    def __len__(self):
+        return self.puts - self.gets
+
+    def __str__(self):
+        average = self.latencyUs // self.gets if self.gets else 0
+        return (f"Handoff(depth {len(self)}/{self.capacity} max {self.maxDepth}, {self.puts} puts, "
+                f"{self.dropped} dropped, latency avg {average} us max {self.maxLatencyUs} us)")
+
+
+class Producer:
+    """
+    Drop-in for Logger.add on the producer core: the point is built at once (timestamp of the reading)
+    and put in the handoff ring ; makePoint: function building a point with the same parameters, e.g. Logger.makePoint
+    makeRow: optional function building the points of a row, e.g. Logger.makeRow, for addRow()
+    """
+    def __init__(self, handoff, makePoint, makeRow=None):
+        self.handoff, self.makePoint, self.makeRow = handoff, makePoint, makeRow
+
+    def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
+        return self.handoff.put(self.makePoint(logType, sensorId, message, rawValue, calcValue, extraFields, extraValues))
+
+    def addRow(self, logType, rowId, message, readings):
+        """Return False if a point of the row was dropped, the ring being full"""
+        put = True
+        for point in self.makeRow(logType, rowId, message, readings):
+            put = self.handoff.put(point) and put
+        return put
+
+
+if __name__ == "__main__":
+    # on CPython with 2 real threads: a producer in bursts, a slow consumer ; no item lost, reordered or duplicated
+    import random
+    import time
+
+    ring = Handoff(16)
+    received, refused = [], []
+    done = _thread.allocate_lock()
+    done.acquire()
+    N = 20_000
+
+    def producer():
+        for i in range(N):
+            while not ring.put(i):
+                refused.append(i)
+                time.sleep(0.0001)  # full: a real producer drops it, here it tries again to check the order
+            if random.random() < 0.01:
+                time.sleep(0.001)
+        done.release()
+
+    def consumer():
+        while len(received) < N:
+            if ring.drainInto(received) == 0:
+                time.sleep(0.0002)
+
+    _thread.start_new_thread(producer, ())
+    consumer()
+    done.acquire()
+    print(ring)
+    print(f"{len(received)} received, in order and complete: {received == list(range(N))}, "
+          f"{len(refused)} refused while full (counted {ring.dropped})")
@@ -0,0 +1,229 @@
+"""
+Serializer of points to the InfluxDB line protocol, written straight into one reusable preallocated buffer
+
+    measurement,tagKey=tagValue fieldKey="string",fieldKey=1.0 timestamp
+
+Escaping follows the InfluxDB rules:
+- measurement: comma and space
+- tag keys, tag values and field keys: comma, equal sign and space
+- string field values: double quote and backslash
+The escaped form of every string is cached: sensorId, message... are the same few strings for every point.
+"""
+from micropython import const
+from compression import BufferStream, Compressor
+
+MEASUREMENT = const(0)
+KEY = const(1)      # tag key, tag value and field key
+STRING = const(2)   # string field value
+GZIP_MARGIN = const(64)  # gzip header, trailer and block overhead over the uncompressed size
+_SPECIALS = ((44, 32), (44, 61, 32), (34, 92))  # ',' ' ' / ',' '=' ' ' / '"' '\\' per kind
+
+
+def escape(s, kind):
+    """Return s encoded to bytes with the characters special for this kind of element backslashed"""
+    data = s.encode()
+    specials = _SPECIALS[kind]
+    if not any(c in specials for c in data):
+        return data
+    escaped = bytearray()
+    for c in data:
+        if c in specials:
+            escaped.append(92)  # backslash
+        escaped.append(c)
+    return bytes(escaped)
+
+
+class LineWriter:
+    """
+    Append points in line protocol to a preallocated bytearray
+    A point is written completely or not at all: when the buffer is full, point() returns False
+    and the caller sends view() before calling reset()
+    limit can be lowered below the buffer size to cap the size of the (uncompressed) payload
+    gzip=True: every line is handed over to a gzip Compressor as soon as written,
+               the buffer only holds the current line and view() returns the compressed payload
+    """
+    def __init__(self, size=4096, gzip=False):
+        self.buffer = bytearray(size)
+        self.limit = size
+        self.size = 0     # number of bytes written in the buffer
+        self.flushed = 0  # number of uncompressed bytes already handed over to the compressor
+        self.gzip = gzip
+        self._out = BufferStream(size + GZIP_MARGIN) if gzip else None
+        self._compressor = None
+        self._cache = ({}, {}, {})  # one cache of escaped strings per kind
+        self.reset()
+
+    def reset(self):
+        self.size = self.flushed = 0
+        if self.gzip:
+            self._out.size = 0
+            self._compressor = Compressor(self._out)
+
+    def view(self):
+        """
+        memoryview on the payload: no copy
+        with gzip, the compressed stream is completed: reset() before writing new points
+        """
+        if self.gzip:
+            if self._compressor:
+                self._compressor.close()
+                self._compressor = None
+            return self._out.view()
+        return memoryview(self.buffer)[:self.size]
+
+    def _done(self):
+        """The current point is completely written: with gzip, compress its line"""
+        if self.gzip:
+            self._compressor.write(memoryview(self.buffer)[:self.size])
+            self.flushed += self.size
+            self.size = 0
+        return True
+
+    def _escaped(self, s, kind):
+        cache = self._cache[kind]
+        data = cache.get(s)
+        if data is None:
+            data = cache[s] = escape(s, kind)
+        return data
+
+    def _write(self, data):
+        end = self.size + len(data)
+        if self.flushed + end > self.limit:
+            raise IndexError
+        self.buffer[self.size:end] = data
+        self.size = end
+
+    def point(self, measurement, tags, fields, timestamp):
+        """
+        Write one line: tags and fields are tuples of (key, value) pairs
+        str field values are written as line protocol strings, int/float as float numbers
+        Return False, leaving the buffer unchanged, if the line does not fit
+        """
+        start = self.size
+        try:
+            if start or self.flushed:
+                self._write(b"\n")
+            self._write(self._escaped(measurement, MEASUREMENT))
+            for key, value in tags:
+                self._write(b",")
+                self._write(self._escaped(key, KEY))
+                self._write(b"=")
+                self._write(self._escaped(value, KEY))
+            sep = b" "
+            for key, value in fields:
+                self._write(sep)
+                self._write(self._escaped(key, KEY))
+                if isinstance(value, str):
+                    self._write(b'="')
+                    self._write(self._escaped(value, STRING))
+                    self._write(b'"')
+                else:
+                    self._write(b"=")
+                    self._write(repr(value).encode())
+                sep = b","
+            self._write(b" ")
+            self._write(str(timestamp).encode())
+        except IndexError:
+            self.size = start
+            if not (start or self.flushed):
+                raise ValueError("point larger than the buffer")
+            return False
+        return self._done()
+
+    def logPoint(self, systemId, point, timestamp=None):
+        """
+        Write a Logger point (timestamp, logType, sensorId, message, rawValue, calcValue[, extraFields, extraValues])
+        without building the intermediate tag and field tuples
+        A wide row has 2 extra field names more than values: they replace rawValue and calcValue
+        timestamp: written instead of the one of the point, e.g. converted to UTC
+        """
+        stamp, logType, sensorId, message, rawValue, calcValue = point if len(point) == 6 else point[:6]
+        if timestamp is None:
+            timestamp = stamp
+        start = self.size
+        try:
+            if start or self.flushed:
+                self._write(b"\n")
+            self._write(self._escaped(systemId, MEASUREMENT))
+            self._write(b",sensorId=")
+            self._write(self._escaped(sensorId, KEY))
+            self._write(b' logType="')
+            self._write(self._escaped(logType, STRING))
+            self._write(b'",message="')
+            self._write(self._escaped(message, STRING))
+            names = point[6] if len(point) > 6 else ()
+            first = len(names) - len(point[7]) if names else 0  # 2 for a wide row
+            if first:
+                self._write(b'",')
+                self._write(self._escaped(names[0], KEY))
+                self._write(b"=")
+                self._write(repr(rawValue).encode())
+                self._write(b",")
+                self._write(self._escaped(names[1], KEY))
+                self._write(b"=")
+            else:
+                self._write(b'",rawValue=')
+                self._write(repr(rawValue).encode())
+                self._write(b",calcValue=")
+            self._write(repr(calcValue).encode())
+            if names:
+                for i, value in enumerate(point[7]):
+                    self._write(b",")
+                    self._write(self._escaped(names[first + i], KEY))
+                    self._write(b"=")
+                    self._write(repr(value).encode())
+            self._write(b" ")
+            self._write(str(timestamp).encode())
+        except IndexError:
+            self.size = start
+            if not (start or self.flushed):
+                raise ValueError("point larger than the buffer")
+            return False
+        return self._done()
+
+
+def bench_allocation(nbPoints=500):
+    """
+    Bytes allocated per point to build the body of a write_api call:
+    former list of f-strings + join against the LineWriter buffer
+    Returns a dictionary {serializer name: bytes per point}
+    """
+    from benchutils import memoryAllocated
+    from pointstore import PointStore
+    systemId = "28:cd:c1:07:e5:d5"
+    store = PointStore(nbPoints)
+    for i in range(nbPoints):
+        store.append((1679738601965652859 + i * 1_000_000_000, "DATA", f"ACD{i % 3}", "moisture",
+                      float(40000 + i), float(i % 100)))
+
+    def fstrings():
+        data = []
+        for i in range(nbPoints):
+            timestamp, logType, sensorId, message, rawValue, calcValue = store[i]
+            data.append(f"""{systemId},sensorId={sensorId} logType="{logType}",message="{message}",\
+rawValue={rawValue},calcValue={calcValue} {timestamp}""")
+        return "\n".join(data).encode()
+
+    writer = LineWriter(nbPoints * 128)
+    writer.logPoint(systemId, store[0])  # warm up the cache of escaped strings
+
+    def lineWriter():
+        writer.reset()
+        for i in range(nbPoints):
+            writer.logPoint(systemId, store[i])
+        return writer.view()
+
+    results = {}
+    for name, run in (("f-strings + join", fstrings), ("LineWriter", lineWriter)):
+        body, allocated = memoryAllocated(run)
+        results[name] = allocated / nbPoints
+    assert bytes(fstrings()) == bytes(lineWriter())
+    return results
+
+
+if __name__ == "__main__":
+    w = LineWriter(256)
+    w.point("my meas", (("sensor,Id", "AC D=2"),), (("message", 'say "hi" \\o/'), ("rawValue", 1.5)), 1679738601965652859)
+    print(bytes(w.view()).decode())
+    for name, perPoint in bench_allocation().items():
+        print(f"{name:>18}: {perPoint:.1f} bytes allocated per point")
@@ -2,7 +2,8 @@
 Logger for the application into InfluxDb time-serie Database
 
 Every Log entry will have the following structure:
-- timestamp: the moment the data was collected ; Unix timestamp in nanosecond
+- timestamp: the moment the data was collected ; monotonic microseconds of the timebase in the queue,
+  converted to a Unix timestamp in nanosecond when written to InfluxDB
 - logType: INFO, WARNING, ERROR, DATA
 - systemId: a free name to identify the system generating the logs ; PicoW mac is used
 - sensorId: a sensor belonging to the system
@@ -10,13 +11,36 @@ Every Log entry will have the following structure:
 - rawValue: the value obtained from the sensor, as a real number
 - calcValue: the result of a calculation from the raw value to convert the raw value to the final value
 
+Rows: addRow() queues the readings of several sensors taken together (a sampling round) with one timestamp
+- rows=False (default): one point per sensor as add() does, the dashboards on sensorId/calcValue keep working
+- rows=True: wide rows, one point for the round: sensorId is the id of the row and each sensor is a field
+  holding its calcValue, the measurement, tags, logType and message are written once instead of per sensor
+  e.g. 28:cd:c1:07:e5:d5,sensorId=moisture logType="DATA",message="moisture",ACD0=29.0,ACD1=31.5,ACD2=30.2 1679...
+  A row holds up to nbExtra + 2 sensors, larger rounds are split in several rows
 """
 from micropython import const
-from collections import deque
+import json
 import urequests
 import socket
-from utime import time_ns, ticks_us
+from uhttp import HTTPConnection
+from utime import ticks_ms, ticks_diff, sleep_ms
 from ssids import influxDBsecrets, LOCALTZ
+from pointstore import PointStore
+from lineprotocol import LineWriter
+from batching import BatchPolicy
+from delivery import Backoff, classify, SUCCESS, MALFORMED, REJECTED
+from telemetry import metrics
+from timebase import timebase
+
+RETRY_WAIT_MS = const(5_000)  # longest backoff waited inside push, longer ones are left to the next push
+
+WRITE_MS = metrics.histogram("write.ms", (100, 200, 500, 1000, 2000, 5000))
+# write_api status codes per class in consecutive counters, HTTP_STATUS + class - 2 ; network errors count as 5xx
+HTTP_STATUS = metrics.counter("write.2xx")
+metrics.counter("write.3xx")
+metrics.counter("write.4xx")
+metrics.counter("write.5xx")
+WRITTEN = metrics.counter("write.points")
 
 
 class uInfluxDBClient():
@@ -38,23 +62,32 @@ class uInfluxDBClient():
         self.host, self.port = host or influxDBsecrets.get('host'), int(port or influxDBsecrets.get('port', 8086))
         self.url = url or influxDBsecrets.get("url") or f"http://{self.host}:{self.port}"
         self.bucket = influxDBsecrets.get("bucket")
+        self.http = HTTPConnection(self.url, timeout=5)  # one keep-alive connection for all the write_api calls
 
-    def write_api(self, bucket, records):
+    def write_api(self, bucket, records, gzip=False):
         """
         bucket:  A created database in InfluxDb
-        records: A list of points/data to write in this bucket/database expressed as line protocol string
+        records: the points/data to write in this bucket/database expressed in line protocol
+                 either a list of strings or a buffer already serialized, e.g. LineWriter.view()
+        gzip:    True if records is a gzip compressed buffer
+        All the calls share the keep-alive connection: only the first one pays for the TLS handshake
         """
-        url_write = f"{self.url}/write?db={bucket or self.bucket}"
+        if isinstance(records, list):
+            records = "\n".join(records).encode()
+        headers = {'Authorization': f'Token {self.token}'} if self.token else {}
+        if gzip:
+            headers['Content-Encoding'] = 'gzip'
         try:
-            response = urequests.post(url_write,
-                                  data="\n".join(records), timeout=5,
-                                  headers={'Authorization': f'Token {self.token}'} if self.token else {})
-            res = response.status_code
+            res, body = self.http.request("POST", f"/write?db={bucket or self.bucket}", records, headers=headers)
         except OSError as err:
             print("***", err)
             res = 500
         return res
 
+    def close(self):
+        """Close the keep-alive connection, e.g. before switching the Wifi off"""
+        self.http.close()
+
     def health_api(self):
         """
         health check of the influxDb database access
@@ -84,6 +117,21 @@ class uInfluxDBClient():
         return res
 
 
+def encodeUtc(point):
+    """
+    FlashQueue encoder of the points: the timestamp stored as UTC microseconds, the monotonic count
+    of the time base starting again from 0 after a reset
+    """
+    return json.dumps([timebase.utcUs(point[0])] + list(point[1:])).encode()
+
+
+def decodeUtc(data):
+    """FlashQueue decoder of the points stored by encodeUtc"""
+    point = json.loads(data)
+    point[0] = timebase.monoUs(point[0])
+    return point
+
+
 class Logger:
     """
     Connectivity with an influxDB hosted on a server
@@ -100,88 +148,205 @@ class Logger:
     }
     
 
-    def __init__(self, systemId, url=None, host=None, port=None, org=None, tz=0):
+    def __init__(self, systemId, url=None, host=None, port=None, org=None, tz=0, queue=None, gzip=False, nbExtra=0,
+                 rows=False):
         """
         # connects to the database hosted on http://host:port
         # systemId: identifies the system either by a given name or by its mac address
         #           this will be a measurement/database for InfluxDb
+        # queue: optional storage for the pending points, e.g. FlashQueue("logQ.bin", encode=encodeUtc,
+        #        decode=decodeUtc) to survive a reboot
+        #        default is a PointStore in RAM
+        # gzip: compress the write_api payloads, less airtime on large backlogs
+        # nbExtra: number of extra fields a point can carry, e.g. 3 for the Aggregator summaries
+        # rows: addRow() queues wide rows, one field per sensor, instead of one point per sensor
         """
-        self.logEntries = deque((), 500)  #  FIFO queue accepting 1000 pending readings
-        self.point["systemId"] = systemId
+        self.logEntries = queue if queue is not None else PointStore(500, nbExtra)  #  FIFO queue accepting 500 pending readings
+        self.systemId = systemId  # shared by all the points, hence not stored in the queue
         self.InfluxClient = uInfluxDBClient(url=url, host=host, port=port, org=org)
+        self.batch = BatchPolicy()  # adaptive number of points and bytes per write_api call
+        self.retry = Backoff()  # delay before the next attempt after failures
+        self.deadLetters = PointStore(20, nbExtra)  # points rejected as malformed by InfluxDB, kept for inspection
+        self.writer = LineWriter(self.batch.maxBytes, gzip=gzip)  # reusable buffer for the body of the write_api calls
+        self.bytesSent = 0  # bytes of the batches accepted by InfluxDB
+        self.sendMs = 0  # time spent in the write_api calls of these batches, without the failed ones nor the backoff
         self.tz = tz
+        self.nbExtra, self.rows = nbExtra, rows
+        if not timebase.synced:
+            timebase.fromRTC(tz)  # the RTC was set to local time
 
     def mapping(self, e):
         """
-        the map function transforms a Point as dict to a string for POSTing to InfluxDb
-        i.e. the e dictionary to the line protocol string expected by influxDb:
+        the map function transforms a Point read from the queue to a string, e.g. for debugging
+        (push_slice serializes with the LineWriter instead)
+        i.e. the e tuple (timestamp, logType, sensorId, message, rawValue, calcValue[, extraFields, extraValues])
+        to the line protocol string expected by influxDb:
         28:cd:c1:07:e5:d5,sensorId=ACD2 logType="DATA",message="moisture",rawValue=46331.0,calcValue=29.0 1679738601965652859
         """
-        return f"""{e["systemId"]},sensorId={e["sensorId"]} \
-logType="{e["logType"]}",\
-message="{e["message"]}",\
-rawValue={e["rawValue"]},\
-calcValue={e["calcValue"]} \
-{e["timestamp"]}"""
+        timestamp, logType, sensorId, message, rawValue, calcValue = e[:6]
+        timestamp = timebase.utcNs(timestamp)
+        names, values = (e[6], e[7]) if len(e) > 6 else ((), ())
+        first = len(names) - len(values)  # 2 for a wide row: the names of rawValue and calcValue
+        rawName, calcName = (names[0], names[1]) if first else ("rawValue", "calcValue")
+        extra = "".join(f",{key}={value}" for key, value in zip(names[first:], values))
+        return f"""{self.systemId},sensorId={sensorId} \
+logType="{logType}",\
+message="{message}",\
+{rawName}={rawValue},\
+{calcName}={calcValue}{extra} \
+{timestamp}"""
         
 
-    def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None):
+    def makePoint(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
+        """
+        Point timestamped now, as queued by add()
+        extraFields/extraValues: optional tuples of names and numbers of additional fields, up to nbExtra
+        """
+        point = (timebase.now(),  # converted to UTC at the upload
+                 logType, sensorId, message,
+                 float(rawValue), float(calcValue if calcValue is not None else rawValue))
+        if extraFields:
+            point += (extraFields, extraValues)
+        return point
+
+    def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
         """
         Post/insert a new entry in the queue.
-        The queue will hold up to 1000 data points expressed as a dictionary.
-        creation of a local point variable to mask self.point --> prevent issue memory assignment
-        """
-        point = {
-            "systemId": self.point["systemId"],
-            "timestamp": time_ns() + ticks_us() - self.tz * 3_600_000_000_000,
-            "logType": logType,
-            "sensorId": sensorId,
-            "message": message,
-            "rawValue": float(rawValue),
-            "calcValue": float(calcValue if calcValue is not None else rawValue)
-        }
+        The queue will hold up to 500 data points packed as fixed-width records.
+        extraFields/extraValues: optional tuples of names and numbers of additional fields, up to nbExtra
+        """
+        point = self.makePoint(logType, sensorId, message, rawValue, calcValue, extraFields, extraValues)
         self.logEntries.append(point)   # .enqueue(point)
-        # print("Point timestamp:", point["timestamp"])  # for debugging, can be commented out later
         print("point=", point, "Q length:", len(self.logEntries)) # for debugging, can be commented out later
 
 
+    def makeRow(self, logType, rowId, message, readings):
+        """
+        Points of a sampling round, all with the same timestamp, as queued by addRow()
+        readings: (sensorId, message, rawValue, calcValue[, extraFields, extraValues]) per sensor
+        rows=False: one point per sensor ; rows=True: wide rows of calcValues, the extra fields are not kept
+        """
+        timestamp = timebase.now()
+        if not self.rows:
+            return [(timestamp, logType, r[0], r[1], float(r[2]), float(r[3] if r[3] is not None else r[2])) +
+                    (tuple(r[4:6]) if len(r) > 4 and r[4] else ()) for r in readings]
+        points, width = [], self.nbExtra + 2
+        for start in range(0, len(readings), width):
+            chunk = readings[start:start + width]
+            values = [float(r[3] if r[3] is not None else r[2]) for r in chunk]
+            if len(chunk) == 1:  # a row needs 2 fields: a single sensor is a plain point
+                points.append((timestamp, logType, chunk[0][0], chunk[0][1], float(chunk[0][2]), values[0]))
+            else:
+                points.append((timestamp, logType, rowId, message, values[0], values[1],
+                               tuple(r[0] for r in chunk), tuple(values[2:])))
+        return points
+
+    def addRow(self, logType, rowId, message, readings):
+        """
+        Post the readings of a sampling round: one point per sensor, or wide rows if rows=True
+        rowId: sensorId of the wide rows, e.g. "moisture" ; message: their message
+        readings: (sensorId, message, rawValue, calcValue[, extraFields, extraValues]) per sensor
+        """
+        for point in self.makeRow(logType, rowId, message, readings):
+            self.logEntries.append(point)
+        print("row=", rowId, len(readings), "readings, Q length:", len(self.logEntries))
+
     def push_slice(self, bucket, slice_size=None):
-        """Send 'slice_size' points to database"""
-        slice_size = slice_size or len(self.logEntries)  # replace None by the current Q length
-        data = []       # buffer for all converted points to send to influxDb with write_api
-        safeguard = []  # keep the dequeued points to repost them if the API call fails
-        for pt in range(slice_size):
-            point = self.logEntries.popleft()  #  .dequeue()
-            safeguard.append(point)
-            data.append(self.mapping(point))
-            print(f"Data point {len(self.logEntries)}: {self.mapping(point)}")
+        """
+        Send the 'slice_size' oldest points to database
+        Points are serialized from the queue straight into the reusable buffer of the LineWriter
+        and only removed from the queue once accepted by InfluxDB
+        """
+        slice_size = min(slice_size or len(self.logEntries), len(self.logEntries))  # replace None by the current Q length
+        writer = self.writer
+        writer.reset()
+        writer.limit = self.batch.maxBytes
+        nbPoints = 0
+        while nbPoints < slice_size and nbPoints < len(self.logEntries):
+            point = self.logEntries[nbPoints]
+            if point is None:  # corrupted record of a FlashQueue: dropped once at the head of the queue
+                if nbPoints:
+                    break
+                self.logEntries.drop(1)
+                self.logEntries.dropped += 1
+                continue
+            if not writer.logPoint(self.systemId, point, timebase.utcNs(point[0])):
+                break
+            nbPoints += 1
+        if not nbPoints:  # only corrupted records, all dropped
+            return 204
+        body = writer.view()
+        print(f"{nbPoints} data points, {len(body)} bytes")
         # call InfluxDB API
-        status_code = self.InfluxClient.write_api(bucket=bucket, records=data)
+        start = ticks_ms()
+        status_code = self.InfluxClient.write_api(bucket=bucket, records=body, gzip=writer.gzip)
+        elapsed = ticks_diff(ticks_ms(), start)
+        metrics.observe(WRITE_MS, elapsed)
+        metrics.inc(HTTP_STATUS + min(3, max(0, status_code // 100 - 2)))
         print("API response code:", status_code)
         if status_code >= 300:
             print(f"Error calling {self.InfluxClient.url}/write?db={bucket}")
-            for point in safeguard:
-                self.logEntries.append(point)
+        else:
+            self.logEntries.drop(nbPoints)
+            self.bytesSent += len(body)
+            self.sendMs += elapsed
+            metrics.inc(WRITTEN, nbPoints)
         return status_code
 
     def push(self, bucket=None):
+        """Same as pushing(), blocking during the backoff delays ; return the status code of the last write_api call"""
+        pushing = self.pushing(bucket)
+        try:
+            while True:
+                sleep_ms(next(pushing))
+        except StopIteration as done:
+            return done.value
+
+    def pushing(self, bucket=None):
         """
-        Send log entry points to InfluxDB database
+        Generator sending the log entry points to InfluxDB database: yields the milliseconds to wait before
+        the next attempt, e.g. awaited by a uasyncio task so that the other tasks keep running during the backoff
         - WIFI connection must have been ensured before calling this method
         - abort if the queue is empty or if the connection with socket is not possible
         - if bucket is left to None then the bucket declared in the dbLogs will be used
+        - the size of the batches adapts to the free heap and to the responses of InfluxDB (see BatchPolicy)
+        - failed batches stay at the head of the queue, in order:
+            retryable errors (timeout, 5xx) are attempted again after an exponential backoff with jitter,
+            waiting at most RETRY_WAIT_MS here, otherwise at the next push once self.retry.ready()
+            a 400 batch is split in halves until the malformed point is isolated and moved to self.deadLetters
+        Return the status code of the last write_api call
         """
         if not self.logEntries: # or self.dbLogs.health_api() != 200:
             return
-        # sending points 20 by 20 to avoid overloading the API's body
-        print(len(self.logEntries), "points in Q to send to InfluxDb...")
-        SLICE_SIZE = const(20)
-        for slice in range(len(self.logEntries) // SLICE_SIZE):
-            status_code = self.push_slice(bucket or self.InfluxClient.bucket, SLICE_SIZE)
-            if status_code >= 300:
-                return status_code
-        # push the remaining points below 20
-        status_code = self.push_slice(bucket or self.InfluxClient.bucket)
+        print(len(self.logEntries), "points in Q to send to InfluxDb...", self.batch)
+        status_code, size = self.retry.status, self.batch.points
+        while self.logEntries:
+            wait = self.retry.waitMs()
+            if wait > RETRY_WAIT_MS:
+                print("Retry in", wait, "ms")
+                break
+            if wait:
+                yield wait
+            start = ticks_ms()
+            status_code = self.push_slice(bucket or self.InfluxClient.bucket, size)
+            self.batch.update(status_code, ticks_diff(ticks_ms(), start))
+            outcome = classify(status_code)
+            if outcome == SUCCESS:
+                self.retry.succeeded()
+                size = self.batch.points
+            elif outcome == MALFORMED:
+                if size > 1:
+                    size //= 2  # bisect the batch to find the malformed point
+                else:
+                    print("Dead letter:", self.mapping(self.logEntries[0]))
+                    self.deadLetters.append(self.logEntries[0])
+                    self.logEntries.drop(1)
+                    size = self.batch.points
+            else:
+                print("Retry in", self.retry.failed(status_code), "ms")
+                size = self.batch.points
+                if outcome == REJECTED:
+                    break
         return status_code
 
 
@@ -195,11 +360,9 @@ if __name__ == "__main__":
     setClock(LOCALTZ)
     print(f"2 - gmtime: {gmtime()} <> localtime: {localtime()}  <>  Unix: {time()}")
     
-    # testing the different creation of a proper Unix timestamp at nanosecond level (default for InfluxdDb)
-    print("time_ns:", time_ns())
-    print("ticks_us:", ticks_us())
-    print("time_ns()+ticks_us():", time_ns()+ticks_us())
-    print("time_ns()+ticks_us() to GMT:", time_ns()+ticks_us()-LOCALTZ*3_600_000_000_000)
+    # the points are stamped with monotonic microseconds, converted to a UTC Unix timestamp in nanosecond
+    now = timebase.now()
+    print("monotonic us:", now, "--> UTC ns:", timebase.utcNs(now), timebase)
 
     print("=" * 50)
     idb = uInfluxDBClient()
@@ -6,17 +6,29 @@ Application to monitor the moisture level in the soil of 3 plants.
 - Other sensor: DHT for air temperature and humidity
 """
 from micropython import const
-from machine import Pin, Timer
-from time import sleep, localtime
-# import _thread
+from machine import Pin
+from time import localtime, time
+from utime import ticks_ms, ticks_diff, sleep_ms
+import _thread
 import gc
 
+from events import asyncio, ThreadSafeFlag
 from ntp import setClock
-from uwifi import uWifi
+from uwifi import stats as wifiStats, networks
+from wifimanager import WifiManager
 from display import Display
+from buttons import Buttons
 from sensors import MakerSoilMoisture, DHT
+from oversampling import Oversampler
 from state import State
-from logger import Logger
+from logger import Logger, encodeUtc, decodeUtc
+from aggregator import Aggregator
+from deadband import Deadband
+from flashqueue import FlashQueue
+from powersave import DutyCycle, Snapshot, LIGHT, DEEP
+from handoff import Handoff, Producer
+from telemetry import metrics, heapFree
+from timebase import timebase
 
 # pins and hardware definitions
 onboard_led = Pin("LED", Pin.OUT)
@@ -24,206 +36,358 @@ onboard_led = Pin("LED", Pin.OUT)
 dis = Display(0, 17, 16)
 # the 4 buttons around the screen
 NB_BUTTONS = const(4)
-buttons = [Pin(i, Pin.IN, Pin.PULL_DOWN) for i in range(NB_BUTTONS)]
-lastValues = [-1] * NB_BUTTONS
+buttons = Buttons(range(NB_BUTTONS))
 # the 3 ACDs and DHT11
 acds = (MakerSoilMoisture("ACD0", 26), MakerSoilMoisture("ACD1", 27), MakerSoilMoisture("ACD2", 28))
+acdSampler = Oversampler(acds, nbSamples=16, trim=4)  # the ADCs are noisy: filtered over 16 interleaved samples
 airSensor = DHT("DHT11", 11, 15)
 # buzzer
 buzzer = Pin(12, Pin.OUT)
 
 DAYS = const(('MON', "TUE", "WED", "THU", "FRI", 'SAT', "SUN"))
-wlan = None
+SAMPLING_S = const(5 * 60)  # period of the sensor readings, aggregated by the Aggregator
+UI_TICK_MS = const(500)     # the UI task wakes up on a button press or after this delay
+POWER_MODE = LIGHT          # sleep between the readings: LIGHT keeps the RAM, DEEP restarts from main.py
+IDLE_MS = const(30_000)     # no sleep within this delay after a button press
+NTP_REFRESH_S = const(3600)  # the mapping of the points timestamps to UTC is refreshed by an upload after this delay
+TZ = const(+8)
+# the points go from the sampling to the uploads through a Handoff ring ; with DUAL_CORE, core 1 delivers them
+# while core 0 keeps sampling and running the UI. Off by default: the CYW43 network stack is not thread safe
+# on the rp2 port, in this mode only core 1 uses the Wifi once booted
+DUAL_CORE = False
+CORE1_TICK_MS = const(100)  # core 1 loop: drains the handoff ring and checks the Wifi
+# the readings of a round are queued as rows "moisture" and "air": with ROWS, one wide point per row (one field per
+# sensor, calcValues only), otherwise one point per sensor as the existing dashboards expect
+ROWS = False
+
+# self-telemetry, sent as INFO points with each upload
+HEAP_FREE = metrics.gauge("heap.free")
+QUEUE_DEPTH = metrics.gauge("queue.depth")  # points waiting for an upload
+DROPPED = metrics.gauge("queue.dropped")  # points refused by the full handoff ring since the start
+GC_MS = metrics.histogram("gc.ms", (2, 5, 10, 20, 50))
+JITTER_MS = metrics.histogram("loop.jitterMs", (5, 10, 20, 50, 100, 500))  # lateness of the clock task
+
+
+def wifiUp():
+    onboard_led.on()
+    print("Connected:", wlan.ifconfig(), wifiStats)
+
+
+def wifiDown():
+    log.InfluxClient.close()  # the keep-alive HTTP connection does not survive the Wifi one
+    onboard_led.off()
+
+
+# one connection shared by the boot, the uploads and the Wifi screen ; kept 1 minute after the last use
+wifi = WifiManager(dis, lingerMs=60_000, onConnect=wifiUp, onDisconnect=wifiDown)
+wlan = wifi.wlan
 
 
 def connectWifi():
     """
-    Connection to Wifi
-    Get localtime to the Pico's clock
-    Need to do a full reset on current Wifi to start a fresh connection
+    Connection to Wifi, blocking: before the tasks are started
+    disconnectWifi() when done, the connection is shared with the other users
     """
-    global wlan
-    onboard_led.on()
-    wlan = uWifi(dis)
-    if wlan:
-        print("Connected:", wlan.ifconfig())
-    else:
+    if not wifi.acquireNow():
         print("Failed to connect any Wifi SSIDs")
 
 
 def disconnectWifi():
-    global wlan
-    try:
-        # wlan._wlan.active(False)
-        wlan._wlan.disconnect()
-    except:
-        pass
-    finally:
-        onboard_led.off()
+    wifi.release()
 
 
-connectWifi()
-try:
-    setClock(tz=+8)  # need to better manage timezone, for now, clock is TZ ignorant
-except:
-    pass
 print("my MAC address:", wlan.mac)
-log = Logger(wlan.mac, tz=+8)  # MAC address used a systemId i.e. InfluxDb database
-now = localtime()
-print("Local time:", now)
-disconnectWifi()
+# in DEEP mode, the RAM is lost at each sleep: the points are queued in flash
+# 6 extra fields: the summaries of the Aggregator and the dispersion of the oversampling
+log = Logger(wlan.mac, tz=TZ, nbExtra=6, rows=ROWS,  # MAC address used a systemId i.e. InfluxDb database
+             queue=FlashQueue("points.fq", encode=encodeUtc, decode=decodeUtc) if POWER_MODE == DEEP else None)
+handoff = Handoff(64)  # points produced on core 0, queued by the consumer (upload task or core 1)
+producer = Producer(handoff, log.makePoint, log.makeRow)
+changes = Deadband(producer, absolute=0.5, heartbeatS=3600)  # only queue the summaries which changed, at least once an hour
+readings = Aggregator(changes, windowS=15 * 60)  # one summary point per sensor every 15 minutes, whatever the sampling rate
 
 
-# start a second thread to send data thru Wifi automatically
-def core1_sendData(timer=None):
-    if len(log.logEntries) > 0:
-        print("Core1 thread...")
-        connectWifi()
-        log.push()
-        disconnectWifi()
-        print("Data sent")
-        gc.collect()
+uploadRequest = ThreadSafeFlag()
+uploadRequested = False  # polled by core 1 in DUAL_CORE mode
+uploadStatus = ""  # shown in the footer of the HOME screen
+uploading = False  # from the request to the end of the upload
+forceUpload = False  # manual upload: even on a weak link
+holdWifi = False  # Wifi screen shown: core 1 keeps the connection
+nextSampling = 0   # time() of the next reading of the sensors
 
 
-def goto98(timer):
-    global state
-    state.changeTo(98)
+def collect():
+    """Garbage collection between the uploads, its duration measured"""
+    start = ticks_ms()
+    gc.collect()
+    metrics.observe(GC_MS, ticks_diff(ticks_ms(), start))
 
 
-# second_thread = _thread.start_new_thread(core1_sendData, ())
-# second_thread = Timer(mode=Timer.PERIODIC, period= (10 * 60 + 30) * 1000, callback=goto98)  #core1_sendData)
+def sampleTelemetry():
+    metrics.set(HEAP_FREE, heapFree())
+    metrics.set(QUEUE_DEPTH, len(handoff) + handoff.backlog)
+    metrics.set(DROPPED, handoff.dropped)
 
-def allReleased():
+
+def send(connected):
     """
-        Wait for all the buttons to be released - prevents bounce effect
+    Consumer side: push the queued points on the connection connected, None if it failed
+    Generator yielding the milliseconds of the backoff delays between the attempts, to wait by the caller
     """
-    while sum([b.value() for b in buttons]):
-        sleep(0.05)
+    global uploadStatus
+    fill = len(log.logEntries) / log.logEntries.maxlen
+    if connected and not forceUpload and not networks.flushNow(wlan.ssid, wlan.rssi, fill):
+        uploadStatus = "Weak"  # weak link: the next scheduled upload may do better
+    elif connected:
+        uploadStatus = "Send"
+        sent, sendMs = log.bytesSent, log.sendMs
+        http_code = yield from log.pushing()
+        if http_code < 300:  # throughput of the accepted batches only, the backoff delays excluded
+            networks.uploaded(wlan.ssid, log.bytesSent - sent, log.sendMs - sendMs)
+            networks.save()
+        uploadStatus = "Fail" if http_code >= 300 else ""
+        if not timebase.synced or timebase.syncAgeS() >= NTP_REFRESH_S:
+            setClock(tz=TZ)  # the drift of the ticks is measured from one sync to the next
+    else:
+        uploadStatus = "NoNet"
 
 
-buttonPressed = None
+async def upload():
+    """Task sending the queued points to InfluxDb when requested (state 98), single core mode"""
+    global uploadStatus, uploading, uploadRequested
+    while True:
+        await uploadRequest.wait()
+        uploadRequested = False
+        handoff.drainInto(log.logEntries)
+        if len(log.logEntries) > 0 and log.retry.ready():  # no Wifi while backing off after failures
+            uploadStatus = "Wifi"
+            async with wifi as connected:
+                for waitMs in send(connected):
+                    await asyncio.sleep(waitMs / 1000)  # the UI and the sampling keep running
+            collect()
+        handoff.backlog = len(log.logEntries)
+        uploading = False
 
 
-def getButtons():
+def core1_sendData():
     """
-    Check all 4 buttons and set the global variable if a button is pressed
+    Consumer loop of core 1 in DUAL_CORE mode: owns the Logger queue and the Wifi,
+    its blocking connections and uploads do not stop the sampling and the UI on core 0
     """
-    global lastValues, buttonPressed
-    for i, button in enumerate(buttons):
-        btn = button.value()
-        if btn != lastValues[i]:
-            lastValues[i] = btn
-            if btn:
-                buttonPressed = i + 1  # button 1 to 4
-                print("Pressed on", buttonPressed)
+    global uploadStatus, uploading, uploadRequested
+    holding = False
+    while True:
+        handoff.drainInto(log.logEntries)
+        if holdWifi != holding:
+            holding = holdWifi
+            if holding:
+                wifi.acquireNow()
             else:
-                print("Button", buttonPressed, "released")
-                buttonPressed = None
+                wifi.release()
+        if uploadRequested:
+            uploadRequested = False
+            if len(log.logEntries) > 0 and log.retry.ready():
+                uploadStatus = "Wifi"
+                connected = wifi.acquireNow()
+                try:
+                    for waitMs in send(connected):
+                        sleep_ms(waitMs)
+                finally:
+                    wifi.release()
+                collect()
+            uploading = False
+        handoff.backlog = len(log.logEntries)
+        sleep_ms(min(wifi.check(), CORE1_TICK_MS))
+
+
+def goto98(timer):
+    global state
+    state.post(98)
+
+
+# second_thread = Timer(mode=Timer.PERIODIC, period= (10 * 60 + 30) * 1000, callback=goto98)
+
+
+async def sampling():
+    """Task reading all the sensors every SAMPLING_S seconds"""
+    global nextSampling
+    while True:
+        nextSampling = time() + SAMPLING_S
+        acdSampler.read()
+        readings.addRow("DATA", "moisture", "moisture", acdSampler.readings("moisture"))
+        if airSensor.read():  # not the previous values again after a failed measure
+            readings.addRow("DATA", "air", "air", [(airSensor.DHTT.id, "temperature", airSensor.temperature, None),
+                                                  (airSensor.DHTH.id, "humidity", airSensor.humidity, None)])
+        sampleTelemetry()
+        timebase.now()  # at least once per wrap around of the ticks, even if no point was queued
+        await asyncio.sleep(SAMPLING_S)
+
+
+def homeScreen():
+    now = localtime()
+    dis.requestScreen(f""" {now[0]}-{now[1]:02}-{now[2]:02} {DAYS[now[6]]}
+ {now[3]}:{now[4]:02}:{now[5]:02}
+ Connected to
+ {wlan.ssid if wifi.connected else "None"}""", footer=f"{len(handoff) + handoff.backlog} {uploadStatus}",
+               button1="Wifi", button2="ACD", button3="Buzz", button4="DHT")
+
+
+async def clock():
+    """Task refreshing the time on the HOME screen every second while waiting for a button"""
+    while True:
+        if state.currentState == 0:
+            homeScreen()
+        start, cycles = ticks_ms(), dutyCycle.cycles
+        await asyncio.sleep(1)
+        if dutyCycle.cycles == cycles:  # a sleep of the board in between is not jitter
+            metrics.observe(JITTER_MS, ticks_diff(ticks_ms(), start) - 1000)
 
 
 state = State(99)  # 99 to display HOME screen as default screen
-refresh = 0
-while True:
-    sleep(0.1)
-    getButtons()
-    # Automation based on states
-    if state.currentState == 0:
-        # default waiting state: act on a pressed button to change state
-        if buttonPressed:
-            state.changeTo(buttonPressed)
-        else:
-            if refresh >= 5:
-                state.changeTo(99)  # once in a while, refresh the screen for time display
-                refresh = 0
-            else:
-                refresh += 1
 
-    # Action for button 1: look for a WIFI connection
-    elif state.currentState == 1:
-        if state.firstTime:
-            # wlan = uWifi(dis)
-            connectWifi()
-            state.firstTime = False
-        elif buttonPressed:
-            # a button is pressed
-            state.changeTo(98)  # send data if any to InfluxDb
-
-    # Action for button 2: display the readings of all ACDs for moisture
-    elif state.currentState == 2:
-        if state.firstTime:
-            mLines = ""
-            for i, acd in enumerate(acds):
-                moisture = acd.read()
-                mLines += f"""{i}: {moisture}% [{acd.rawValue}]\n"""
-                log.add("DATA", acd.id, "moisture", acd.rawValue, moisture)
-            dis.screen(mLines,
-                       title="Moisture",
-                       button3="Read", button4="HOME")
-            state.firstTime = False
-        elif buttonPressed == 4:  # button4: let's go back to main screen
-            state.changeToDefault()
-        elif buttonPressed == 3:  # press on BTN3 -->  read again
-            state.firstTime = True
-            allReleased()
-
-    # Action for button 3: buzzer - force push all logs to InfluxDb
-    elif state.currentState == 3:
-        if state.firstTime:
-            dis.screen("Press STOP", button3="STOP")
-            buzzer.on()
-            state.firstTime = False
-        elif buttonPressed == 3:  # button3: let's go back to main screen
-            buzzer.off()
-            state.changeTo(98)  # send data if any to InfluxDb
-
-    # Action for button 4: read data from DHT11
-    elif state.currentState == 4:
-        if state.firstTime:
-            now = localtime()
-            try:
-                airSensor.read()
-            except OSError as err:
-                continue
-            temperature = airSensor.DHTT.read()
-            humidity = airSensor.DHTH.read()
-            dis.screen(f"""{now[3]}:{now[4]:02}:{now[5]:02}
+
+def sleeping():
+    timebase.suspend(dutyCycle.plannedMs if POWER_MODE == DEEP else 0)
+    snapshot.save()
+    if not DUAL_CORE:  # in DUAL_CORE mode busy() keeps the board awake until core 1 is done
+        handoff.drainInto(log.logEntries)  # the ring is in RAM, the Logger queue in flash in DEEP mode
+        wifi.disconnect()
+    dis.displayOff()  # switched on again by a button
+
+
+def busy():
+    """
+    The board stays awake while a screen other than HOME is shown, a button was just used,
+    data is sent or the Wifi is used
+    """
+    return state.currentState != 0 or state.pending() or buttons.idleMs() < IDLE_MS or uploading or wifi.refs > 0 \
+        or (DUAL_CORE and (wifi.connected or len(handoff) > 0))
+
+
+dutyCycle = DutyCycle(lambda: min(state.scheduler.nextAt(), nextSampling), busy, sleeping, mode=POWER_MODE)
+# windows in progress, last values queued, next scheduled slots, time base and duty cycle statistics survive
+# a sleep or a power cut
+snapshot = Snapshot("state.json", scheduler=state.scheduler, readings=readings, changes=changes, timebase=timebase,
+                    dutyCycle=dutyCycle)
+woke = snapshot.restore() and timebase.resumed  # restarted by a deep sleep
+if woke:
+    snapshot.save()  # without the mark of the deep sleep: a reset from now on does not resume it
+    buttons.setIdle()  # no press to wait for: the board goes back to sleep once its tasks are done
+else:
+    connectWifi()
+    try:
+        setClock(tz=TZ)  # need to better manage timezone, for now, clock is TZ ignorant
+    except:
+        pass
+    disconnectWifi()
+print("Local time:", localtime())
+
+
+# Action for button 1: look for a WIFI connection, any button then sends the data if any to InfluxDb
+def wifiEnter():
+    global holdWifi
+    if DUAL_CORE:
+        holdWifi = True  # core 1 connects
+    else:
+        asyncio.create_task(wifi.acquire())  # released when leaving the screen
+
+
+def wifiExit():
+    global holdWifi
+    if DUAL_CORE:
+        holdWifi = False
+    else:
+        wifi.release()
+
+
+# Action for button 2: display the readings of all ACDs for moisture
+def moistureEnter():
+    mLines = ""
+    acdSampler.read()
+    for i, acd in enumerate(acds):
+        moisture = acd.calcValue
+        mLines += f"""{i}: {moisture}% [{acd.rawValue}]\n"""
+    readings.addRow("DATA", "moisture", "moisture", acdSampler.readings("moisture"))
+    dis.requestScreen(mLines,
+               title="Moisture",
+               button3="Read", button4="HOME")
+
+
+# Action for button 3: buzzer - force push all logs to InfluxDb
+def buzzerEnter():
+    dis.requestScreen("Press STOP", button3="STOP")
+    buzzer.on()
+
+
+# Action for button 4: read data from DHT11
+def dhtEnter():
+    now = localtime()
+    if not airSensor.read():
+        dis.requestScreen(f"DHT error\n{airSensor.error}", button3="Read", button4="Home")
+        return
+    temperature = airSensor.DHTT.read()
+    humidity = airSensor.DHTH.read()
+    dis.requestScreen(f"""{now[3]}:{now[4]:02}:{now[5]:02}
 Temp: {temperature}C
 Humidity: {humidity}%""", button3="Read", button4="Home")
-            log.add("DATA", airSensor.DHTT.id, "temperature", temperature)
-            log.add("DATA", airSensor.DHTH.id, "humidity", humidity)
-            state.firstTime = False
-        elif buttonPressed == 4:  # button4: let's go back to main screen
-            state.changeToDefault()
-        elif buttonPressed == 3:  # press on BTN3 -->  read again
-            state.firstTime = True
-            allReleased()
-
-    # request to send data to InfluxDb
-    elif state.currentState == 98:
-        if len(log.logEntries) > 0:
-            if not wlan:
-                connectWifi()
-            if wlan:
-                dis.screen(f"Sending {len(log.logEntries)} pts")
-                http_code = log.push()
-                if http_code >= 300:
-                    dis.screen(f"""Failed to send.\nEnQ {len(log.logEntries)} pts""")
-                    sleep(3)
-            else:
-                dis.screen(f"""No internet\n{len(log.logEntries)} pts in Q""")
-                sleep(2)
-            disconnectWifi()
-            gc.collect()
-        state.changeToDefault()
-
-    # default action
-    elif state.currentState == 99:  # display the HOME screen and go to waiting a press (state = 0)
-        now = localtime()
-        dis.screen(f""" {now[0]}-{now[1]:02}-{now[2]:02} {DAYS[now[6]]}
- {now[3]}:{now[4]:02}:{now[5]:02}
- Connected to
- {wlan.ssid or "None"}""", footer=f"{len(log.logEntries)}",
-                   button1="Wifi", button2="ACD", button3="Buzz", button4="DHT")
-        #         if wlan: log.push()
-        state.changeTo(0)
-        allReleased()
+    readings.addRow("DATA", "air", "air", [(airSensor.DHTT.id, "temperature", temperature, None),
+                                          (airSensor.DHTH.id, "humidity", humidity, None)])
+
+
+# request to send data to InfluxDb: done by the upload task
+def uploadEnter():
+    global uploading, forceUpload, uploadRequested
+    readings.flush()  # summaries of the windows already over, produced on core 0
+    sampleTelemetry()
+    metrics.flush(producer)  # the metrics since the previous upload
+    uploading = True
+    forceUpload = state.lastState in (1, 3)  # requested with a button, not by the SCHEDULER
+    uploadRequested = True
+    uploadRequest.set()
+    state.changeToDefault()
+
+
+# default action: display the HOME screen and go to waiting a press (state = 0)
+def homeEnter():
+    homeScreen()
+    state.changeTo(0)
+
+
+# the buttons are the events ; a transition to the current state runs its entry action again (Read)
+state.on(0, events={1: 1, 2: 2, 3: 3, 4: 4})
+state.on(1, enter=wifiEnter, exit=wifiExit, events={1: 98, 2: 98, 3: 98, 4: 98})
+state.on(2, enter=moistureEnter, events={3: 2, 4: 99})
+state.on(3, enter=buzzerEnter, exit=buzzer.off, events={3: 98})
+state.on(4, enter=dhtEnter, events={3: 4, 4: 99})
+state.on(98, enter=uploadEnter)
+state.on(99, enter=homeEnter)
+
+
+async def ui():
+    """Task running the screens: wakes up on a button press, a change of state or every UI_TICK_MS"""
+    while True:
+        if state.firstTime:
+            await asyncio.sleep(0)  # entry action of a new state: only let the other tasks run
+            state.step()
+        else:
+            buttonPressed = await buttons.next(UI_TICK_MS)
+            if buttonPressed and dis.displayOn():
+                continue  # the press only switched the display on
+            state.step(buttonPressed)
+
+
+async def main():
+    asyncio.create_task(dis.run())
+    if DUAL_CORE:
+        _thread.start_new_thread(core1_sendData, ())
+    else:
+        asyncio.create_task(wifi.run())
+        asyncio.create_task(upload())
+    asyncio.create_task(sampling())
+    asyncio.create_task(clock())
+    asyncio.create_task(state.scheduler.run(state.post))  # SCHEDULER: upload every 10 minutes
+    asyncio.create_task(dutyCycle.run())
+    await ui()
+
+
+asyncio.run(main())
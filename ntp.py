@@ -1,44 +1,78 @@
 """
 NTP utility to set date and time from Internet
 Connection to network is not covered here
+
+setClock() sends up to `retries` requests and keeps the exchange with the shortest round trip:
+the RTC is set to local time from it, and the time base of the points (timebase) is synced with
+its 4 timestamps, the round trip being compensated
 """
 from micropython import const
 import socket
 import struct
 from machine import Pin, RTC
 from time import gmtime
+from utime import sleep_ms
+from timebase import timebase
 
 NTP_DELTA = const(2208988800)
 NTP_HOST = const("pool.ntp.org")
+RETRY_MS = const(200)  # between 2 requests
 
 
-def setClock(tz=0):
-    """
-    Set pi pico clock using NTP
-    :return:
-    """
-    led = Pin("LED", Pin.OUT)
-    led.on()
-    NTP_QUERY = bytearray(48)
-    NTP_QUERY[0] = 0x1B
-    addr = socket.getaddrinfo(NTP_HOST, 123)[0][-1]
+def _utcUs(packet, offset):
+    """NTP timestamp (seconds since 1900, 32 bits fraction) at offset of packet --> Unix time in us"""
+    seconds, fraction = struct.unpack_from("!II", packet, offset)
+    return (seconds - NTP_DELTA) * 1_000_000 + (fraction * 1_000_000 >> 32)
+
+
+def exchange(addr, timeoutS=1):
+    """One request: (t1, t2, t3, t4) for timebase.sync(), None without answer"""
+    query = bytearray(48)
+    query[0] = 0x1B  # version 3, client
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        s.settimeout(1)
-        res = s.sendto(NTP_QUERY, addr)
+        s.settimeout(timeoutS)
+        t1 = timebase.peek()
+        s.sendto(query, addr)
         msg = s.recv(48)
-    except:
-        print("No response received from", NTP_HOST)
+        t4 = timebase.peek()
+    except OSError:
+        return None
     finally:
         s.close()
+    if len(msg) < 48 or msg[1] == 0:  # stratum 0: kiss-o'-death, no time
+        return None
+    return t1, _utcUs(msg, 32), _utcUs(msg, 40), t4
+
+
+def setClock(tz=0, retries=3, timeoutS=1, host=NTP_HOST):
+    """
+    Set pi pico clock using NTP
+    Return True if a server answered
+    """
+    led = Pin("LED", Pin.OUT)
+    led.on()
+    best = None
     try:
-        val = struct.unpack("!I", msg[40:44])[0]
-        tm = gmtime(val - NTP_DELTA + tz*3600)
-        RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
-        print("In NTP:", tm, "with tz=", tz)
-    except:
-        print("Error")
+        addr = socket.getaddrinfo(host, 123)[0][-1]
+        for attempt in range(retries):
+            sample = exchange(addr, timeoutS)
+            if sample and (best is None or sample[3] - sample[0] < best[3] - best[0]):
+                best = sample
+            elif not sample:
+                sleep_ms(RETRY_MS)
+    except OSError as err:
+        print("NTP error:", err)
     led.off()
+    if best is None:
+        print("No response received from", host)
+        return False
+    timebase.sync(*best)
+    tm = gmtime(timebase.utcUs(timebase.peek()) // 1_000_000 + tz * 3600)
+    RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+    print("In NTP:", tm, "with tz=", tz, timebase)
+    return True
+
 
 if __name__ == "__main__":
     from uwifi import uWifi
@@ -47,4 +81,3 @@ if __name__ == "__main__":
     print(f"1 - gmtime: {gmtime()} <> localtime: {localtime()}  <>  Unix: {time()}")
     setClock()
     print(f"2 - gmtime: {gmtime()} <> localtime: {localtime()}  <>  Unix: {time()}")
-    
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Oversampling of the noisy RP2040 ADCs
+
+- sample(): nbSamples reads per sensor, interleaving the sensors so that all of them see the same
+  conditions, into a preallocated array('H') ; then, per sensor, an in-place insertion sort of its
+  samples, one pass for the trimmed mean, min and max and one over the kept samples for their squared
+  deviations from the trimmed mean
+  Only integer operations on preallocated arrays: bounded time, nothing allocated,
+  hence it can be called from a Timer callback
+- update(): copies the results to the sensors (rawValue, calcValue, minValue, maxValue, stddev)
+  computes floats, so to be called from the main loop
+- read(): sample() + update()
+- readings(): the sensors as readings for Logger.addRow, with min, max and stddev as extra fields
+
+The sensors are any objects with an _adc offering read_u16(), like sensors.MakerSoilMoisture
+"""
+from micropython import const
+from array import array
+from math import sqrt
+
+DISPERSION_FIELDS = const(("rawMin", "rawMax", "rawStddev"))  # extra fields of readings()
+
+
+class Oversampler:
+    def __init__(self, sensors, nbSamples=16, trim=4):
+        """
+        :param sensors: sensors read together, e.g. the 3 ACDs
+        :param nbSamples: number of samples per sensor and per reading
+        :param trim: number of lowest and of highest samples ignored by the trimmed mean
+        """
+        if 2 * trim >= nbSamples:
+            raise ValueError("trim too large for nbSamples")
+        self.sensors = sensors
+        self.nbSamples, self.trim = nbSamples, trim
+        nb = len(sensors)
+        self.samples = array('H', [0] * (nb * nbSamples))  # samples of sensor c in [c * nbSamples, (c + 1) * nbSamples)
+        self.mean = array('H', [0] * nb)     # trimmed mean
+        self.median = array('H', [0] * nb)
+        self.min = array('H', [0] * nb)
+        self.max = array('H', [0] * nb)
+        self.sumSq = array('I', [0] * nb)    # squared deviations of the kept samples from the trimmed mean, 1/8 read_u16 units
+
+    def sample(self):
+        """Read and reduce all the samples ; allocation free"""
+        samples, sensors, n = self.samples, self.sensors, self.nbSamples
+        nb = len(sensors)
+        for k in range(n):
+            for c in range(nb):  # interleaved: sensor 0, 1, 2, 0, 1, 2...
+                samples[c * n + k] = sensors[c]._adc.read_u16()
+        for c in range(nb):
+            self._reduce(c)
+
+    def _reduce(self, c):
+        samples, n, trim = self.samples, self.nbSamples, self.trim
+        first = c * n
+        # insertion sort of the samples of sensor c: at most n * n / 2 moves
+        for i in range(first + 1, first + n):
+            value = samples[i]
+            j = i - 1
+            while j >= first and samples[j] > value:
+                samples[j + 1] = samples[j]
+                j -= 1
+            samples[j + 1] = value
+        # trimmed mean, then the dispersion of the same kept samples around it
+        total = totalSq = 0
+        for i in range(first + trim, first + n - trim):
+            total += samples[i]
+        mean = total // (n - 2 * trim)
+        for i in range(first + trim, first + n - trim):
+            deviation = (samples[i] - mean) >> 3  # half a step of the 12 bits ADC keeps the squares as small ints
+            totalSq += deviation * deviation
+        self.mean[c] = mean
+        self.median[c] = samples[first + n // 2]
+        self.min[c], self.max[c] = samples[first], samples[first + n - 1]
+        self.sumSq[c] = totalSq
+
+    def update(self):
+        """Copy the last reduced values into the sensors: rawValue is the trimmed mean"""
+        for c, sensor in enumerate(self.sensors):
+            sensor.rawValue = self.mean[c]
+            sensor.calcValue = sensor.calculate()
+            sensor.minValue, sensor.maxValue = self.min[c], self.max[c]
+            sensor.stddev = self.stddev(c)
+
+    def stddev(self, c):
+        """Standard deviation of the samples of sensor c kept by the trimmed mean, in read_u16 units"""
+        return sqrt(self.sumSq[c] / (self.nbSamples - 2 * self.trim)) * 8
+
+    def read(self):
+        self.sample()
+        self.update()
+
+    def readings(self, message):
+        """(sensorId, message, rawValue, calcValue, extraFields, extraValues) per sensor, e.g. for Logger.addRow"""
+        return [(s.id, message, s.rawValue, s.calcValue, DISPERSION_FIELDS, (s.minValue, s.maxValue, s.stddev))
+                for s in self.sensors]
+
+
+if __name__ == "__main__":
+    # on CPython, with fake ADCs producing a noisy level with a few spikes
+    import random
+    import statistics
+
+    class FakeADC:
+        def __init__(self, level, noise):
+            self.level, self.noise = level, noise
+
+        def read_u16(self):
+            if random.random() < 0.05:
+                return random.choice((0, 65535))  # spike
+            return max(0, min(65535, int(random.gauss(self.level, self.noise)))) & 0xFFF0
+
+    class FakeSensor:
+        def __init__(self, id, level):
+            self.id, self._adc = id, FakeADC(level, 600)
+
+        def calculate(self):
+            return min(100.0, max(0.0, (45675.9 - self.rawValue) * 100.0 / (45675.9 - 27803.7)))
+
+    sensors = [FakeSensor(f"ACD{i}", level) for i, level in enumerate((30000, 38000, 44000))]
+    sampler = Oversampler(sensors, nbSamples=16, trim=4)
+    sampler.read()
+    for c, s in enumerate(sensors):
+        kept = sampler.samples[c * 16 + 4:(c + 1) * 16 - 4]
+        expected = statistics.pstdev(kept)
+        print(f"{s.id}: level {s._adc.level} trimmed mean {s.rawValue} median {sampler.median[c]} "
+              f"min {s.minValue} max {s.maxValue} stddev {s.stddev:.0f} "
+              f"(brute force {expected:.0f}) moisture {s.calcValue:.1f}%")
+        assert abs(s.stddev - expected) <= 16  # the integer mean and deviations are within an ADC step
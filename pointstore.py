@@ -0,0 +1,170 @@
+"""
+Compact in-RAM storage of the Logger pending points
+
+Every point is a fixed-width packed record in one preallocated bytearray used as a ring:
+    timestamp (8 bytes) | logType id | sensorId id | message id | fields id | rawValue (8 bytes) | calcValue (8 bytes)
+    followed by nbExtra values (8 bytes each) for the points carrying extra fields
+logType, sensorId and message are interned into small integer ids: each distinct string is stored once.
+So are the tuples of extra field names: fields id 0 means no extra field.
+A wide row (see Logger.makeRow) has 2 names more than values: they name rawValue and calcValue.
+The systemId shared by all the points is not stored per point: the Logger holds it.
+
+Operation Runtimes:
+- append: O(1) - no allocation except the interned strings seen for the first time
+- [i]: O(1) - returns a (timestamp, logType, sensorId, message, rawValue, calcValue) tuple
+              or (timestamp, logType, sensorId, message, rawValue, calcValue, extraFields, extraValues)
+- drop: O(1)
+- len: O(1)
+"""
+from micropython import const
+import struct
+
+HEADER_FMT = const("<qBBBB")
+RECORD_SIZE = const(28)  # record without extra values
+MAX_STRINGS = const(256)  # an id is stored on 1 byte
+
+
+class PointStore:
+    """
+    deque-like ring of packed points ; when full, the oldest point is dropped like deque((), maxlen)
+    nbExtra: number of extra values a point can carry on top of rawValue and calcValue
+    """
+    def __init__(self, maxlen=500, nbExtra=0):
+        self.maxlen, self.nbExtra = maxlen, nbExtra
+        self._format = HEADER_FMT + "d" * (2 + nbExtra)
+        self._size = RECORD_SIZE + 8 * nbExtra
+        self._buffer = bytearray(maxlen * self._size)
+        self._padding = (0.0,) * nbExtra
+        self._strings = []  # id --> str
+        self._ids = {}      # str --> id
+        self._fields = [()]  # id --> tuple of extra field names
+        self._nbValues = [0]  # id --> number of extra values, 2 less than the names for a wide row
+        self.head, self.count = 0, 0
+        self.dropped = 0    # number of points lost because the store was full
+
+    def intern(self, s):
+        """Return the id of the string s, registering it if seen for the first time"""
+        idx = self._ids.get(s)
+        if idx is None:
+            if len(self._strings) >= MAX_STRINGS:
+                raise ValueError("too many distinct strings")
+            idx = self._ids[s] = len(self._strings)
+            self._strings.append(s)
+        return idx
+
+    def _internFields(self, fields, nbValues):
+        """Return the id of a tuple of extra field names carrying nbValues values"""
+        for idx, known in enumerate(self._fields):
+            if known == fields and self._nbValues[idx] == nbValues:
+                return idx
+        if len(self._fields) >= MAX_STRINGS:
+            raise ValueError("too many distinct extra fields")
+        self._fields.append(tuple(fields))
+        self._nbValues.append(nbValues)
+        return len(self._fields) - 1
+
+    def append(self, point):
+        """
+        point: (timestamp, logType, sensorId, message, rawValue, calcValue)
+           or  (timestamp, logType, sensorId, message, rawValue, calcValue, extraFields, extraValues)
+        """
+        timestamp, logType, sensorId, message, rawValue, calcValue = point if len(point) == 6 else point[:6]
+        if len(point) > 6 and point[6]:
+            extraFields, extraValues = point[6], point[7]
+            if len(extraValues) > self.nbExtra:
+                raise ValueError("too many extra values")
+            fields = self._internFields(extraFields, len(extraValues))
+            extraValues = tuple(extraValues) + self._padding[len(extraValues):]
+        else:
+            fields, extraValues = 0, self._padding
+        if self.count == self.maxlen:  # full: overwrite the oldest point
+            self.head = (self.head + 1) % self.maxlen
+            self.count -= 1
+            self.dropped += 1
+        struct.pack_into(self._format, self._buffer, ((self.head + self.count) % self.maxlen) * self._size,
+                         timestamp, self.intern(logType), self.intern(sensorId), self.intern(message), fields,
+                         rawValue, calcValue, *extraValues)
+        self.count += 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("index out of range")
+        record = struct.unpack_from(self._format, self._buffer, ((self.head + i) % self.maxlen) * self._size)
+        strings = self._strings
+        timestamp, logType, sensorId, message, fields, rawValue, calcValue = record[:7]
+        if fields:
+            extraFields = self._fields[fields]
+            return (timestamp, strings[logType], strings[sensorId], strings[message], rawValue, calcValue,
+                    extraFields, record[7:7 + self._nbValues[fields]])
+        return timestamp, strings[logType], strings[sensorId], strings[message], rawValue, calcValue
+
+    def popleft(self):
+        point = self[0]
+        self.drop(1)
+        return point
+
+    def drop(self, n):
+        """Remove the n oldest points"""
+        n = min(n, self.count)
+        self.head = (self.head + n) % self.maxlen
+        self.count -= n
+
+    def clear(self):
+        self.drop(self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+
+def bench_memory(nbPoints=500):
+    """
+    Bytes per queued point: packed PointStore against the former deque of dictionaries
+    Returns a dictionary {storage name: bytes per point}
+    """
+    from collections import deque
+    from benchutils import memoryUsed
+    sensors = ("ACD0", "ACD1", "ACD2", "DHT11_T", "DHT11_H")
+    messages = ("moisture", "moisture", "moisture", "temperature", "humidity")
+
+    def dictQueue():
+        q = deque((), nbPoints)
+        for i in range(nbPoints):
+            q.append({
+                "systemId": "28:cd:c1:07:e5:d5",
+                "timestamp": 1679738601965652859 + i * 1_000_000_000,
+                "logType": "DATA",
+                "sensorId": sensors[i % 5],
+                "message": messages[i % 5],
+                "rawValue": float(40000 + i),
+                "calcValue": float(i % 100)
+            })
+        return q
+
+    def packedStore():
+        q = PointStore(nbPoints)
+        for i in range(nbPoints):
+            q.append((1679738601965652859 + i * 1_000_000_000, "DATA", sensors[i % 5], messages[i % 5],
+                      float(40000 + i), float(i % 100)))
+        return q
+
+    results = {}
+    for name, build in (("dict deque", dictQueue), ("PointStore", packedStore)):
+        q, used = memoryUsed(build)
+        results[name] = used / nbPoints
+        del q
+    return results
+
+
+if __name__ == "__main__":
+    store = PointStore(3)
+    for i in range(5):
+        store.append((1679738601965652859 + i, "DATA", f"ACD{i % 3}", "moisture", 40000.0 + i, 29.0))
+    print(len(store), "points, dropped:", store.dropped, "first:", store[0])
+    store.drop(2)
+    print("after drop:", len(store), store.popleft())
+
+    for name, perPoint in bench_memory().items():
+        print(f"{name:>12}: {perPoint:.1f} bytes per queued point")
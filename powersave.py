@@ -0,0 +1,159 @@
+"""
+Duty cycling: sleep between the scheduled tasks instead of idling awake
+
+Once the UI is idle, DutyCycle computes the time left before the next deadline (scheduled state, sampling...)
+and sleeps until then if it is worth it:
+- LIGHT: machine.lightsleep, RAM kept ; returns at the deadline or on a GPIO interrupt (button)
+- DEEP: machine.deepsleep, the board restarts from main.py at the deadline: all the state needed
+  has to be restored from flash (Snapshot below, FlashQueue for the points)
+Before sleeping, onSleep() persists the state and switches off what can be.
+The awake and asleep times of the last cycles are recorded to compare duty cycles: report().
+"""
+from micropython import const
+from array import array
+from time import time
+from utime import ticks_ms, ticks_diff
+import json
+import os
+from events import asyncio
+
+LIGHT = const(0)
+DEEP = const(1)
+
+
+class Snapshot:
+    """
+    State of several objects saved together to a json file, each object offering dump() and load(data)
+    e.g. Snapshot("state.json", scheduler=state.scheduler, readings=readings)
+    """
+    def __init__(self, path, **parts):
+        self.path, self.parts = path, parts
+
+    def save(self):
+        data = {name: part.dump() for name, part in self.parts.items()}
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.rename(self.path + ".tmp", self.path)  # the previous snapshot stays valid until the new one is complete
+
+    def restore(self):
+        """Load the parts from the last snapshot ; False if there is none"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        for name, part in self.parts.items():
+            if name in data:
+                part.load(data[name])
+        return True
+
+
+class DutyCycle:
+    """
+    nextAt: function returning the time in seconds of the next deadline
+    busy: function returning True while the board must stay awake (UI in use, upload running...)
+    onSleep, onWake: called before sleeping and after waking up from a light sleep
+    minSleepS: shorter sleeps are not worth it
+    clock: function returning the current time in seconds, ticks: function returning milliseconds ticks
+    sleep: function(ms) replacing the machine one ; clock, ticks and sleep are injectable for testing
+    """
+    def __init__(self, nextAt, busy=None, onSleep=None, onWake=None, mode=LIGHT, minSleepS=10,
+                 nbCycles=48, clock=time, ticks=ticks_ms, sleep=None):
+        self.nextAt, self.busy, self.onSleep, self.onWake = nextAt, busy, onSleep, onWake
+        self.mode, self.minSleepS, self.clock, self.ticks = mode, minSleepS, clock, ticks
+        if sleep is None:
+            from machine import lightsleep, deepsleep
+            sleep = deepsleep if mode == DEEP else lightsleep
+        self.sleep = sleep
+        self.awakeMs = array('I', [0] * nbCycles)  # ring of the last cycles
+        self.asleepMs = array('I', [0] * nbCycles)
+        self.cycles = 0
+        self.plannedMs = 0  # of the last sleep
+        self._awakeSince = ticks()  # in DEEP mode: since the restart
+
+    def sleepMs(self):
+        """Milliseconds of sleep possible now, 0 if the board must stay awake"""
+        if self.busy and self.busy():
+            return 0
+        at = self.nextAt()
+        if at is None:
+            return 0
+        left = at - self.clock()
+        return int(left * 1000) if left >= self.minSleepS else 0
+
+    def maybeSleep(self):
+        """Sleep until the next deadline if possible ; return the milliseconds slept"""
+        ms = self.sleepMs()
+        if not ms:
+            return 0
+        i = self.cycles % len(self.awakeMs)
+        self.awakeMs[i] = ticks_diff(self.ticks(), self._awakeSince)
+        self.asleepMs[i] = ms
+        self.cycles += 1
+        self.plannedMs = ms  # for onSleep, e.g. the time to resume after a deep sleep
+        if self.onSleep:
+            self.onSleep()  # persists the statistics too in DEEP mode
+        start = self.ticks()
+        self.sleep(ms)
+        # LIGHT only: woken up at the deadline or earlier by a button
+        self._awakeSince = self.ticks()
+        self.asleepMs[i] = ticks_diff(self._awakeSince, start)
+        if self.onWake:
+            self.onWake()
+        return self.asleepMs[i]
+
+    async def run(self, checkMs=1000):
+        """Task trying to sleep every checkMs, once the other tasks are done"""
+        while True:
+            await asyncio.sleep(checkMs / 1000)
+            self.maybeSleep()
+
+    def dump(self):
+        return [self.cycles, list(self.awakeMs), list(self.asleepMs)]
+
+    def load(self, data):
+        self.cycles = data[0]
+        for i, (awake, asleep) in enumerate(zip(data[1], data[2])):
+            self.awakeMs[i], self.asleepMs[i] = awake, asleep
+
+    def dutyCycle(self):
+        """Share of the time awake over the last cycles"""
+        n = min(self.cycles, len(self.awakeMs))
+        awake, asleep = sum(self.awakeMs[:n]), sum(self.asleepMs[:n])
+        return awake / (awake + asleep) if awake + asleep else 1.0
+
+    def report(self):
+        n = min(self.cycles, len(self.awakeMs))
+        if not n:
+            return "no sleep yet"
+        awake = sorted(self.awakeMs[:n])
+        return (f"{self.cycles} cycles, awake {100 * self.dutyCycle():.1f}% ; awake per cycle (ms): "
+                f"min {awake[0]} median {awake[n // 2]} max {awake[-1]}")
+
+    def __str__(self):
+        return f"DutyCycle({self.report()})"
+
+
+if __name__ == "__main__":
+    # on CPython: a simulated day, readings every 5 minutes and uploads every 10 minutes,
+    # the fake clock moved forward by the work done and by the sleeps
+    from scheduler import Scheduler
+    start = 1_700_000_000
+    now = [float(start)]
+    scheduler = Scheduler({1: "*/5 *", 98: "*/10 *"}, clock=lambda: now[0])
+    snapshot = Snapshot("/tmp/snapshot.json", scheduler=scheduler)
+
+    def fakeSleep(ms):
+        now[0] += ms / 1000
+
+    cycle = DutyCycle(scheduler.nextAt, onSleep=snapshot.save, clock=lambda: now[0],
+                      ticks=lambda: int((now[0] - start) * 1000), sleep=fakeSleep, minSleepS=2)
+    while now[0] < start + 86400:
+        for s in scheduler.due(int(now[0])):
+            now[0] += 0.8 if s == 1 else 4.5  # reading the sensors, uploading
+        if not cycle.maybeSleep():
+            now[0] += 0.1
+    print(cycle)
+    restored = Scheduler({1: "*/5 *", 98: "*/10 *"}, clock=lambda: start)
+    print("snapshot restored:", Snapshot("/tmp/snapshot.json", scheduler=restored).restore(),
+          "same next deadline:", restored.nextAt() == scheduler.nextAt())
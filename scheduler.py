@@ -0,0 +1,193 @@
+"""
+Cron-like scheduler of state changes
+
+Each entry of the schedule is state: spec, the spec being
+- a tuple of minutes, e.g. (9, 19, 29): at these minutes of every hour
+- a cron-like string "minutes hours", each field being *, */n, a, a-b, a-b/n or a list of them separated by ","
+  e.g. "*/10 *" every 10 minutes, "0 7-22/3" at 7:00, 10:00... 22:00
+The minutes of the day matching a spec are computed once (sorted tuple).
+The next fire time of every entry is kept in a min-heap: the scheduler sleeps until the top of the heap,
+finding the next deadline costs O(log n) and nothing is computed while waiting.
+Slots missed while the main loop was blocked (long upload, sleep...) are handled according to a policy:
+- SKIP: the missed slots are forgotten, the entry fires at its next slot
+- ONCE: the entry fires once for all the missed slots
+- ALL: the entry fires once per missed slot
+A deadline more than a day late or ahead is a jump of the clock (RTC set by NTP, cold boot in 2021...), not
+missed slots: the entry is rescheduled from the current time without firing.
+"""
+from micropython import const
+from time import time
+import heapq
+from events import asyncio
+
+SKIP = const(0)
+ONCE = const(1)
+ALL = const(2)
+
+MINUTES_PER_DAY = const(1440)
+DAY_S = const(86400)  # no slot is further away: a larger gap is a jump of the clock
+MAX_WAIT_S = const(3600)  # run() checks the deadlines at least this often
+
+
+def _field(text, lowest, highest):
+    """Values of one cron field, e.g. "*/10" or "7-22/3,23" """
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+        if part == "*":
+            first, last = lowest, highest
+        elif "-" in part:
+            first, last = (int(v) for v in part.split("-"))
+        else:
+            first = last = int(part)
+        if not lowest <= first <= last <= highest or step < 1:
+            raise ValueError("invalid cron field " + text)
+        values.update(range(first, last + 1, step))
+    return values
+
+
+def minutesOfDay(spec):
+    """Sorted tuple of the minutes of the day (0 to 1439) matching a spec"""
+    if isinstance(spec, str):
+        fields = spec.split()
+        minutes = _field(fields[0], 0, 59)
+        hours = _field(fields[1], 0, 23) if len(fields) > 1 else range(24)
+    else:
+        minutes, hours = spec, range(24)
+    return tuple(sorted(h * 60 + m for h in hours for m in minutes))
+
+
+def nextSlot(slots, t):
+    """First time in seconds strictly after t which is one of the minutes of the day slots"""
+    minute = t // 60
+    day, ofDay = divmod(minute, MINUTES_PER_DAY)
+    lo, hi = 0, len(slots)
+    while lo < hi:  # first slot > ofDay
+        mid = (lo + hi) // 2
+        if slots[mid] <= ofDay:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == len(slots):
+        day, lo = day + 1, 0
+    return (day * MINUTES_PER_DAY + slots[lo]) * 60
+
+
+class Scheduler:
+    """
+    schedule: {state: spec} e.g. state.SCHEDULER
+    policy: SKIP, ONCE or ALL for the slots missed
+    clock: function returning the current local time in seconds, injectable for testing
+    """
+    def __init__(self, schedule, policy=ONCE, clock=time):
+        self.policy, self.clock = policy, clock
+        self.states = list(schedule)
+        self.slots = [minutesOfDay(spec) for spec in schedule.values()]
+        self.missed = 0  # slots skipped or merged by the catch-up policy
+        now = int(clock())  # a slot in the current minute is due at once
+        self._heap = [(nextSlot(slots, now - 60), i) for i, slots in enumerate(self.slots)]
+        heapq.heapify(self._heap)
+
+    def nextAt(self):
+        """Time in seconds of the next deadline, None if nothing is scheduled"""
+        return self._heap[0][0] if self._heap else None
+
+    def waitS(self, now=None):
+        """Seconds to wait until the next deadline"""
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - int(self.clock() if now is None else now))
+
+    def due(self, now=None):
+        """States whose time has come, in the order of their deadlines ; their next slots are scheduled"""
+        now = int(self.clock() if now is None else now)
+        fired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            at, i = heap[0]
+            slots = self.slots[i]
+            if now - at > DAY_S:  # the clock jumped forward
+                self.missed += 1
+                heapq.heapreplace(heap, (nextSlot(slots, now), i))
+                continue
+            following = nextSlot(slots, at)
+            if following <= now:  # late: the slots after at were missed too
+                if self.policy == ALL:
+                    fired.append(self.states[i])
+                    heapq.heappop(heap)
+                    heapq.heappush(heap, (following, i))
+                    continue
+                while following <= now:
+                    self.missed += 1
+                    following = nextSlot(slots, following)
+                if self.policy == SKIP:
+                    self.missed += 1
+                    heapq.heappop(heap)
+                    heapq.heappush(heap, (following, i))
+                    continue
+            fired.append(self.states[i])
+            heapq.heappop(heap)
+            heapq.heappush(heap, (following, i))
+        return fired
+
+    async def run(self, post):
+        """Task calling post(state) for each state due, sleeping until the next deadline in between"""
+        while self._heap:
+            self._rebase()
+            await asyncio.sleep(min(self.waitS(), MAX_WAIT_S))
+            for state in self.due():
+                post(state)
+
+    def _rebase(self, now=None):
+        """Reschedule from the current time the deadlines more than a day ahead: the clock jumped backward"""
+        now = int(self.clock() if now is None else now)
+        if self._heap and max(at for at, i in self._heap) - now > DAY_S:
+            self._heap = [(at if at - now <= DAY_S else nextSlot(self.slots[i], now), i) for at, i in self._heap]
+            heapq.heapify(self._heap)
+
+    def dump(self):
+        """Next fire times [[state, time]...] e.g. to be saved before a deep sleep"""
+        return [[self.states[i], at] for at, i in self._heap] + [self.missed]
+
+    def load(self, data):
+        """
+        Restore the next fire times saved by dump(): the slots missed since are caught up by due()
+        Saved times more than a day ahead, e.g. restored at a cold boot with the RTC in 2021, are ignored
+        """
+        *entries, self.missed = data
+        saved = dict(entries)
+        self._heap = [(saved.get(state, at), i) for at, i in self._heap for state in (self.states[i],)]
+        heapq.heapify(self._heap)
+        self._rebase()
+
+    def __str__(self):
+        return f"Scheduler(next at {self.nextAt()}, {self.missed} missed)"
+
+
+if __name__ == "__main__":
+    # on CPython: compare with the old minute by minute scan of the schedule, then check the catch-up policies
+    schedule = {98: (9, 19, 29, 39, 49, 59), 2: "*/5 *", 7: "0 7-22/3", 5: "30 12"}
+    start = 1_700_000_000
+    scheduler = Scheduler(schedule, clock=lambda: start)
+    fired, expected = [], []
+    for t in range(start, start + 2 * 86400, 20):  # a due() every 20 s, as the old ontick every 5 s
+        fired += [(t // 60, s) for s in scheduler.due(t)]
+        minute = t // 60
+        if t % 60 < 20:  # first pass in this minute
+            expected += [(minute, s) for s in schedule if minute % 1440 in minutesOfDay(schedule[s])]
+    print("scan", len(expected), "fired", len(fired), "identical" if sorted(fired) == sorted(expected) else "DIFFERENT")
+    for policy, name in ((SKIP, "SKIP"), (ONCE, "ONCE"), (ALL, "ALL")):
+        scheduler = Scheduler({98: "*/10 *"}, policy=policy, clock=lambda: start)
+        late = scheduler.due(scheduler.nextAt() + 3600)  # blocked for an hour
+        print(f"{name}: {len(late)} fired after an hour late, {scheduler.missed} missed, next in {scheduler.waitS(scheduler.nextAt() - 600)} s")
+    # cold boot: the RTC in 2021 while the snapshot was saved in 2026, then NTP sets the clock
+    now = [1_609_459_200]
+    saved = Scheduler({98: "*/10 *"}, clock=lambda: start).dump()
+    scheduler = Scheduler({98: "*/10 *"}, clock=lambda: now[0])
+    scheduler.load(saved)
+    print("cold boot: next in", scheduler.waitS(), "s", end="")
+    now[0] = start
+    print(", after NTP:", scheduler.due(), "fired, next in", scheduler.waitS(), "s")
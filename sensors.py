@@ -11,6 +11,7 @@ class Sensor:
     id = "1234"         # sensorId
     rawValue = 0.0
     calcValue = 0.0
+    minValue = maxValue = stddev = None  # dispersion of the raw samples when oversampled (see oversampling.py)
 
     def __init__(self, id):
         self.id = id
@@ -69,10 +70,12 @@ class DHT:
         self.dht = DHT11(Pin(pin)) if serie == 11 else DHT22(Pin(pin))
         self.DHTT = Sensor(f"{id}_T")
         self.DHTH = Sensor(f"{id}_H")
+        self.error = None  # OSError of the last failed measure
 
     def read(self):
         """
         Only read if the last read was done 3 seconds ago
+        Return False if the measure failed, the error in self.error and the values being the previous ones
         """
         if time() - self.lastRead > 3:
             try:
@@ -80,9 +83,10 @@ class DHT:
                 self.DHTT.rawValue = self.DHTT.calcValue = self.dht.temperature()
                 self.DHTH.rawValue = self.DHTH.calcValue = self.dht.humidity()
             except OSError as err:
-                pass
-            else:
-                self.lastRead = time()
+                self.error = err
+                return False
+            self.lastRead = time()
+        return True
 
     @property
     def temperature(self):
@@ -0,0 +1,41 @@
+"""
+Simulation of the Pico W hardware on CPython: the application modules run unchanged on a PC
+
+install() registers the fakes of this package under the names of the MicroPython modules
+(machine, network, ssd1306, framebuf, dht, urequests, utime, micropython, ubinascii),
+then import main, display, logger... as on the board:
+
+    import sim
+    sim.install(scale=0.1)
+    from display import Display
+
+The fakes mimic the timing of the hardware: the Wifi scan and association, the DHCP lease,
+the DHT conversion... take their real duration multiplied by sim.timeScale (0: instant).
+The I2C bus does not sleep: it adds the time the bytes take at its frequency to I2C.busUs.
+InfluxDB is replaced by a local HTTP server: see sim.influx.
+The benchmark suite is sim.bench: python -m sim.bench
+"""
+import sys
+import time
+
+MODULES = ("micropython", "utime", "ubinascii", "machine", "framebuf", "ssd1306", "dht", "network", "urequests")
+timeScale = 1.0  # duration of the simulated operations: 1.0 real time, 0 instant
+
+
+def delay(seconds):
+    """Sleep for a simulated operation lasting seconds on the board"""
+    if seconds * timeScale > 0:
+        time.sleep(seconds * timeScale)
+
+
+def install(scale=None):
+    """
+    Register the fakes as the MicroPython modules, replacing the ones already imported
+    scale: new timeScale if given
+    """
+    global timeScale
+    import importlib
+    if scale is not None:
+        timeScale = scale
+    for name in MODULES:
+        sys.modules[name] = importlib.import_module("sim." + name)
@@ -0,0 +1,291 @@
+"""
+End-to-end benchmarks of the application on the simulated hardware, compared with a stored baseline
+
+    python -m sim.bench                  all the scenarios, compared with sim/baseline.json
+    python -m sim.bench logger display   some scenarios only
+    python -m sim.bench --save           store the results as the new baseline
+
+Scenarios and their metrics:
+- logger, logger gzip: points/s from Logger.add to the end of push() to the InfluxDB stub, bytes/point sent,
+  heap bytes (peak allocated on CPython)
+- display: frame ms of a full screen and of a HOME screen refresh (Python time + I2C bus time at 400 kHz),
+  bytes/frame on the bus, heap bytes of a refresh
+- sampling: ms per reading of the 3 moisture sensors (16 samples each) and the DHT, queued through the
+  Aggregator and the Deadband, heap bytes
+- wifi: connection ms through the cached access point and through a scan, in real time whatever timeScale
+- telemetry: us per call of the metrics updated from the hot paths, us per flush of a full registry
+- dead letters: points with extra fields all rejected by a 400 of the stub, isolated one by one by push()
+  and moved to the dead letters: write_api requests per dead letter
+- rows: an hour of rounds (3 moisture sensors, DHT temperature and humidity) every minute, uploaded every
+  10 minutes, queued one point per sensor (narrow) or as wide rows: queued bytes (PointStore records),
+  bytes sent and write_api requests to the InfluxDB stub
+A metric worse than the baseline by more than the tolerance is flagged, and the exit status is 1.
+The timings are the ones of the host: a baseline is only comparable on the same machine.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(REPO, "sim", "baseline.json")
+MAC = "28:cd:c1:07:e5:d5"
+
+
+def _quiet(run):
+    """Run without the debugging prints of the application"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run()
+
+
+def benchLogger(nbPoints=500, gzip=False):
+    from logger import Logger
+    from benchutils import memoryAllocated
+    from sim.influx import influxStub, stop
+
+    def run():
+        log = Logger(MAC, url=server.url, gzip=gzip, nbExtra=3)
+        for i in range(nbPoints):
+            log.add("DATA", f"ACD{i % 3}", "moisture", 38000 + i, 29.0 + i % 7,
+                    ("min", "max", "n"), (28.0, 30.0, 3))
+        log.push()
+        log.InfluxClient.close()
+        return log
+
+    server = influxStub()
+    start = time.perf_counter()
+    log = _quiet(run)
+    elapsed = time.perf_counter() - start
+    delivered = server.points
+    heap = _quiet(lambda: memoryAllocated(run))[1]
+    stop(server)
+    if delivered != nbPoints:
+        raise AssertionError(f"{delivered} points received by the stub out of {nbPoints}")
+    return {"points/s": nbPoints / elapsed, "bytes/point": log.bytesSent / nbPoints, "heap bytes": heap}
+
+
+def benchDeadLetters(nbPoints=8):
+    from logger import Logger
+    from sim.influx import influxStub, stop
+
+    def run():
+        log = Logger(MAC, url=server.url, nbExtra=3)
+        for i in range(nbPoints):
+            log.add("DATA", f"ACD{i % 3}", "moisture", 38000 + i, 29.0, ("calcMin", "calcMax", "count"), (28.0, 30.0, 3))
+        log.push()
+        log.InfluxClient.close()
+        return log
+
+    server = influxStub(lambda request, length: 400)
+    log = _quiet(run)
+    stop(server)
+    if len(log.deadLetters) != nbPoints or log.logEntries:
+        raise AssertionError(f"{len(log.deadLetters)} dead letters out of {nbPoints}, {len(log.logEntries)} left")
+    if log.deadLetters[0][6] != ("calcMin", "calcMax", "count"):
+        raise AssertionError("extra fields lost in the dead letters")
+    return {"requests/dead letter": server.requests / nbPoints}
+
+
+def benchDisplay(repeat=20):
+    from display import Display
+    from machine import I2C
+    from benchutils import memoryAllocated
+    i2c = I2C(0, freq=400000)
+    dis = Display(0, 17, 16, i2c=i2c)
+    tick = [0]
+
+    def frame(ms):
+        """ms: Python time of the drawing, the time of the bytes on the bus is added"""
+        return ms + (i2c.busUs - busUs) / 1000
+
+    def home():
+        tick[0] += 1
+        dis.screen(f" 2024-03-25 MON\n 12:{tick[0] // 60 % 60:02}:{tick[0] % 60:02}\n Connected to\n MyWifi",
+                   footer=f"{tick[0] % 50} Send", button1="Wifi", button2="ACD", button3="Buzz", button4="DHT")
+
+    busUs, start = i2c.busUs, time.perf_counter()
+    dis.screen("Moisture\n0: 29.0% [38000]\n1: 31.5% [37020]", title="Moisture", button3="Read", button4="HOME")
+    full = frame((time.perf_counter() - start) * 1000)
+    home()  # layout of the HOME screen prerendered
+    busUs, bytesSent, start = i2c.busUs, dis.bytesSent, time.perf_counter()
+    for i in range(repeat):
+        home()
+    refresh = frame((time.perf_counter() - start) * 1000) / repeat
+    bytesPerFrame = (dis.bytesSent - bytesSent) / repeat
+    heap = memoryAllocated(home)[1]
+    if i2c.ram != dis.buffer:
+        raise AssertionError("the display RAM differs from the framebuffer")
+    return {"frame ms (full)": full, "frame ms (refresh)": refresh, "bytes/frame": bytesPerFrame, "heap bytes": heap}
+
+
+def benchSampling(repeat=20):
+    from sensors import MakerSoilMoisture, DHT
+    from oversampling import Oversampler
+    from logger import Logger
+    from deadband import Deadband
+    from aggregator import Aggregator
+    from benchutils import memoryAllocated
+    import sim
+    acds = (MakerSoilMoisture("ACD0", 26), MakerSoilMoisture("ACD1", 27), MakerSoilMoisture("ACD2", 28))
+    sampler = Oversampler(acds, nbSamples=16, trim=4)
+    airSensor = DHT("DHT11", 11, 15)
+    log = Logger(MAC, nbExtra=3)
+    readings = Aggregator(Deadband(log, absolute=0.5, heartbeatS=3600), windowS=15 * 60)
+
+    def cycle():
+        sampler.read()
+        for acd in acds:
+            readings.add("DATA", acd.id, "moisture", acd.rawValue, acd.calcValue)
+        airSensor.lastRead = 0  # as after SAMPLING_S
+        airSensor.read()
+        readings.add("DATA", airSensor.DHTT.id, "temperature", airSensor.temperature)
+        readings.add("DATA", airSensor.DHTH.id, "humidity", airSensor.humidity)
+
+    scale, sim.timeScale = sim.timeScale, 0  # the DHT interval would fail the measures
+    start = time.perf_counter()
+    for i in range(repeat):
+        _quiet(cycle)
+    ms = (time.perf_counter() - start) * 1000 / repeat
+    heap = _quiet(lambda: memoryAllocated(cycle))[1]
+    sim.timeScale = scale
+    return {"ms/cycle": ms, "heap bytes": heap}
+
+
+def benchWifi():
+    import sim
+    import uwifi
+    scale, sim.timeScale = sim.timeScale, 1.0  # polled every POLL_MS: only meaningful in real time
+    results = {}
+    for name in ("scan", "cached"):  # the first connection fills the cache of the access point
+        start = time.perf_counter()
+        wlan = _quiet(uwifi.uWifi)
+        results[f"connect ms ({name})"] = (time.perf_counter() - start) * 1000
+        if not wlan:
+            raise AssertionError("not connected")
+        wlan.disconnect()
+    sim.timeScale = scale
+    return results
+
+
+def benchTelemetry():
+    from telemetry import Metrics, bench_overhead
+
+    class Sink:
+        def add(self, *point):
+            pass
+
+    results = {f"{call} us": us for call, (us, allocated) in bench_overhead().items()}
+    registry = Metrics()
+    indexes = [(registry.counter(f"c{i}"), registry.gauge(f"g{i}"), registry.histogram(f"h{i}", (1, 10, 100)))
+               for i in range(7)]
+    for i in range(5):
+        for c, g, h in indexes:
+            registry.inc(c)
+            registry.set(g, i)
+            registry.observe(h, 10 * i)
+        registry.flush(Sink())
+    results["flush us"] = registry.gauges[0]  # telemetry.flushUs of the last flush: 22 metrics updated
+    return results
+
+
+def benchRows(minutes=60, uploadMin=10):
+    from logger import Logger
+    from sim.influx import influxStub, stop
+
+    def run(rows):
+        log = Logger(MAC, url=server.url, nbExtra=3, rows=rows)
+        queued = 0
+        for minute in range(minutes):
+            log.addRow("DATA", "moisture", "moisture",
+                       [(f"ACD{i}", "moisture", 38000 + 10 * i + minute, 29.0 + i + minute / 60) for i in range(3)])
+            log.addRow("DATA", "air", "air", [("DHT11_T", "temperature", 21.0 + minute % 5, None),
+                                              ("DHT11_H", "humidity", 55.0 + minute % 7, None)])
+            if minute % uploadMin == uploadMin - 1:
+                queued += len(log.logEntries) * log.logEntries._size
+                log.push()
+        log.InfluxClient.close()
+        return queued, log.bytesSent
+
+    results = {}
+    for name, rows in (("narrow", False), ("wide", True)):
+        server = influxStub()
+        queued, sent = _quiet(lambda: run(rows))
+        results.update({f"queued bytes ({name})": queued, f"bytes sent ({name})": sent,
+                        f"requests ({name})": server.requests})
+        stop(server)
+    return results
+
+
+SCENARIOS = {
+    "logger": benchLogger,
+    "logger gzip": lambda: benchLogger(gzip=True),
+    "dead letters": benchDeadLetters,
+    "display": benchDisplay,
+    "sampling": benchSampling,
+    "wifi": benchWifi,
+    "telemetry": benchTelemetry,
+    "rows": benchRows,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print the results against the baseline ; return the number of regressions"""
+    regressions = 0
+    print(f"{'scenario':<12} {'metric':<20} {'baseline':>12} {'current':>12} {'change':>8}")
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(scenario, {}).get(metric)
+            if before is None:
+                print(f"{scenario:<12} {metric:<20} {'-':>12} {value:>12.1f}")
+                continue
+            change = (value - before) / before if before else 0.0
+            worse = -change if "/s" in metric else change  # throughputs: higher is better
+            flag = " WORSE" if worse > tolerance else ""
+            regressions += bool(flag)
+            print(f"{scenario:<12} {metric:<20} {before:>12.1f} {value:>12.1f} {100 * change:>+7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks of the application on the simulated hardware")
+    parser.add_argument("scenarios", nargs="*", help=f"among {', '.join(SCENARIOS)} ; all by default")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change flagged as a regression")
+    parser.add_argument("--scale", type=float, default=0.1, help="sim.timeScale of the simulated delays")
+    args = parser.parse_args()
+    names = args.scenarios or list(SCENARIOS)
+
+    import sim
+    sim.install(args.scale)
+    sys.path.insert(0, REPO)
+    os.chdir(tempfile.mkdtemp())  # the files written by the application: wifi.json, networks.json...
+    results = {}
+    for name in names:
+        results[name] = SCENARIOS[name]()
+
+    try:
+        with open(BASELINE) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        stored = {"results": {}}
+    if stored.get("scale", args.scale) != args.scale:
+        print(f"baseline measured with --scale {stored['scale']}: the network timings are not comparable")
+    regressions = compare(results, stored["results"], args.tolerance)
+    if args.save:
+        stored["results"].update(results)
+        stored.update(scale=args.scale, host=platform.node(), python=platform.python_version(),
+                      at=time.strftime("%Y-%m-%d %H:%M:%S"))
+        with open(BASELINE, "w") as f:
+            json.dump(stored, f, indent=1)
+        print("baseline saved to", BASELINE)
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
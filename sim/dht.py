@@ -0,0 +1,49 @@
+"""
+Fake dht module: DHT11 and DHT22 with their conversion time and minimum interval between measures
+A measure sooner than the interval or a transmission error (failRate) raises OSError(ETIMEDOUT) as the driver
+The temperature and humidity drift slowly around DHTBase.temperature and DHTBase.humidity
+"""
+import errno
+import random
+import time
+import sim
+
+
+class DHTBase:
+    temperature0, humidity0 = 27.0, 60.0  # mean values of the room
+    failRate = 0.0  # share of the measures failing
+
+    def __init__(self, pin):
+        self.pin = pin
+        self._t, self._h = self.temperature0, self.humidity0
+        self._lastMeasure = None
+
+    def measure(self):
+        sim.delay(self.CONVERSION_S)
+        now = time.monotonic()
+        if self._lastMeasure is not None and (now - self._lastMeasure) < self.INTERVAL_S * sim.timeScale \
+                or random.random() < self.failRate:
+            raise OSError(errno.ETIMEDOUT)
+        self._lastMeasure = now
+        self._t += (self.temperature0 - self._t) * 0.1 + random.gauss(0, 0.2)
+        self._h += (self.humidity0 - self._h) * 0.1 + random.gauss(0, 0.5)
+
+
+class DHT11(DHTBase):
+    CONVERSION_S, INTERVAL_S = 0.02, 1.0
+
+    def temperature(self):
+        return round(self._t)
+
+    def humidity(self):
+        return round(self._h)
+
+
+class DHT22(DHTBase):
+    CONVERSION_S, INTERVAL_S = 0.02, 2.0
+
+    def temperature(self):
+        return round(self._t, 1)
+
+    def humidity(self):
+        return round(self._h, 1)
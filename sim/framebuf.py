@@ -0,0 +1,71 @@
+"""
+Fake framebuf module: MONO_VLSB frame buffers only, the format of the SSD1306
+text() draws an 8x8 pattern derived from the character code instead of the built-in font:
+as many pixels as real glyphs for the frame comparisons, not readable
+Pure Python: far slower than the C module of the firmware, only relative timings make sense
+"""
+MONO_VLSB = 0
+
+
+class FrameBuffer:
+    def __init__(self, buffer, width, height, format=MONO_VLSB, stride=None):
+        if format != MONO_VLSB:
+            raise ValueError("only MONO_VLSB is simulated")
+        self.buffer, self.width, self.height = buffer, width, height
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        i, mask = (y >> 3) * self.width + x, 1 << (y & 7)
+        if c is None:
+            return 1 if self.buffer[i] & mask else 0
+        if c:
+            self.buffer[i] |= mask
+        else:
+            self.buffer[i] &= ~mask & 0xFF
+
+    def fill(self, c):
+        value = 0xFF if c else 0
+        buffer = self.buffer
+        for i in range(len(buffer)):
+            buffer[i] = value
+
+    def fill_rect(self, x, y, w, h, c):
+        for yy in range(max(y, 0), min(y + h, self.height)):
+            for xx in range(max(x, 0), min(x + w, self.width)):
+                self.pixel(xx, yy, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            return self.fill_rect(x, y, w, h, c)
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def text(self, s, x, y, c=1):
+        for k, ch in enumerate(s):
+            if ch == " ":
+                continue
+            code = ord(ch) * 2654435761
+            for col in range(8):
+                bits = code >> col & 0x7F
+                for row in range(8):
+                    if bits >> row & 1:
+                        self.pixel(x + 8 * k + col, y + row, c)
+
+    def blit(self, fbuf, x, y, key=-1, palette=None):
+        for yy in range(fbuf.height):
+            for xx in range(fbuf.width):
+                c = fbuf.pixel(xx, yy)
+                if c != key:
+                    self.pixel(x + xx, y + yy, c)
+
+    def scroll(self, xstep, ystep):
+        raise NotImplementedError("scroll is not simulated")
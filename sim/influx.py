@@ -0,0 +1,19 @@
+"""
+InfluxDB stub: the local /write server of uhttp with the delays of InfluxDB Cloud over a home connection,
+multiplied by sim.timeScale ; Logger(mac, url=server.url) sends it the points, counted in server.points
+"""
+import sim
+from uhttp import stubServer
+
+HANDSHAKE_S = 0.25  # TCP and TLS handshake of a new connection
+LATENCY_S = 0.08  # round trip and write of a batch
+
+
+def influxStub(status=None):
+    """status: optional function(request index, body length) returning the status code to inject"""
+    return stubServer(HANDSHAKE_S * sim.timeScale, LATENCY_S * sim.timeScale, status)
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
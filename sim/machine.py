@@ -0,0 +1,197 @@
+"""
+Fake machine module of the Pico W
+- Pin: press(), release() simulate a button, calling the irq handler as the hardware does
+- ADC: read_u16() returns ADC.levels[pin] (the soil moisture of the plant) with gaussian noise
+- I2C: counts the bytes and the time they take on the bus at its frequency (busUs), and keeps
+  the display RAM of a SSD1306 at the end of the bus up to date with the commands and data received
+- Timer: periodic or one shot callbacks from a thread
+- lightsleep() sleeps, deepsleep() raises DeepSleep: the board would restart from main.py
+"""
+import random
+import threading
+import time
+import sim
+
+WIDTH, HEIGHT = 128, 64  # SSD1306 emulated on the I2C bus
+SET_COL_ADDR, SET_PAGE_ADDR = 0x21, 0x22
+
+PWRON_RESET, WDT_RESET, DEEPSLEEP_RESET, SOFT_RESET = 1, 3, 4, 5
+_resetCause = PWRON_RESET
+
+
+class Pin:
+    IN, OUT, OPEN_DRAIN = 0, 1, 2
+    PULL_UP, PULL_DOWN = 1, 2
+    IRQ_FALLING, IRQ_RISING = 4, 8
+    pins = {}  # id --> last Pin created, to simulate the buttons
+
+    def __init__(self, id, mode=IN, pull=None, value=None):
+        self.id, self.mode, self.pull = id, mode, pull
+        self._value = value or 0
+        self._handler, self._trigger = None, 0
+        Pin.pins[id] = self
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._set(1 if v else 0)
+
+    __call__ = value
+
+    def on(self):
+        self._set(1)
+
+    def off(self):
+        self._set(0)
+
+    def toggle(self):
+        self._set(1 - self._value)
+
+    def _set(self, v):
+        rising, falling = v > self._value, v < self._value
+        self._value = v
+        if self._handler and (rising and self._trigger & Pin.IRQ_RISING or falling and self._trigger & Pin.IRQ_FALLING):
+            self._handler(self)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler, self._trigger = handler, trigger
+
+    def press(self):
+        """A button wired to 3.3V pressed then released"""
+        self._set(1)
+        self._set(0)
+
+    def __repr__(self):
+        return f"Pin({self.id})"
+
+
+class ADC:
+    levels = {}  # pin id --> mean reading, e.g. {26: 38000}
+    noise = 300  # standard deviation of the readings
+    default = 38000
+
+    def __init__(self, pin):
+        self.pin = pin.id if isinstance(pin, Pin) else pin
+
+    def read_u16(self):
+        value = random.gauss(ADC.levels.get(self.pin, ADC.default), ADC.noise)
+        return min(65535, max(0, int(value)))
+
+
+class I2C:
+    def __init__(self, id=0, scl=None, sda=None, freq=400000):
+        self.freq = freq
+        self.bytes = self.transfers = 0
+        self.busUs = 0.0  # time on the bus: 9 clock cycles per byte (8 bits + ack) and the address byte
+        self.ram = bytearray(WIDTH * HEIGHT // 8)  # display RAM of the SSD1306
+        self._cmd, self._col, self._page = [], 0, 0
+        self._window = (0, WIDTH - 1, 0, HEIGHT // 8 - 1)
+
+    def _count(self, nbBytes):
+        self.bytes += nbBytes
+        self.transfers += 1
+        self.busUs += (nbBytes + 1) * 9 * 1_000_000 / self.freq
+
+    def scan(self):
+        return [0x3C]
+
+    def writeto(self, addr, buf, stop=True):
+        """Commands: Co=1, D/C#=0 then the command byte"""
+        self._count(len(buf))
+        self._cmd.append(buf[1])
+        cmd = self._cmd
+        if len(cmd) == 3 and cmd[0] == SET_COL_ADDR:
+            self._window = (cmd[1], cmd[2]) + self._window[2:]
+            self._col, self._cmd = cmd[1], []
+        elif len(cmd) == 3 and cmd[0] == SET_PAGE_ADDR:
+            self._window = self._window[:2] + (cmd[1], cmd[2])
+            self._page, self._cmd = cmd[1], []
+        elif cmd[0] not in (SET_COL_ADDR, SET_PAGE_ADDR):
+            self._cmd = []
+        return len(buf)
+
+    def writevto(self, addr, bufs, stop=True):
+        """Data: the control byte then the bytes written in the window from the current column and page"""
+        data = bufs[1]
+        self._count(len(bufs[0]) + len(data))
+        x0, x1, p0, p1 = self._window
+        for byte in data:
+            self.ram[self._page * WIDTH + self._col] = byte
+            self._col += 1
+            if self._col > x1:
+                self._col, self._page = x0, self._page + 1 if self._page < p1 else p0
+        return len(data)
+
+
+class Timer:
+    ONE_SHOT, PERIODIC = 0, 1
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, freq=None, callback=None):
+        self._alive = False
+        if callback:
+            self.init(mode=mode, period=period, freq=freq, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, freq=None, callback=None):
+        self.deinit()
+        periodS = 1 / freq if freq else period / 1000
+        self._alive = alive = [True]  # a new init() stops the previous thread
+
+        def run():
+            while alive[0]:
+                time.sleep(periodS)
+                if not alive[0]:
+                    break
+                callback(self)
+                if mode == Timer.ONE_SHOT:
+                    break
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def deinit(self):
+        if self._alive:
+            self._alive[0] = False
+
+
+class RTC:
+    _offset = 0  # seconds added to the host clock once datetime() is set
+
+    def datetime(self, datetimetuple=None):
+        """(year, month, day, weekday, hours, minutes, seconds, subseconds), weekday 0 for Monday"""
+        if datetimetuple is None:
+            tm = time.localtime(time.time() + RTC._offset)
+            return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0)
+        year, month, day, weekday, hours, minutes, seconds = datetimetuple[:7]
+        RTC._offset = time.mktime((year, month, day, hours, minutes, seconds, 0, 0, -1)) - time.time()
+
+
+class DeepSleep(SystemExit):
+    """Raised by deepsleep(): the board restarts from main.py after ms"""
+    def __init__(self, ms):
+        super().__init__(f"deepsleep {ms} ms")
+        self.ms = ms
+
+
+def lightsleep(ms=None):
+    sim.delay((ms or 0) / 1000)
+
+
+def deepsleep(ms=None):
+    global _resetCause
+    _resetCause = DEEPSLEEP_RESET
+    raise DeepSleep(ms)
+
+
+def reset_cause():
+    return _resetCause
+
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x2f\x57\x28"
+
+
+def freq(hz=None):
+    return 125_000_000 if hz is None else None
+
+
+def idle():
+    time.sleep(0.001)
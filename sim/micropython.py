@@ -0,0 +1,26 @@
+"""Fake micropython module: const and the code emitters are no-ops on CPython"""
+
+
+def const(value):
+    return value
+
+
+def native(f):
+    return f
+
+
+viper = native
+
+
+def schedule(f, arg):
+    f(arg)
+    return True
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(verbose=False):
+    import gc
+    print("gc objects:", len(gc.get_objects()))
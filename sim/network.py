@@ -0,0 +1,94 @@
+"""
+Fake network module: a CYW43 station interface and the access points around it
+
+WLAN.accessPoints lists the access points as returned by scan(): (ssid, bssid, channel, RSSI, security, hidden)
+WLAN.passwords: {ssid: password} to reject the wrong ones, empty to accept any
+The durations are the ones observed on the Pico W, multiplied by sim.timeScale:
+- scan(): SCAN_S, blocking
+- connect(): returns at once, isconnected() becomes True after the association
+  (ASSOCIATE_S, longer without the bssid: the channels are probed) and the DHCP lease unless ifconfig was set
+"""
+import time
+import sim
+
+STA_IF, AP_IF = 0, 1
+STAT_IDLE, STAT_CONNECTING, STAT_GOT_IP = 0, 1, 3
+STAT_CONNECT_FAIL, STAT_NO_AP_FOUND, STAT_WRONG_PASSWORD = -1, -2, -3
+
+SCAN_S = 2.2
+ASSOCIATE_S = 0.3  # bssid given
+PROBE_S = 0.5  # added without the bssid
+DHCP_S = 1.0
+
+
+class WLAN:
+    accessPoints = [(b"ssid1", b"\x00\x11\x22\x33\x44\x55", 6, -60, 3, 0),
+                    (b"ssid2", b"\x00\x11\x22\x33\x44\x66", 11, -75, 3, 0)]
+    passwords = {}
+    mac = b"\x28\xcd\xc1\x07\xe5\xd5"
+
+    def __init__(self, interface=STA_IF):
+        self._active = False
+        self._ap = None  # access point associated or being associated
+        self._status = STAT_IDLE
+        self._readyAt = None  # time.monotonic() of the end of the association and DHCP
+        self._static = None  # ifconfig set by the application
+        self.scans = self.connects = 0
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = bool(is_active)
+        if not self._active:
+            self.disconnect()
+
+    def scan(self):
+        if not self._active:
+            raise OSError("interface not active")
+        self.scans += 1
+        sim.delay(SCAN_S)
+        return list(WLAN.accessPoints)
+
+    def connect(self, ssid, key=None, bssid=None):
+        self.connects += 1
+        self._ap = None
+        for ap in WLAN.accessPoints:
+            if ap[0].decode() == ssid and (bssid is None or ap[1] == bssid):
+                self._ap = ap
+        duration = ASSOCIATE_S + (0 if bssid else PROBE_S)
+        if self._ap is None:
+            self._status = STAT_NO_AP_FOUND
+        elif ssid in WLAN.passwords and WLAN.passwords[ssid] != key:
+            self._status = STAT_WRONG_PASSWORD
+        else:
+            self._status = STAT_CONNECTING
+            self._readyAt = time.monotonic() + (duration + (0 if self._static else DHCP_S)) * sim.timeScale
+
+    def disconnect(self):
+        self._ap, self._status, self._readyAt = None, STAT_IDLE, None
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def status(self, param=None):
+        if param == "rssi":
+            if self._ap is None:
+                raise OSError("not connected")
+            return self._ap[3]
+        if param is not None:
+            raise ValueError("unknown status param " + param)
+        if self._status == STAT_CONNECTING and time.monotonic() >= self._readyAt:
+            self._status = STAT_GOT_IP
+        return self._status
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return self._static or ("192.168.1.10", "255.255.255.0", "192.168.1.1", "8.8.8.8")
+        self._static = None if config == "dhcp" else tuple(config)
+
+    def config(self, param):
+        if param == "mac":
+            return WLAN.mac
+        if param in ("ssid", "essid"):
+            return self._ap[0].decode() if self._ap else ""
+        raise ValueError("unknown config param " + param)
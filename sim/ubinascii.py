@@ -0,0 +1,7 @@
+"""Fake ubinascii module: hexlify accepts the separator as on MicroPython"""
+from binascii import unhexlify, crc32, a2b_base64, b2a_base64
+import binascii
+
+
+def hexlify(data, sep=None):
+    return binascii.hexlify(data, sep) if sep else binascii.hexlify(data)
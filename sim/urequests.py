@@ -0,0 +1,43 @@
+"""Fake urequests module: the requests are really sent, with urllib, e.g. to the InfluxDB stub of sim.influx"""
+import urllib.request
+import urllib.error
+
+
+class Response:
+    def __init__(self, status_code, content, reason=""):
+        self.status_code, self.content, self.reason = status_code, content, reason
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        import json
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+
+def request(method, url, data=None, json=None, headers={}, timeout=None):
+    if json is not None:
+        import json as _json
+        data, headers = _json.dumps(json).encode(), dict(headers, **{"Content-Type": "application/json"})
+    if isinstance(data, str):
+        data = data.encode()
+    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return Response(res.status, res.read(), res.reason)
+    except urllib.error.HTTPError as err:
+        return Response(err.code, err.read(), err.reason)
+    except urllib.error.URLError as err:
+        raise OSError(str(err.reason))
+
+
+def get(url, **kw):
+    return request("GET", url, **kw)
+
+
+def post(url, **kw):
+    return request("POST", url, **kw)
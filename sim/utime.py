@@ -0,0 +1,37 @@
+"""
+Fake utime module: the CPython time functions plus the MicroPython ticks
+The ticks wrap around after 2**30 as on the RP2040 port: ticks_diff() handles it, the code using them is exercised
+"""
+from time import *
+from time import perf_counter as _perfCounter, sleep as _sleep
+
+TICKS_PERIOD = 1 << 30
+_TICKS_MAX = TICKS_PERIOD - 1
+_TICKS_HALF = TICKS_PERIOD // 2
+
+
+def ticks_us():
+    return int(_perfCounter() * 1_000_000) & _TICKS_MAX
+
+
+def ticks_ms():
+    return int(_perfCounter() * 1000) & _TICKS_MAX
+
+
+ticks_cpu = ticks_us
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+
+def sleep_ms(ms):
+    _sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _sleep(us / 1_000_000)
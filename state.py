@@ -1,30 +1,69 @@
 """
 Class to manage states for simple automation
+
+Table-driven: each state registers its handlers with on()
+- enter(): entry action, called once each time the state is entered (replaces the firstTime tests)
+- run(event): called on every step while in the state, event is 0 when nothing happened
+- exit(): called once when leaving the state
+- events: {event: next state} transitions taken without any handler
+step(event) finds the handlers of the current state with one dictionary lookup, whatever the number of states.
+Per state, the engine accounts for the time spent in the state and the time spent in its handlers,
+see stats() and report().
+The SCHEDULER changes of state are computed by a scheduler.Scheduler: its task posts them with post(),
+they are taken by the next step() of the main loop (never changed from an IRQ or a Timer callback)
 """
-from machine import Timer
-from time import localtime
+from micropython import const
+from time import time
+from utime import ticks_ms, ticks_us, ticks_diff
+from scheduler import Scheduler, ONCE
 
 SCHEDULER = {
-    #  state : (t1, t2, ..., tn)   in minutes
-    2: (0, 15, 30, 45),
-    4: (1, 16, 31, 46),
+    #  state : (t1, t2, ..., tn)   in minutes of every hour, or a cron-like "minutes hours" see scheduler.py
+    # the sensors are read by the sampling task of main.py every SAMPLING_S seconds
     98: (9, 19, 29, 39, 49, 59) # push data every 10 minutes
 }
 
+# index of the handlers of a state
+ENTER = const(0)
+RUN = const(1)
+EXIT = const(2)
+EVENTS = const(3)
+# index of the statistics of a state
+ENTRIES = const(0)   # number of times the state was entered
+DWELL_MS = const(1)  # total time spent in the state
+BUSY_US = const(2)   # total time spent in the handlers of the state
+STEPS = const(3)     # number of steps handled in the state
+
+_NO_HANDLERS = (None, None, None, {})
+
+
 class State:
-    def __init__(self, initialState, delay=5000, defaultSate=None):
+    def __init__(self, initialState, defaultSate=None, schedule=SCHEDULER, policy=ONCE, clock=time):
         """
         Usually only one object is created to manage the current state.
         :param initialState:
-        :param callback: function to call back after a timer is set upon change of state
-        :param delay: duration in seconds of the timer
         :param defaultSate: default state upon timer completion. If not indicated, initialState is used instead
+        :param schedule: {state: spec} of the scheduled changes of state, see scheduler.py
+        :param policy: catch-up policy for the scheduled changes missed, see scheduler.py
+        :param clock: function returning the local time in seconds, injectable for testing
         """
         self.lastState, self.currentState = -1, initialState
         self.defaultState = defaultSate or initialState
-        self.firstTime = False  # change to True when changing state
-        self.lastMinute = -1  # for scheduled tasks
-        Timer(mode=Timer.PERIODIC, period=delay, callback=self.ontick)  # default every 5 seconds
+        self.firstTime = True  # True until the entry action of the current state is done
+        self.scheduler = Scheduler(schedule, policy, clock)  # its run(self.post) task is started by the application
+        self._posted = []  # changes of state waiting for the next step
+        self._handlers = {}  # state --> (enter, run, exit, {event: next state})
+        self._stats = {}  # state --> [entries, dwell ms, busy us, steps]
+        self._entered = None  # state whose entry action was done
+        self._enteredAt = ticks_ms()
+
+    def on(self, state, enter=None, run=None, exit=None, events=None):
+        """
+        Register the handlers of a state ; any of them can be omitted
+        :param events: {event: next state} e.g. {1: 1, 4: 99} for the buttons 1 and 4
+        """
+        self._handlers[state] = (enter, run, exit, events or {})
+        self._stats[state] = [0, 0, 0, 0]
 
     def changeToDefault(self, t=None):
         """
@@ -36,6 +75,8 @@ class State:
     def changeTo(self, newState):
         """
         Change the currentState to a new given state, saving current in last State
+        The exit and entry actions are done by the next step()
+        Changing to the current state runs its exit and entry actions again
         :param newState:
         :return:
         """
@@ -44,33 +85,98 @@ class State:
         self.firstTime = True  # change to True when changing state for first time entry action
         # print("State changes from", self.lastState, "to", self.currentState)
 
-    def ontick(self, timer):
+    def post(self, newState):
+        """Queue a change of state for the next step, once the entry action of the current state is done"""
+        self._posted.append(newState)
+
+    def pending(self):
+        """True while a change of state is waiting for the next step"""
+        return self.firstTime or bool(self._posted)
+
+    def step(self, event=0):
         """
-        Callback function for the scheduler ; needs to be called at least once a minute
+        Run the state machine once: pending exit and entry actions, then the event
+        An event with a transition in the table changes the state, otherwise it is given to run()
         """
-        curMinute = localtime()[4]
-        if curMinute == self.lastMinute:
-            print(".", end="")
-            return  # already passed here
-        else:
-            print("|", end="")
-            self.lastMinute = curMinute
-
-        for state_idx, ticks in SCHEDULER.items():
-            if curMinute in ticks:
-                self.changeTo(state_idx)
-                break
+        if self._posted and not self.firstTime:
+            self.changeTo(self._posted.pop(0))
+        if self.firstTime:
+            self._enter()
+        state = self.currentState
+        handlers = self._handlers.get(state, _NO_HANDLERS)
+        nextState = handlers[EVENTS].get(event) if event else None
+        if nextState is not None:
+            self.changeTo(nextState)
+        elif handlers[RUN] and not self.firstTime:  # not when the entry action already changed the state
+            start = ticks_us()
+            handlers[RUN](event)
+            self._account(state, start)
+
+    def _enter(self):
+        now = ticks_ms()
+        left = self._entered
+        if left is not None:
+            stats = self._stats.get(left)
+            if stats:
+                stats[DWELL_MS] += ticks_diff(now, self._enteredAt)
+            exit = self._handlers.get(left, _NO_HANDLERS)[EXIT]
+            if exit:
+                start = ticks_us()
+                exit()
+                self._account(left, start)
+        # the entry action may change the state again: it is then entered by the next step
+        state = self._entered = self.currentState
+        self._enteredAt = now
+        self.firstTime = False
+        stats = self._stats.get(state)
+        if stats:
+            stats[ENTRIES] += 1
+        enter = self._handlers.get(state, _NO_HANDLERS)[ENTER]
+        if enter:
+            start = ticks_us()
+            enter()
+            self._account(state, start)
+
+    def _account(self, state, start):
+        stats = self._stats.get(state)
+        if stats:
+            stats[BUSY_US] += ticks_diff(ticks_us(), start)
+            stats[STEPS] += 1
+
+    def stats(self):
+        """{state: (entries, ms spent in the state, ms spent in its handlers, steps)} including the current stay"""
+        result = {}
+        for state, (entries, dwellMs, busyUs, steps) in self._stats.items():
+            if state == self._entered:
+                dwellMs += ticks_diff(ticks_ms(), self._enteredAt)
+            result[state] = (entries, dwellMs, busyUs // 1000, steps)
+        return result
+
+    def report(self):
+        """Text table of stats(), the states where the handlers are the busiest first"""
+        lines = ["state entries   in (ms) busy (ms)  steps"]
+        for state, (entries, dwellMs, busyMs, steps) in sorted(self.stats().items(), key=lambda s: -s[1][2]):
+            lines.append(f"{state:>5} {entries:>7} {dwellMs:>9} {busyMs:>9} {steps:>6}")
+        return "\n".join(lines)
 
     def __str__(self):
         return(f"currentState:{self.currentState} /  lastState={self.lastState}")
 
 if __name__ == "__main__":
     from time import sleep
-    state = State(99, delay=5)
-    print(state==99)
-    state.changeTo(0)
-    print(state)
-    state.changeTo(10)
-    sleep(6)
-    print(state)
-
+    state = State(99, schedule={98: "*/10 *"})
+    log = []
+    state.on(99, enter=lambda: state.changeTo(0))
+    state.on(0, events={1: 1})
+    state.on(1, enter=lambda: log.append("enter 1"), run=lambda e: log.append(f"run 1 {e}"),
+             exit=lambda: log.append("exit 1"), events={4: 99})
+    state.on(98, enter=lambda: log.append("upload") or state.changeToDefault())
+    for event in (0, 0, 1, 0, 2, 4, 0, 0):
+        state.step(event)
+        sleep(0.01)
+    for s in state.scheduler.due(state.scheduler.nextAt()):
+        state.post(s)
+    for event in (0, 0, 0):
+        state.step(event)
+    print(state, log)
+    print(state.report())
@@ -0,0 +1,197 @@
+"""
+Self-telemetry: metrics of the device itself, sent to InfluxDB as INFO points with the readings
+
+The registry keeps counters, gauges and fixed-bucket histograms in arrays preallocated at its creation:
+- counter(name), gauge(name), histogram(name, bounds) register a metric when a module is imported
+  and return its index ; registering more metrics than the capacity raises IndexError
+- inc(i), set(i, value), observe(i, value) are called from the hot paths: O(1) for counters and gauges,
+  O(number of buckets) for histograms, no allocation: the values are integers (ms, bytes, dBm...),
+  a float would be allocated on the heap of the Pico W
+- flush(logger) adds one INFO point per metric updated since the last flush through logger.add,
+  the sensorId being the name of the metric:
+    counter: rawValue total, calcValue increase since the last flush
+    gauge: rawValue = calcValue last value, extra fields min and max since the last flush
+    histogram: rawValue count, calcValue mean, extra fields p50, p90 (upper bound of the bucket) and max
+  then starts a new interval for the gauges and histograms
+The cost of the flushes is measured by the registry itself (gauge telemetry.flushUs), the one of the
+hot path calls by bench_overhead()
+"""
+from micropython import const
+from array import array
+import gc
+try:
+    from utime import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+    ticks_us = lambda: int(perf_counter() * 1_000_000)
+    ticks_diff = lambda a, b: a - b
+
+COUNTER = const(0)
+GAUGE = const(1)
+HISTOGRAM = const(2)
+KINDS = ("counter", "gauge", "histogram")
+MAX_BUCKETS = const(8)  # bounds of a histogram, the last bucket counting the values above them
+
+
+def heapFree():
+    """Free heap in bytes, 0 on CPython"""
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return 0
+
+
+class Metrics:
+    def __init__(self, nbCounters=16, nbGauges=8, nbHistograms=8):
+        self.names = ([], [], [])  # per kind, index --> name
+        self.counters = array('i', [0] * nbCounters)
+        self._flushed = array('i', [0] * nbCounters)  # counters at the last flush
+        self.gauges = array('i', [0] * nbGauges)
+        self._min = array('i', [0] * nbGauges)
+        self._max = array('i', [0] * nbGauges)
+        self._set = bytearray(nbGauges)  # set since the last flush
+        self._bounds = []  # per histogram, tuple of the upper bounds of its buckets
+        self._buckets = array('I', [0] * (nbHistograms * (MAX_BUCKETS + 1)))
+        self._count = array('I', [0] * nbHistograms)
+        self._sum = array('i', [0] * nbHistograms)
+        self._hMax = array('i', [0] * nbHistograms)
+        self._capacity = (nbCounters, nbGauges, nbHistograms)
+        self.flushes = 0
+        self._flushUs = self.gauge("telemetry.flushUs")
+
+    def _register(self, kind, name):
+        names = self.names[kind]
+        if name in names:
+            return names.index(name)
+        if len(names) == self._capacity[kind]:
+            raise IndexError(f"no room left for the {KINDS[kind]} {name}")
+        names.append(name)
+        return len(names) - 1
+
+    def counter(self, name):
+        return self._register(COUNTER, name)
+
+    def gauge(self, name):
+        return self._register(GAUGE, name)
+
+    def histogram(self, name, bounds):
+        """bounds: increasing upper bounds of the buckets, up to MAX_BUCKETS"""
+        if len(bounds) > MAX_BUCKETS:
+            raise ValueError("too many buckets")
+        i = self._register(HISTOGRAM, name)
+        if i == len(self._bounds):
+            self._bounds.append(tuple(bounds))
+        return i
+
+    def inc(self, i, n=1):
+        self.counters[i] += n
+
+    def set(self, i, value):
+        self.gauges[i] = value
+        if not self._set[i]:
+            self._set[i] = 1
+            self._min[i] = self._max[i] = value
+        elif value < self._min[i]:
+            self._min[i] = value
+        elif value > self._max[i]:
+            self._max[i] = value
+
+    def observe(self, i, value):
+        b = 0
+        for bound in self._bounds[i]:
+            if value <= bound:
+                break
+            b += 1
+        self._buckets[i * (MAX_BUCKETS + 1) + b] += 1
+        if not self._count[i] or value > self._hMax[i]:
+            self._hMax[i] = value
+        self._count[i] += 1
+        self._sum[i] += value
+
+    def quantile(self, i, q):
+        """Upper bound of the bucket reaching the quantile q (0 to 1) ; the max for the last bucket"""
+        count, bounds, first = self._count[i], self._bounds[i], i * (MAX_BUCKETS + 1)
+        seen = 0
+        for b in range(len(bounds) + 1):
+            seen += self._buckets[first + b]
+            if seen >= q * count:
+                return min(bounds[b], self._hMax[i]) if b < len(bounds) else self._hMax[i]
+        return self._hMax[i]
+
+    def flush(self, logger):
+        """Add the metrics updated since the last flush as INFO points, e.g. logger = Logger or Producer"""
+        start = ticks_us()
+        for i, name in enumerate(self.names[COUNTER]):
+            total = self.counters[i]
+            if total != self._flushed[i]:
+                logger.add("INFO", name, "counter", total, total - self._flushed[i])
+                self._flushed[i] = total
+        for i, name in enumerate(self.names[GAUGE]):
+            if self._set[i]:
+                value = self.gauges[i]
+                logger.add("INFO", name, "gauge", value, value, ("min", "max"), (self._min[i], self._max[i]))
+                self._set[i] = 0
+        for i, name in enumerate(self.names[HISTOGRAM]):
+            count = self._count[i]
+            if count:
+                logger.add("INFO", name, "histogram", count, self._sum[i] / count, ("p50", "p90", "max"),
+                           (self.quantile(i, 0.5), self.quantile(i, 0.9), self._hMax[i]))
+                first = i * (MAX_BUCKETS + 1)
+                for b in range(first, first + MAX_BUCKETS + 1):
+                    self._buckets[b] = 0
+                self._count[i], self._sum[i] = 0, 0
+        self.flushes += 1
+        self.set(self._flushUs, ticks_diff(ticks_us(), start))  # sent with the next flush
+
+    def __str__(self):
+        return (f"Metrics({len(self.names[COUNTER])} counters, {len(self.names[GAUGE])} gauges, "
+                f"{len(self.names[HISTOGRAM])} histograms, {self.flushes} flushes)")
+
+
+# registry shared by the modules of the application
+metrics = Metrics()
+
+
+def bench_overhead(repeat=10_000):
+    """
+    Microseconds per call of inc, set and observe (a 6 buckets histogram, value in the last but one),
+    an empty loop deducted ; bytes allocated by these calls
+    Returns a dictionary {call: (microseconds, bytes allocated)}
+    """
+    from benchutils import memoryAllocated, timeUsed
+    registry = Metrics()
+    c, g = registry.counter("bench.counter"), registry.gauge("bench.gauge")
+    h = registry.histogram("bench.histogram", (10, 20, 50, 100, 200, 500))
+
+    def loop(call, arg):
+        def run():
+            for i in range(repeat):
+                call(arg, 300)
+        return run
+
+    empty = timeUsed(loop(lambda i, v: None, 0))[1]
+    results = {}
+    for name, call, i in (("inc", registry.inc, c), ("set", registry.set, g), ("observe", registry.observe, h)):
+        run = loop(call, i)
+        results[name] = ((timeUsed(run)[1] - empty) / repeat, memoryAllocated(run)[1])
+    return results
+
+
+if __name__ == "__main__":
+    class PrintLogger:
+        def add(self, logType, sensorId, message, rawValue=0.0, calcValue=None, extraFields=None, extraValues=None):
+            print(logType, sensorId, message, rawValue, calcValue, extraFields or "", extraValues or "")
+
+    registry = Metrics()
+    uploads = registry.counter("uploads")
+    queue = registry.gauge("queue.depth")
+    latency = registry.histogram("write.ms", (50, 100, 200, 500, 1000, 2000))
+    for ms in (80, 120, 95, 450, 130, 2500, 110, 90):
+        registry.observe(latency, ms)
+        registry.inc(uploads)
+    for depth in (12, 40, 3):
+        registry.set(queue, depth)
+    registry.flush(PrintLogger())
+    registry.flush(PrintLogger())  # only the cost of the first flush: nothing else changed
+    for call, (us, allocated) in bench_overhead().items():
+        print(f"{call:>8}: {us:.2f} us per call, {allocated} bytes allocated")
@@ -0,0 +1,170 @@
+"""
+Time base of the points: monotonic microseconds at the sampling, UTC at the upload
+
+now() is called on the sampling path: it extends the wrapping ticks_us counter to a monotonic count of
+microseconds since the boot, without reading the RTC or building a nanosecond timestamp.
+The points keep this value until they are written to InfluxDB, where utcNs() converts it with the
+current mapping monotonic --> UTC:
+    utc = refUtc + (mono - refMono) * (1 + driftPpm / 1e6)
+The mapping comes from the NTP exchanges (ntp.setClock): sync() takes the 4 timestamps of an exchange,
+the offset is taken at the middle of the round trip, so the error is at most half the round trip not
+spent in the server. From one sync to the next, the difference between the UTC predicted and the
+UTC measured gives the drift of the crystal, smoothed and bounded to MAX_DRIFT_PPM.
+Until the first sync, the mapping comes from the RTC (local time, tz hours ahead of UTC).
+
+Wrap around: ticks_us wraps every TICKS_PERIOD us (17.9 minutes on the rp2 port). now() counts the ticks
+elapsed modulo the period since its previous call: it has to be called at least once per period,
+e.g. by the sampling task. Across a deep sleep, the count goes on from the snapshot: see suspend().
+After a power cut or a reset, the time spent is unknown: the snapshot is ignored, the count starts again
+from 0 with the mapping of the RTC until the next NTP sync. The points kept in flash across such a restart
+are stored with their UTC timestamp instead (utcUs() and monoUs()).
+now() is to be called from one core only ; peek() and utcNs() can be called from the other one.
+"""
+from micropython import const
+from utime import ticks_us, time_ns
+from machine import reset_cause, PWRON_RESET
+
+TICKS_PERIOD = const(1 << 30)  # of ticks_us on the rp2 port
+MIN_DRIFT_US = const(600_000_000)  # syncs closer than 10 minutes do not update the drift
+MAX_DRIFT_PPM = const(500)
+DRIFT_ALPHA = 0.5  # weight of the last measure of the drift
+
+
+class TimeBase:
+    def __init__(self, tz=0):
+        self._now = (0, ticks_us())  # (monotonic us, ticks_us) of the last now(), replaced as a whole for the other core
+        self._mapping = None  # (refMono, refUtc us, driftPpm)
+        self.fromRTC(tz)
+        self.synced = False
+        self.syncs = 0
+        self.rttUs = 0  # round trip of the last sync
+        self.correctionUs = 0  # UTC measured minus UTC predicted at the last sync
+        self._suspendUs = 0  # planned deep sleep, added to the count restored by load()
+        self._drift = False  # the next sync can measure the drift: no deep sleep since the last one
+        self.resumed = False  # the count goes on from the snapshot of a deep sleep
+
+    def fromRTC(self, tz=0):
+        """Mapping from the RTC set to local time, tz hours ahead of UTC: until the first NTP sync"""
+        self._mapping = (self.now(), time_ns() // 1000 - tz * 3_600_000_000, 0)
+
+    def now(self):
+        """Monotonic microseconds since the boot"""
+        us, last = self._now
+        t = ticks_us()
+        us += (t - last) & (TICKS_PERIOD - 1)
+        self._now = (us, t)
+        return us
+
+    def peek(self):
+        """now() without updating the count, for the other core"""
+        us, last = self._now
+        return us + ((ticks_us() - last) & (TICKS_PERIOD - 1))
+
+    def utcUs(self, mono):
+        refMono, refUtc, driftPpm = self._mapping
+        elapsed = mono - refMono
+        return refUtc + elapsed + elapsed * driftPpm // 1_000_000
+
+    def monoUs(self, utc):
+        """Monotonic microseconds of the UTC microseconds utc, negative before the boot"""
+        refMono, refUtc, driftPpm = self._mapping
+        return refMono + (utc - refUtc) * 1_000_000 // (1_000_000 + driftPpm)
+
+    def utcNs(self, mono):
+        """Unix time in nanoseconds of the monotonic microseconds mono, e.g. a point timestamp"""
+        return self.utcUs(mono) * 1000
+
+    def sync(self, t1, t2, t3, t4):
+        """
+        One NTP exchange: t1, t4 monotonic us when the request was sent and the answer received,
+        t2, t3 UTC us when the server received the request and sent the answer
+        """
+        mono, utc = (t1 + t4) // 2, (t2 + t3) // 2
+        self.rttUs = (t4 - t1) - (t3 - t2)
+        refMono, refUtc, driftPpm = self._mapping
+        self.correctionUs = utc - self.utcUs(mono)
+        if self.synced and self._drift and mono - refMono >= MIN_DRIFT_US:
+            measured = driftPpm + self.correctionUs * 1_000_000 // (mono - refMono)
+            driftPpm = int(DRIFT_ALPHA * measured + (1 - DRIFT_ALPHA) * driftPpm)
+            driftPpm = max(-MAX_DRIFT_PPM, min(MAX_DRIFT_PPM, driftPpm))
+        self._mapping = (mono, utc, driftPpm)
+        self.synced = self._drift = True
+        self.syncs += 1
+
+    def syncAgeS(self):
+        """Seconds since the last NTP sync, None if never synced"""
+        return (self.peek() - self._mapping[0]) // 1_000_000 if self.synced else None
+
+    @property
+    def driftPpm(self):
+        return self._mapping[2]
+
+    def suspend(self, ms):
+        """Before a deep sleep of ms: the snapshot saved next resumes the count after the sleep"""
+        self._suspendUs = ms * 1000
+
+    def dump(self):
+        return [self.now(), list(self._mapping), self.synced, self._suspendUs]
+
+    def load(self, data):
+        """
+        After a deep sleep: the count goes on from the snapshot, a mapping synced since the boot is kept,
+        moved to this scale ; the length of the sleep being the planned one, the next sync does not update the drift
+        The snapshot of a sleep is only resumed when the board was not powered off since (power cut during the sleep):
+        a snapshot without suspend(), e.g. saved in LIGHT mode, or older than a reset, is ignored
+        """
+        us, mapping, synced, suspendUs = data if len(data) > 3 else data + [0]
+        self.resumed = bool(suspendUs) and reset_cause() != PWRON_RESET
+        if not self.resumed:
+            return
+        us += suspendUs
+        shift = us - self.now()
+        self._now = (us, self._now[1])
+        if self.synced:
+            refMono, refUtc, driftPpm = self._mapping
+            self._mapping = (refMono + shift, refUtc, driftPpm)
+        else:
+            self._mapping, self.synced = tuple(mapping), synced
+        self._drift = False
+        self._suspendUs = 0
+
+    def __str__(self):
+        refMono, refUtc, driftPpm = self._mapping
+        return (f"TimeBase({'NTP' if self.synced else 'RTC'}, {self.syncs} syncs, drift {driftPpm} ppm, "
+                f"last correction {self.correctionUs} us, rtt {self.rttUs} us)")
+
+
+# time base shared by the Logger and ntp
+timebase = TimeBase()
+
+
+if __name__ == "__main__":
+    # on CPython: a crystal 40 ppm fast and ticks wrapping every 2**30 us, synced every 2 hours
+    # by NTP exchanges of 20 to 80 ms ; error of the timestamps converted between the syncs
+    import random
+    true = [0]  # true UTC us since the start
+    start = 1_700_000_000_000_000
+
+    def fakeTicks():
+        return int(true[0] * (1 + 40e-6)) & (TICKS_PERIOD - 1)
+
+    ticks_us = fakeTicks
+    base = TimeBase()
+    base._drift = True  # no deep sleep
+    base._mapping = (0, start + 3_000_000, 0)  # the RTC set 3 s off
+    worst = [0] * 4  # before the first sync, after 1, after 2 to 5, after 6 syncs or more
+    phase = lambda syncs: 0 if syncs == 0 else 1 if syncs == 1 else 2 if syncs < 6 else 3
+    for hour in range(24):
+        for minute in range(0, 60, 5):  # a now() every 5 minutes, 2**30 us being 17.9 minutes
+            true[0] = (hour * 60 + minute) * 60_000_000
+            error = abs(base.utcUs(base.now()) - (start + true[0]))
+            worst[phase(base.syncs)] = max(worst[phase(base.syncs)], error)
+            if minute == 0 and hour % 2 == 0:
+                rtt = random.randint(20_000, 80_000)
+                t1 = base.now()
+                server = start + true[0] + rtt // 2
+                true[0] += rtt
+                base.sync(t1, server, server + 200, base.now())
+    print(base)
+    print("worst error (ms): before sync", worst[0] // 1000, "after 1 sync", worst[1] // 1000,
+          "after 2 to 5", worst[2] // 1000, "after 6+", worst[3] // 1000)
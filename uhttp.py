@@ -0,0 +1,206 @@
+"""
+Minimal HTTP/1.1 client keeping one keep-alive connection to a server
+- many requests are sent over the same socket: a single TCP connection and TLS handshake
+  instead of one per request as with urequests
+- if the server closed the connection while idle, the request is transparently sent again on a new one
+Works on the Pico W (socket, ssl) as well as on CPython
+"""
+import socket
+try:
+    import ssl
+except ImportError:
+    import ussl as ssl
+
+
+class HTTPConnection:
+    """
+    Connection to the server given by url: http(s)://host[:port][/prefix]
+    keepAlive=False closes the socket after each request, as urequests does
+    """
+    def __init__(self, url, timeout=5, keepAlive=True):
+        scheme, _, rest = url.partition("://")
+        netloc, _, prefix = rest.partition("/")
+        self.tls = scheme == "https"
+        self.host, _, port = netloc.partition(":")
+        self.port = int(port) if port else (443 if self.tls else 80)
+        self.prefix = "/" + prefix.rstrip("/") if prefix else ""
+        self.timeout, self.keepAlive = timeout, keepAlive
+        self.sock = self._stream = None
+        self.connects = 0   # number of TCP connections opened i.e. TLS handshakes for https
+        self.requests = 0   # number of requests answered
+
+    def _connect(self):
+        addr = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0][-1]
+        sock = socket.socket()
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(addr)
+            if self.tls:
+                if hasattr(ssl, "create_default_context"):
+                    sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+                else:
+                    sock = ssl.wrap_socket(sock, server_hostname=self.host)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        try:
+            self._stream = sock.makefile("rwb")
+        except AttributeError:
+            self._stream = sock  # MicroPython: sockets are already streams
+        self.connects += 1
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = self._stream = None
+
+    def _send(self, method, path, body, headers):
+        stream = self._stream
+        stream.write(f"{method} {self.prefix}{path} HTTP/1.1\r\nHost: {self.host}\r\n".encode())
+        if not self.keepAlive:
+            stream.write(b"Connection: close\r\n")
+        for key, value in headers.items():
+            stream.write(f"{key}: {value}\r\n".encode())
+        stream.write(f"Content-Length: {len(body) if body else 0}\r\n\r\n".encode())
+        if body:
+            stream.write(body)
+        if hasattr(stream, "flush"):
+            stream.flush()
+
+    def _receive(self):
+        """Read the whole response, return (status code, body, server keeps the connection open)"""
+        stream = self._stream
+        line = stream.readline()
+        if not line:
+            raise OSError("connection closed by server")
+        status = int(line.split(None, 2)[1])
+        length, chunked, keepAlive = None, False, self.keepAlive
+        while True:
+            line = stream.readline()
+            if not line or line == b"\r\n":
+                break
+            key, _, value = line.partition(b":")
+            key, value = key.strip().lower(), value.strip().lower()
+            if key == b"content-length":
+                length = int(value)
+            elif key == b"transfer-encoding":
+                chunked = value == b"chunked"
+            elif key == b"connection":
+                keepAlive = keepAlive and value != b"close"
+        if chunked:
+            body = b""
+            while True:
+                size = int(stream.readline().split(b";")[0], 16)
+                if size:
+                    body += stream.read(size)
+                stream.readline()  # CRLF after the chunk
+                if not size:
+                    break
+        elif length is not None:
+            body = stream.read(length) if length else b""
+        elif status in (204, 304):
+            body = b""
+        else:  # no length: the body ends when the server closes the connection
+            body, keepAlive = stream.read(), False
+        return status, body, keepAlive
+
+    def request(self, method, path, body=None, headers={}):
+        """
+        Send a request and return (status code, response body)
+        A request on a reused connection which fails is sent once more on a new connection
+        """
+        while True:
+            fresh = self.sock is None
+            if fresh:
+                self._connect()
+            try:
+                self._send(method, path, body, headers)
+                status, response, keepAlive = self._receive()
+            except (OSError, ValueError, IndexError):  # ValueError/IndexError: malformed status line
+                self.close()
+                if fresh:
+                    raise
+                continue
+            self.requests += 1
+            if not keepAlive:
+                self.close()
+            return status, response
+
+
+def stubServer(handshakeDelay=0.0, latency=0.0, status=None):
+    """
+    Local InfluxDB /write stub on CPython, answering 204 with HTTP/1.1 keep-alive
+    handshakeDelay: seconds spent on every new connection, to mimic a TLS handshake
+    latency: seconds spent on every request
+    status: optional function(request index, body length) returning the status code to inject
+    Returns the server: url in server.url, connections counted in server.connects, requests in server.requests,
+    bytes received in server.bytes and points (lines of the bodies, decompressed if gzip) in server.points
+    """
+    import threading
+    import time
+    import zlib
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            self.server.connects += 1
+            time.sleep(handshakeDelay)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = zlib.decompress(body, 31)
+            time.sleep(latency)
+            code = status(self.server.requests, length) if status else 204
+            self.server.requests += 1
+            if code < 300:
+                self.server.bytes += length
+                self.server.points += len(body.strip().split(b"\n")) if body.strip() else 0
+            self.send_response(code)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.connects = server.requests = server.bytes = server.points = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_keepalive(nbSlices=25, handshakeDelay=0.05):
+    """
+    Flush nbSlices write requests against the local stub, with a new connection per request (urequests)
+    then with a single keep-alive connection
+    Returns a dictionary {mode: (connections/handshakes, wall time in ms)}
+    """
+    import time
+    body = b'28:cd:c1:07:e5:d5,sensorId=ACD0 logType="DATA",message="moisture",rawValue=40000.0,calcValue=29.0 1679738601965652859\n' * 20
+    results = {}
+    for name, keepAlive in (("new connection", False), ("keep-alive", True)):
+        server = stubServer(handshakeDelay)
+        http = HTTPConnection(server.url, keepAlive=keepAlive)
+        start = time.perf_counter()
+        for i in range(nbSlices):
+            http.request("POST", "/write?db=bench", body)
+        results[name] = (server.connects, (time.perf_counter() - start) * 1000)
+        http.close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+if __name__ == "__main__":
+    for name, (connects, ms) in bench_keepalive().items():
+        print(f"{name:>15}: {connects} handshakes, {ms:.0f} ms per flush of 25 slices")
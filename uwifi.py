@@ -9,40 +9,278 @@ SSIDs = const((
     ("eric's phone", 'password2')
     ))
 
+Fast reconnect: the SSID, BSSID, channel and IP configuration of the last successful connection are saved
+to CACHE_FILE. The next connection goes straight to this access point without scanning, with the same IP
+as long as the DHCP lease obtained is recent (LEASE_S), and falls back to a scan of all the SSIDs on failure.
+The status is polled every POLL_MS ; stats keeps the connection latencies of both paths.
 
+Selection of the network: the SSIDs found by a scan are tried best first, ranked by networks (NetworkTable)
+on their RSSI, their past success rate and connection time. networks also keeps the throughput of
+the uploads per network, for the uploader to decide whether to send now or wait for a better link: flushNow()
 """
-from time import sleep
+from micropython import const
+from array import array
+from time import time
+from utime import sleep_ms, ticks_ms, ticks_diff
+import json
 import network
-from ubinascii import hexlify
+from ubinascii import hexlify, unhexlify
 from ssids import SSIDs
+from telemetry import metrics
+
+CACHE_FILE = "wifi.json"
+POLL_MS = const(100)
+TIMEOUT_MS = const(10_000)  # per access point
+LEASE_S = const(12 * 3600)  # the IP obtained by DHCP is reused as a static IP during this delay
+FAST = const(0)  # connection to the cached access point
+SCAN = const(1)  # connection after a scan
+
+CONNECT_HISTOGRAMS = (metrics.histogram("wifi.fastMs", (300, 500, 1000, 2000, 5000)),
+              metrics.histogram("wifi.scanMs", (1000, 2000, 3000, 5000, 10000)))  # per path FAST, SCAN
+FAILURES_COUNTER = metrics.counter("wifi.failures")
+RSSI_GAUGE = metrics.gauge("wifi.rssi")
+
+
+class ConnectStats:
+    """Latencies in ms of the last connections, per path FAST or SCAN"""
+    def __init__(self, size=32):
+        self.ms = (array('I', [0] * size), array('I', [0] * size))
+        self.counts = [0, 0]
+        self.failures = 0
+
+    def record(self, path, ms):
+        latencies = self.ms[path]
+        latencies[self.counts[path] % len(latencies)] = ms
+        self.counts[path] += 1
+        metrics.observe(CONNECT_HISTOGRAMS[path], ms)
+
+    def percentiles(self, path, ps=(50, 90, 100)):
+        n = min(self.counts[path], len(self.ms[path]))
+        if not n:
+            return ()
+        latencies = sorted(self.ms[path][:n])
+        return tuple(latencies[min(n - 1, n * p // 100)] for p in ps)
+
+    def __str__(self):
+        return " ; ".join(f"{name} {self.counts[path]} p50/p90/max {'/'.join(str(ms) for ms in self.percentiles(path))} ms"
+                          for path, name in ((FAST, "fast"), (SCAN, "scan"))) + f" ; {self.failures} failures"
+
+
+stats = ConnectStats()
+
+NETWORKS_FILE = "networks.json"
+WEAK_RSSI = const(-80)          # dBm
+MIN_BYTES_PER_S = const(1000)   # slower uploads are not worth the radio time unless the queue fills up
+MIN_SAMPLE_BYTES = const(4096)  # smaller uploads measure the latency of the requests rather than the throughput
+# index of the statistics of a network
+ATTEMPTS = const(0)
+SUCCESSES = const(1)
+CONNECT_MS = const(2)   # moving average of the connection time
+RSSI = const(3)         # last RSSI seen
+BYTES_PER_S = const(4)  # moving average of the upload throughput
+UPLOADS = const(5)
+
+
+class NetworkTable:
+    """
+    Small persistent table of the networks used: {ssid: [attempts, successes, connect ms, rssi, bytes/s, uploads]}
+    The averages are exponential moving averages with the weight alpha for the last value
+    """
+    def __init__(self, path=NETWORKS_FILE, alpha=0.25):
+        self.path, self.alpha = path, alpha
+        try:
+            with open(path) as f:
+                self.table = json.load(f)
+        except (OSError, ValueError):
+            self.table = {}
+
+    def save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.table, f)
+        except OSError:
+            pass
+
+    def _network(self, SSID):
+        network = self.table.get(SSID)
+        if network is None:
+            network = self.table[SSID] = [0, 0, None, None, None, 0]
+        return network
+
+    def _average(self, average, value):
+        return value if average is None else average + self.alpha * (value - average)
+
+    def connected(self, SSID, success, ms, rssi=None):
+        """Record a connection attempt"""
+        network = self._network(SSID)
+        network[ATTEMPTS] += 1
+        if success:
+            network[SUCCESSES] += 1
+            network[CONNECT_MS] = self._average(network[CONNECT_MS], ms)
+        if rssi is not None:
+            network[RSSI] = rssi
+
+    def uploaded(self, SSID, nbBytes, ms):
+        """Record an upload of nbBytes in ms milliseconds, ignored when too small to measure the throughput"""
+        if nbBytes >= MIN_SAMPLE_BYTES and ms > 0:
+            network = self._network(SSID)
+            network[BYTES_PER_S] = self._average(network[BYTES_PER_S], nbBytes * 1000 / ms)
+            network[UPLOADS] += 1
+
+    def score(self, SSID, rssi):
+        """
+        The higher the better: RSSI in dBm, + up to 20 for the success rate (10 when unknown),
+        - 1 per second of connection time
+        """
+        network = self.table.get(SSID) or (0, 0, None)
+        successRate = (network[SUCCESSES] + 1) / (network[ATTEMPTS] + 2)
+        return rssi + 20 * successRate - (network[CONNECT_MS] or 0) / 1000
+
+    def rank(self, candidates):
+        """SSIDs of the candidates [(ssid, rssi)...] best first"""
+        return [SSID for SSID, rssi in sorted(candidates, key=lambda c: -self.score(c[0], c[1]))]
+
+    def bytesPerS(self, SSID):
+        network = self.table.get(SSID)
+        return network[BYTES_PER_S] if network else None
+
+    def flushNow(self, SSID, rssi=None, fill=0.0):
+        """
+        Whether to upload now on the network SSID: not on a weak link (RSSI or past throughput),
+        unless the queue is filled at more than half (fill from 0.0 to 1.0)
+        """
+        if fill >= 0.5:
+            return True
+        if rssi is not None and rssi < WEAK_RSSI:
+            return False
+        throughput = self.bytesPerS(SSID)
+        return throughput is None or throughput >= MIN_BYTES_PER_S
+
+
+networks = NetworkTable()
+
 
 class uWifi:
     _wlan = None
 
-    def __init__(self, display=None):
+    def __init__(self, display=None, connect=True, wlan=None):
         """
         Connect to a Wifi network looking through the possible ssids list
+        display: the progress is requested to this display.Display, drawn by its task when it runs
+        connect=False: only activate the interface, connect() or aconnect() to be called later
+        wlan: interface to use instead of network.WLAN(network.STA_IF), e.g. a fake one for testing
         """
-        self._wlan = network.WLAN(network.STA_IF)
+        self.display = display
+        self._wlan = wlan or network.WLAN(network.STA_IF)
         self._wlan.active(True)
+        if connect:
+            self.connect()
+
+    def _connecting(self):
+        """
+        Generator connecting to the cached access point, or else trying the SSIDs found by a scan best first:
+        yields the milliseconds to wait before polling again ; returns when connected or when all failed
+        """
+        start = ticks_ms()
+        self._wlan.active(True)
+        cache = self._loadCache()
+        passwords = dict(SSIDs)
+        if cache and cache["ssid"] in passwords:
+            age = time() - cache["at"]
+            fresh = 0 <= age < LEASE_S  # negative: the RTC is not set yet after a cold boot, the age is unknown
+            if fresh:
+                self._wlan.ifconfig(tuple(cache["ifconfig"]))  # no DHCP exchange
+            connected = yield from self._try(cache["ssid"], passwords[cache["ssid"]], unhexlify(cache["bssid"]))
+            networks.connected(cache["ssid"], connected, ticks_diff(ticks_ms(), start), self.rssi)
+            if connected:
+                stats.record(FAST, ticks_diff(ticks_ms(), start))
+                if not fresh:
+                    self._saveCache(cache["ssid"], cache["bssid"], cache["channel"])
+                networks.save()
+                return
+            self._wlan.disconnect()
+            if fresh:
+                self._setDHCP()
         nets = self._wlan.scan()
-        foundSSIDs = [n[0].decode('utf-8') for n in nets]
+        found = {}  # ssid --> strongest access point found (ssid, bssid, channel, RSSI, security, hidden)
+        for net in nets:
+            SSID = net[0].decode('utf-8')
+            if SSID in passwords and (SSID not in found or net[3] > found[SSID][3]):
+                found[SSID] = net
         # print(nets)
-        for SSID, PASSWORD in SSIDs:
-            if SSID in foundSSIDs:
-                print("Trying SSID", SSID)
-                self._wlan.connect(SSID, PASSWORD)
-                # Wait for connect or fail
-                for max_wait in range(10):
-                    print('Waiting for connection...', max_wait, "Status", self._wlan.status())
-                    if display:
-                        display.multiLines(f"Connecting to\n{SSID}\n\n{1 + max_wait}/10")
-                    sleep(1)
-                    if self._wlan.isconnected():
-                        print("Connected with self.ip:", self.ip)
-                        if display:
-                            display.multiLines(f"Connected to\n{SSID}\nIP {self.ip}")
-                        return
+        for SSID in networks.rank([(SSID, net[3]) for SSID, net in found.items()]):
+            attempt = ticks_ms()
+            connected = yield from self._try(SSID, passwords[SSID])
+            net = found[SSID]
+            networks.connected(SSID, connected, ticks_diff(ticks_ms(), attempt), net[3])
+            if connected:
+                stats.record(SCAN, ticks_diff(ticks_ms(), start))
+                self._saveCache(SSID, hexlify(net[1]).decode(), net[2])
+                networks.save()
+                return
+        stats.failures += 1
+        metrics.inc(FAILURES_COUNTER)
+        networks.save()
+
+    def _try(self, SSID, PASSWORD, bssid=None):
+        """Generator connecting to one access point, polling the status every POLL_MS ; returns True if connected"""
+        display = self.display
+        print("Trying SSID", SSID, "(cached)" if bssid else "")
+        if bssid:
+            self._wlan.connect(SSID, PASSWORD, bssid=bssid)
+        else:
+            self._wlan.connect(SSID, PASSWORD)
+        # Wait for connect or fail
+        for waited in range(0, TIMEOUT_MS, POLL_MS):
+            if self._wlan.isconnected():
+                print("Connected with self.ip:", self.ip)
+                rssi = self.rssi
+                if rssi is not None:
+                    metrics.set(RSSI_GAUGE, rssi)
+                if display:
+                    display.requestLines(f"Connected to\n{SSID}\nIP {self.ip}")
+                return True
+            if self._wlan.status() < 0:  # wrong password, access point not found...
+                break
+            if waited % 1000 == 0:
+                print('Waiting for connection...', waited // 1000, "Status", self._wlan.status())
+                if display:
+                    display.requestLines(f"Connecting to\n{SSID}\n\n{1 + waited // 1000}/{TIMEOUT_MS // 1000}")
+            yield POLL_MS
+        return False
+
+    def _loadCache(self):
+        try:
+            with open(CACHE_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _saveCache(self, SSID, bssid, channel):
+        """The IP configuration obtained by DHCP is saved with the access point"""
+        try:
+            with open(CACHE_FILE, "w") as f:
+                json.dump({"ssid": SSID, "bssid": bssid, "channel": channel,
+                           "ifconfig": self.ifconfig(), "at": time()}, f)
+        except OSError:
+            pass
+
+    def _setDHCP(self):
+        try:
+            self._wlan.ifconfig("dhcp")
+        except (TypeError, ValueError, OSError):
+            pass
+
+    def connect(self):
+        """Connect, blocking up to 10 seconds per SSID"""
+        for waitMs in self._connecting():
+            sleep_ms(waitMs)
+
+    async def aconnect(self):
+        """Connect from a uasyncio task: the other tasks keep running while waiting"""
+        from events import asyncio
+        for waitMs in self._connecting():
+            await asyncio.sleep(waitMs / 1000)
 
 
     # def __init__(self, display=None):
@@ -70,6 +308,16 @@ class uWifi:
     #                 display.multiLines(f"Connected to\n{SSID}\nIP {self.ip}")
     #             return
 
+    def disconnect(self, powerOff=True):
+        """Leave the access point ; powerOff switches the radio off until the next connection"""
+        self._wlan.disconnect()
+        if powerOff:
+            self._wlan.active(False)
+
+    def healthy(self):
+        """Connected with an IP address"""
+        return self._wlan.isconnected() and self.ip not in ("0.0.0.0", "?.?.?.?")
+
     def __bool__(self):
         return self._wlan.isconnected()
 
@@ -88,6 +336,14 @@ class uWifi:
             mac = ""
         return mac
 
+    @property
+    def rssi(self):
+        """Signal strength of the current connection in dBm, None if unknown"""
+        try:
+            return self._wlan.status('rssi')
+        except (ValueError, TypeError, OSError):
+            return None
+
     @property
     def ip(self):
         try:
@@ -97,7 +353,11 @@ class uWifi:
         return res
 
 if __name__ == "__main__":
-    wlan = uWifi()
-    if wlan:
-        print(f"Connected as {wlan.ip}")
-        print(f"MAC as {wlan.mac}")
\ No newline at end of file
+    for i in range(5):  # the first connection scans, the next ones reconnect to the cached access point
+        wlan = uWifi()
+        if wlan:
+            print(f"Connected as {wlan.ip}")
+            print(f"MAC as {wlan.mac}")
+        wlan._wlan.disconnect()
+    print(stats)
+    print(networks.table)
\ No newline at end of file
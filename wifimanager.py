@@ -0,0 +1,195 @@
+"""
+Wifi connection shared by the tasks needing the network (uploads, NTP, manual sends)
+
+- acquire() / release() count the users of the connection: the first acquire connects, the next ones reuse it
+  async with wifi as wlan: ... does both, wlan being None if the connection failed
+- once the last user released it, the connection lingers for lingerMs: bursts of uploads share one association
+  then the run() task disconnects and switches the radio off
+- the run() task also checks the health of the connection every healthMs: a lost connection is
+  reconnected by the next acquire()
+Metrics: connects, reuses, failures, healthFailures and radioOnMs (time with the radio on)
+"""
+from utime import ticks_ms, ticks_diff
+from events import asyncio
+from uwifi import uWifi
+
+
+class WifiManager:
+    """
+    display: given to uWifi to show the progress of the connections
+    onConnect, onDisconnect: called after connecting and before disconnecting, e.g. to switch a LED
+    wlan: interface given to uWifi instead of network.WLAN, e.g. a fake one for testing
+    """
+    def __init__(self, display=None, lingerMs=60_000, healthMs=5_000, onConnect=None, onDisconnect=None, wlan=None):
+        self.wlan = uWifi(display, connect=False, wlan=wlan)
+        self.wlan.disconnect()  # radio off until needed
+        self.lingerMs, self.healthMs = lingerMs, healthMs
+        self.onConnect, self.onDisconnect = onConnect, onDisconnect
+        self.refs = 0
+        self.connected = False
+        self._lock = asyncio.Lock()
+        self._releasedAt = ticks_ms()
+        self._radioOnAt = None  # ticks_ms when the radio was switched on
+        self._radioOnMs = 0
+        self.connects = self.reuses = self.failures = self.healthFailures = 0
+
+    def _reuse(self):
+        if self.connected and self.wlan.healthy():
+            self.reuses += 1
+            return True
+        if self.connected:  # lost since the last health check
+            self.healthFailures += 1
+            self.connected = False
+        if self._radioOnAt is None:
+            self._radioOnAt = ticks_ms()
+        return False
+
+    def _connected(self):
+        self.connected = bool(self.wlan)
+        if self.connected:
+            self.connects += 1
+            if self.onConnect:
+                self.onConnect()
+        else:
+            self.failures += 1
+        return self.wlan if self.connected else None
+
+    async def acquire(self):
+        """
+        Return the connected uWifi, None if the connection failed ; release() to call in any case
+        but an exception, e.g. cancelled: the reference is already released
+        """
+        self.refs += 1
+        try:
+            async with self._lock:  # one connection at a time, the other users wait for it
+                if self._reuse():
+                    return self.wlan
+                await self.wlan.aconnect()
+                return self._connected()
+        except BaseException:
+            self.release()
+            raise
+
+    def acquireNow(self):
+        """Same as acquire() blocking, e.g. before the tasks are started"""
+        self.refs += 1
+        try:
+            if self._reuse():
+                return self.wlan
+            self.wlan.connect()
+            return self._connected()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        self.refs -= 1
+        if self.refs <= 0:
+            self._releasedAt = ticks_ms()
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def disconnect(self):
+        """Disconnect and switch the radio off now, e.g. before a sleep ; acquire() will connect again"""
+        if self._radioOnAt is None:
+            return
+        if self.connected and self.onDisconnect:
+            self.onDisconnect()
+        self.wlan.disconnect()
+        self.connected = False
+        self._radioOnMs += ticks_diff(ticks_ms(), self._radioOnAt)
+        self._radioOnAt = None
+
+    @property
+    def radioOnMs(self):
+        """Total time with the radio on, including the current connection"""
+        if self._radioOnAt is None:
+            return self._radioOnMs
+        return self._radioOnMs + ticks_diff(ticks_ms(), self._radioOnAt)
+
+    def check(self):
+        """
+        Disconnect once the linger delay is over, check the health of the connection
+        Return the milliseconds before the next check is needed
+        """
+        waitMs = self.healthMs
+        if self._radioOnAt is not None and self.refs <= 0 and not self._lock.locked():
+            lingered = ticks_diff(ticks_ms(), self._releasedAt)
+            if lingered >= self.lingerMs:
+                self.disconnect()
+            else:
+                waitMs = min(waitMs, self.lingerMs - lingered)
+        elif self.connected and not self.wlan.healthy():
+            self.healthFailures += 1
+            self.connected = False
+        return waitMs
+
+    async def run(self):
+        """Task calling check(): without this task, e.g. on core 1, check() is to be called regularly"""
+        while True:
+            await asyncio.sleep(self.check() / 1000)
+
+    def __str__(self):
+        return (f"WifiManager({self.refs} users, {self.connects} connects, {self.reuses} reuses, "
+                f"{self.failures} failures, {self.healthFailures} lost, radio on {self.radioOnMs} ms)")
+
+
+if __name__ == "__main__":
+    # on CPython, with a fake WLAN: a burst of 3 uploads, an NTP sync during the second one, then the linger delay
+    import time
+
+    class FakeWLAN:
+        def __init__(self, connectS=0.5):
+            self.connectS, self._at, self._active = connectS, None, False
+
+        def active(self, a=None):
+            if a is None:
+                return self._active
+            self._active = a
+
+        def scan(self):
+            from ssids import SSIDs
+            return [(SSIDs[0][0].encode(), b"\x00\x11\x22\x33\x44\x55", 6, -60, 3, 0)]
+
+        def connect(self, ssid, password, bssid=None):
+            self._at, self._ssid = time.time() + self.connectS, ssid
+
+        def disconnect(self):
+            self._at = None
+
+        def isconnected(self):
+            return self._at is not None and time.time() >= self._at
+
+        def status(self):
+            return 3 if self.isconnected() else 1 if self._at else 0
+
+        def ifconfig(self, *config):
+            return ("192.168.1.10", "255.255.255.0", "192.168.1.1", "8.8.8.8")
+
+        def config(self, key):
+            return {"mac": b"\x28\xcd\xc1\x07\xe5\xd5", "ssid": getattr(self, "_ssid", "")}[key]
+
+    async def upload(wifi, name, durationS):
+        async with wifi as wlan:
+            print(f"{name}: connected {bool(wlan)} ({wifi})")
+            await asyncio.sleep(durationS)
+
+    async def demo():
+        fake = FakeWLAN()
+        wifi = WifiManager(lingerMs=1000, healthMs=200, wlan=fake)
+        asyncio.create_task(wifi.run())
+        await upload(wifi, "upload 1", 0.2)
+        await asyncio.gather(upload(wifi, "upload 2", 0.3), upload(wifi, "NTP", 0.1))
+        await asyncio.sleep(0.5)
+        await upload(wifi, "upload 3", 0.2)
+        fake.disconnect()  # access point lost
+        await asyncio.sleep(0.4)
+        await upload(wifi, "upload 4", 0.1)
+        await asyncio.sleep(1.5)
+        print("after the linger delay:", wifi, "radio", "on" if fake.active() else "off")
+
+    asyncio.run(demo())